@@ -0,0 +1,240 @@
+import io
+import os
+import struct
+import zlib
+from dataclasses import dataclass, field
+from typing import BinaryIO, List, Optional, Tuple
+
+from fastq_handler.compression import GzipCodec
+
+
+@dataclass
+class BlockIndex:
+    """
+    sidecar index of a bgzf file, one row per block:
+    compressed offset, uncompressed offset, uncompressed size and
+    number of reads ending in the block.
+    """
+
+    suffix = ".blocks"
+    columns = ["compressed_offset", "uncompressed_offset",
+               "uncompressed_size", "reads"]
+
+    blocks: List[Tuple[int, int, int, int]] = field(default_factory=list)
+
+    @staticmethod
+    def get_path(gz_file: str) -> str:
+        return gz_file + BlockIndex.suffix
+
+    @property
+    def uncompressed_end(self) -> int:
+        if not self.blocks:
+            return 0
+
+        _, uncompressed_offset, uncompressed_size, _ = self.blocks[-1]
+
+        return uncompressed_offset + uncompressed_size
+
+    @property
+    def reads(self) -> int:
+        return sum(block[3] for block in self.blocks)
+
+    def add(self, compressed_offset: int, uncompressed_offset: int, uncompressed_size: int, reads: int):
+        self.blocks.append(
+            (compressed_offset, uncompressed_offset, uncompressed_size, reads))
+
+    def extend(self, other: "BlockIndex", compressed_shift: int) -> "BlockIndex":
+        """
+        append blocks of a file concatenated after compressed_shift bytes
+        """
+        uncompressed_shift = self.uncompressed_end
+
+        for compressed_offset, uncompressed_offset, uncompressed_size, reads in other.blocks:
+            self.add(compressed_offset + compressed_shift,
+                     uncompressed_offset + uncompressed_shift,
+                     uncompressed_size, reads)
+
+        return self
+
+    @classmethod
+    def load(cls, gz_file: str) -> Optional["BlockIndex"]:
+        """
+        index of gz_file, None if missing
+        """
+        try:
+            with open(cls.get_path(gz_file), "r") as index_file:
+                lines = index_file.read().splitlines()[1:]
+        except FileNotFoundError:
+            return None
+
+        return cls([tuple(int(value) for value in line.split("\t")) for line in lines])
+
+    def save(self, gz_file: str):
+        """
+        write index next to gz_file
+        """
+        index_path = self.get_path(gz_file)
+        tmp_path = index_path + ".tmp"
+
+        with open(tmp_path, "w") as index_file:
+            index_file.write("\t".join(self.columns) + "\n")
+
+            for block in self.blocks:
+                index_file.write("\t".join(str(value)
+                                 for value in block) + "\n")
+
+        os.replace(tmp_path, index_path)
+
+    @classmethod
+    def remove(cls, gz_file: str):
+        if os.path.exists(cls.get_path(gz_file)):
+            os.remove(cls.get_path(gz_file))
+
+
+class BgzfWriter(io.RawIOBase):
+    """
+    write bgzf blocks into fileobj. blocks end on fastq record boundaries where
+    a record fits, so each block can be decompressed and parsed on its own.
+    closing writes the empty end of file block, fileobj is left open.
+    """
+
+    max_block_data = 0xff00
+    max_block_size = 0x10000
+    header = struct.Struct("<4BI2BH2BHH")
+    trailer = struct.Struct("<II")
+    eof_block = bytes.fromhex(
+        "1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+    def __init__(self, fileobj: BinaryIO, compresslevel: int = 6, index: Optional[BlockIndex] = None):
+        super().__init__()
+        self.fileobj = fileobj
+        self.compresslevel = compresslevel
+        self.index = index
+
+        fileobj.flush()
+        self.compressed_offset = os.fstat(fileobj.fileno()).st_size
+        self.uncompressed_offset = index.uncompressed_end if index is not None else 0
+
+        self.buffer = bytearray()
+        self.newlines = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data) -> int:
+        self.buffer.extend(data)
+
+        while len(self.buffer) >= self.max_block_data:
+            cut = self.record_cut(bytes(self.buffer[:self.max_block_data]))
+            self.write_block(bytes(self.buffer[:cut]))
+            del self.buffer[:cut]
+
+        return len(data)
+
+    def record_cut(self, chunk: bytes) -> int:
+        """
+        length of chunk up to the last complete record, all of it if none fits
+        """
+        n_lines = chunk.count(b"\n")
+        extra_lines = (self.newlines + n_lines) % 4
+
+        if n_lines - extra_lines <= 0:
+            return len(chunk)
+
+        position = chunk.rfind(b"\n")
+        for _ in range(extra_lines):
+            position = chunk.rfind(b"\n", 0, position)
+
+        return position + 1
+
+    def compress_block(self, data: bytes, compresslevel: int) -> bytes:
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+        deflated = compressor.compress(data) + compressor.flush()
+
+        block_size = self.header.size + len(deflated) + self.trailer.size
+
+        return self.header.pack(0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord("B"), ord("C"), 2, block_size - 1) + \
+            deflated + self.trailer.pack(zlib.crc32(data), len(data))
+
+    def write_block(self, data: bytes):
+        block = self.compress_block(data, self.compresslevel)
+
+        if len(block) > self.max_block_size:
+            block = self.compress_block(data, 0)
+
+        newlines = self.newlines + data.count(b"\n")
+        reads = newlines // 4 - self.newlines // 4
+        self.newlines = newlines
+
+        self.fileobj.write(block)
+
+        if self.index is not None:
+            self.index.add(self.compressed_offset,
+                           self.uncompressed_offset, len(data), reads)
+
+        self.compressed_offset += len(block)
+        self.uncompressed_offset += len(data)
+
+    def close(self):
+        if self.closed:
+            return
+
+        super().close()
+
+        if self.buffer:
+            self.write_block(bytes(self.buffer))
+            self.buffer.clear()
+
+        self.fileobj.write(self.eof_block)
+        self.compressed_offset += len(self.eof_block)
+        self.fileobj.flush()
+
+
+class BgzfCodec(GzipCodec):
+    """
+    bgzf output with a block index next to the file. gzip input is
+    recompressed into blocks, not appended raw.
+    """
+
+    name = "bgzf"
+    raw_append = False
+
+    @staticmethod
+    def is_available() -> bool:
+        return True
+
+    def open_writer(self, fileobj: BinaryIO) -> BinaryIO:
+        return IndexedBgzfWriter(fileobj, self.compresslevel)
+
+
+class IndexedBgzfWriter(BgzfWriter):
+    """
+    bgzf writer keeping the index of the file it writes to.
+    appending to a file without an index drops indexing.
+    """
+
+    def __init__(self, fileobj: BinaryIO, compresslevel: int = 6):
+        self.gz_file = getattr(fileobj, "name", None)
+
+        index = None
+        if isinstance(self.gz_file, str):
+            fileobj.flush()
+
+            if os.fstat(fileobj.fileno()).st_size == 0:
+                index = BlockIndex()
+            else:
+                index = BlockIndex.load(self.gz_file)
+
+                if index is None:
+                    self.gz_file = None
+
+        super().__init__(fileobj, compresslevel, index)
+
+    def close(self):
+        if self.closed:
+            return
+
+        super().close()
+
+        if self.index is not None and isinstance(self.gz_file, str):
+            self.index.save(self.gz_file)
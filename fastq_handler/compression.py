@@ -0,0 +1,418 @@
+import gzip
+import io
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+from abc import ABC, abstractmethod
+from typing import BinaryIO, Dict, List, Optional, Tuple, Type
+
+try:
+    from isal import igzip, igzip_threaded
+except ImportError:
+    igzip = None
+    igzip_threaded = None
+
+try:
+    from zlib_ng import gzip_ng, gzip_ng_threaded
+except ImportError:
+    gzip_ng = None
+    gzip_ng_threaded = None
+
+
+class GzipCodec(ABC):
+    """
+    abstract gzip compressor writing members into an open binary file.
+    """
+
+    name: str = ""
+    levels: Tuple[int, ...] = (0, 1, 3, 6, 9)
+    raw_append = True  # gzip input may be appended without recompression
+    writes_fd = False  # writes to the file descriptor, bypassing fileobj.write
+
+    def __init__(self, compresslevel: int = 3, threads: int = 1):
+        self.compresslevel = compresslevel
+        self.threads = max(threads, 1)
+
+    @staticmethod
+    @abstractmethod
+    def is_available() -> bool:
+        """
+        backend can be used here
+        """
+        pass
+
+    @abstractmethod
+    def open_writer(self, fileobj: BinaryIO) -> BinaryIO:
+        """
+        writable stream compressing into fileobj. closing it ends the gzip member,
+        fileobj is left open.
+        """
+        pass
+
+
+class ZlibCodec(GzipCodec):
+    """
+    stdlib gzip, single threaded
+    """
+
+    name = "zlib"
+
+    @staticmethod
+    def is_available() -> bool:
+        return True
+
+    def open_writer(self, fileobj: BinaryIO) -> BinaryIO:
+        return gzip.GzipFile(fileobj=fileobj, mode="wb", compresslevel=self.compresslevel)
+
+
+class IsalCodec(GzipCodec):
+    """
+    python-isal. isa-l levels are 0-3, higher levels are capped.
+    """
+
+    name = "isal"
+    max_compresslevel = 3
+    levels = (0, 1, 2, 3)
+
+    @staticmethod
+    def is_available() -> bool:
+        return igzip is not None
+
+    def open_writer(self, fileobj: BinaryIO) -> BinaryIO:
+        compresslevel = min(self.compresslevel, self.max_compresslevel)
+
+        if self.threads > 1:
+            return igzip_threaded.open(fileobj, "wb", compresslevel=compresslevel, threads=self.threads)
+
+        return igzip.IGzipFile(fileobj=fileobj, mode="wb", compresslevel=compresslevel)
+
+
+class ZlibNgCodec(GzipCodec):
+    """
+    python-zlib-ng
+    """
+
+    name = "zlib-ng"
+
+    @staticmethod
+    def is_available() -> bool:
+        return gzip_ng is not None
+
+    def open_writer(self, fileobj: BinaryIO) -> BinaryIO:
+        if self.threads > 1:
+            return gzip_ng_threaded.open(fileobj, "wb", compresslevel=self.compresslevel, threads=self.threads)
+
+        return gzip_ng.GzipNGFile(fileobj=fileobj, mode="wb", compresslevel=self.compresslevel)
+
+
+class PigzWriter(io.RawIOBase):
+    """
+    pipe to a pigz process writing to fileobj
+    """
+
+    def __init__(self, fileobj: BinaryIO, compresslevel: int, threads: int):
+        super().__init__()
+        fileobj.flush()
+
+        self.process = subprocess.Popen(
+            ["pigz", "-c", f"-{compresslevel}", "-p", str(threads)],
+            stdin=subprocess.PIPE, stdout=fileobj)
+
+    def writable(self):
+        return True
+
+    def write(self, data) -> int:
+        self.process.stdin.write(data)
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+
+        super().close()
+        self.process.stdin.close()
+
+        if self.process.wait() != 0:
+            raise OSError(f"pigz exited with code {self.process.returncode}")
+
+
+class PigzCodec(GzipCodec):
+    """
+    pigz subprocess, fileobj must have a file descriptor.
+    """
+
+    name = "pigz"
+    writes_fd = True
+
+    @staticmethod
+    def is_available() -> bool:
+        return shutil.which("pigz") is not None
+
+    def open_writer(self, fileobj: BinaryIO) -> BinaryIO:
+        return PigzWriter(fileobj, self.compresslevel, self.threads)
+
+
+class MeasuredWriter(io.RawIOBase):
+    """
+    codec writer reporting bytes in, bytes out and time spent compressing.
+    """
+
+    def __init__(self, fileobj: BinaryIO, codec: GzipCodec, advisor: "CompressionLevelAdvisor"):
+        super().__init__()
+        self.fileobj = fileobj
+        self.codec = codec
+        self.advisor = advisor
+        self.bytes_in = 0
+        self.seconds = 0.0
+
+        fileobj.flush()
+        self.start_size = os.fstat(fileobj.fileno()).st_size
+
+        start = time.perf_counter()
+        self.writer = codec.open_writer(fileobj)
+        self.seconds += time.perf_counter() - start
+
+    def writable(self):
+        return True
+
+    def write(self, data) -> int:
+        start = time.perf_counter()
+        self.writer.write(data)
+        self.seconds += time.perf_counter() - start
+
+        self.bytes_in += len(data)
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+
+        super().close()
+
+        start = time.perf_counter()
+        self.writer.close()
+        self.fileobj.flush()
+        self.seconds += time.perf_counter() - start
+
+        bytes_out = os.fstat(self.fileobj.fileno()).st_size - self.start_size
+        self.advisor.record_compression(
+            self.codec.compresslevel, self.bytes_in, bytes_out, self.seconds)
+
+
+class CompressionLevelAdvisor:
+    """
+    pick the compression level minimising compress time plus upload time
+    per input byte. compressor rate and ratio per level are calibrated on a
+    sample and then follow real compressions, upload rate follows uploads.
+    without an upload measurement the default level is used. level 0 stores
+    the data uncompressed and is never a candidate.
+    """
+
+    smoothing = 0.3
+    min_upload_bytes = 1024 * 1024
+    calibration_reads = 1000
+    min_level = 1
+
+    def __init__(self, codec_class: Type[GzipCodec], default_level: int = 3, threads: int = 1):
+        self.codec_class = codec_class
+        self.default_level = default_level
+        self.threads = threads
+
+        self.compress_rate: Dict[int, float] = {}
+        self.ratio: Dict[int, float] = {}
+        self.upload_rate: Optional[float] = None
+
+    def smooth(self, previous: Optional[float], value: float) -> float:
+        if previous is None:
+            return value
+
+        return (1 - self.smoothing) * previous + self.smoothing * value
+
+    @property
+    def candidate_levels(self) -> List[int]:
+        return [level for level in self.codec_class.levels if level >= self.min_level]
+
+    def calibrate(self, sample: Optional[bytes] = None):
+        """
+        compress sample at each level
+        """
+        if sample is None:
+            sample = benchmark_sample(n_reads=self.calibration_reads)
+
+        for level in self.candidate_levels:
+            codec = self.codec_class(level, self.threads)
+
+            with tempfile.TemporaryFile() as output:
+                start = time.perf_counter()
+
+                with codec.open_writer(output) as writer:
+                    writer.write(sample)
+
+                seconds = time.perf_counter() - start
+                output.flush()
+                output_size = os.fstat(output.fileno()).st_size
+
+            self.record_compression(level, len(sample), output_size, seconds)
+
+        return self
+
+    def record_compression(self, level: int, bytes_in: int, bytes_out: int, seconds: float):
+        if bytes_in == 0 or seconds <= 0:
+            return
+
+        self.compress_rate[level] = self.smooth(
+            self.compress_rate.get(level), bytes_in / seconds)
+        self.ratio[level] = self.smooth(
+            self.ratio.get(level), bytes_out / bytes_in)
+
+    def record_upload(self, n_bytes: int, seconds: float):
+        """
+        upload listener, small files are dominated by latency and ignored.
+        """
+        if n_bytes < self.min_upload_bytes or seconds <= 0:
+            return
+
+        self.upload_rate = self.smooth(self.upload_rate, n_bytes / seconds)
+
+    def cost(self, level: int) -> float:
+        """
+        seconds per input byte to compress and upload at level
+        """
+        return 1 / self.compress_rate[level] + self.ratio[level] / self.upload_rate
+
+    def choose_level(self) -> int:
+        levels = [level for level in self.compress_rate if level >= self.min_level]
+
+        if self.upload_rate is None or not levels:
+            return self.default_level
+
+        return min(levels, key=self.cost)
+
+
+class AdaptiveCodec(GzipCodec):
+    """
+    codec_class at the level chosen by the advisor for each new member
+    """
+
+    def __init__(self, codec_class: Type[GzipCodec], advisor: CompressionLevelAdvisor, threads: int = 1):
+        super().__init__(advisor.default_level, threads)
+        self.codec_class = codec_class
+        self.advisor = advisor
+        self.name = codec_class.name
+        self.levels = codec_class.levels
+        self.raw_append = codec_class.raw_append
+        self.writes_fd = codec_class.writes_fd
+
+    def is_available(self) -> bool:
+        return self.codec_class.is_available()
+
+    def open_writer(self, fileobj: BinaryIO) -> BinaryIO:
+        codec = self.codec_class(self.advisor.choose_level(), self.threads)
+
+        return MeasuredWriter(fileobj, codec, self.advisor)
+
+
+CODECS: Dict[str, Type[GzipCodec]] = {
+    codec.name: codec for codec in [IsalCodec, ZlibNgCodec, PigzCodec, ZlibCodec]
+}
+
+
+def available_codecs() -> List[str]:
+    return [name for name, codec in CODECS.items() if codec.is_available()]
+
+
+def benchmark_sample(n_reads: int = 4000, read_length: int = 250) -> bytes:
+    """
+    fastq-like sample, fixed seed
+    """
+    rand = random.Random(0)
+    reads = []
+
+    for ix in range(n_reads):
+        seq = "".join(rand.choices("ACGT", k=read_length))
+        qual = "".join(rand.choices("+5?IIII", k=read_length))
+        reads.append(f"@read_{ix} ch={ix % 512}\n{seq}\n+\n{qual}\n")
+
+    return "".join(reads).encode()
+
+
+def benchmark_codec(codec: GzipCodec, sample: bytes) -> float:
+    """
+    seconds to compress sample
+    """
+    with tempfile.TemporaryFile() as output:
+        start = time.perf_counter()
+
+        with codec.open_writer(output) as writer:
+            writer.write(sample)
+
+        return time.perf_counter() - start
+
+
+def fastest_codec(compresslevel: int = 3, threads: int = 1, sample: Optional[bytes] = None) -> GzipCodec:
+    """
+    compress a sample with each available backend, return the fastest
+    """
+    if sample is None:
+        sample = benchmark_sample()
+
+    timings = {}
+
+    for name in available_codecs():
+        codec = CODECS[name](compresslevel, threads)
+        try:
+            timings[name] = benchmark_codec(codec, sample)
+        except OSError as error:
+            print(f"codec {name} failed: ", error)
+
+    name = min(timings, key=timings.get)
+    print(f"gzip codec: {name} ({timings[name] * 1000:.1f} ms on benchmark)")
+
+    return CODECS[name](compresslevel, threads)
+
+
+_benchmarked: Dict[Tuple[int, int], str] = {}
+
+
+def get_codec(name: str = "auto", compresslevel: int = 3, threads: int = 1) -> GzipCodec:
+    """
+    codec by name, "auto" benchmarks the available ones once per process.
+    """
+    if name == "auto":
+        if (compresslevel, threads) not in _benchmarked:
+            _benchmarked[(compresslevel, threads)] = fastest_codec(
+                compresslevel, threads).name
+
+        name = _benchmarked[(compresslevel, threads)]
+
+    if name not in CODECS:
+        raise ValueError(f"unknown codec {name}, choose from {list(CODECS)}")
+
+    if not CODECS[name].is_available():
+        raise ValueError(f"codec {name} is not available")
+
+    return CODECS[name](compresslevel, threads)
+
+
+_default_codec: Optional[GzipCodec] = None
+
+
+def set_default_codec(codec: GzipCodec):
+    global _default_codec
+    _default_codec = codec
+
+
+def get_default_codec() -> GzipCodec:
+    """
+    codec used by Utils when none is given. until one is set,
+    the first in-process backend available.
+    """
+    if _default_codec is not None:
+        return _default_codec
+
+    for codec in [IsalCodec, ZlibNgCodec, ZlibCodec]:
+        if codec.is_available():
+            return codec()
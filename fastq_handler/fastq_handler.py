@@ -1,445 +1,990 @@
-# -*- coding: utf-8 -*-
-"""
-Created on Fri Feb 17 14:20:20 2023
-
-@author: andre
-"""
-
-import os
-import subprocess
-import sys
-import time
-
-import pandas as pd
-
-from fastq_handler.records import Processed, RunConfig
-from fastq_handler.utilities import Utils
-
-pd.options.mode.chained_assignment = None  # default='warn'
-
-
-"""
-Notes:
-- Now automatically detects if there's barcoding or not and also the format.
-- Now it always creates .fastq.gz merged files.
-
-TO DO:
-- de sleep em sleep fazer uma pasta com 'lattest_compilation_to_upload' todos os últimos concatenados por amostra
-(barcode10, barcode11, etc) + um ficheiro de metadata com todos os dados respetivos dos concatenados totais.
-
-"""
-
-HELP = " _________________________________________________\n | mfmc.py - MERGING FASTQ AND METADATA CREATION | \n _________________________________________________\nExample of usage:\npython mfmc.py --in_dir C:\\users\\samples --out_dir C:\\users\processed_files --tsv_t_name template.tsv --tsv_t_dir C:\\users\\templates \n\nOptions and arguments:\n--in_dir [DIRECTORY OF THE FAST_PASS] : directory of the files being produced by the sequencing machine (typically the 'fast_pass' folder).\n--out_dir [OUTPUT DIRECTORY or 'q' for the default] : desired directory to storage the output files\n--tsv_t_n [TSV TEMPLATE FILE NAME] : name of the tsv template\n--tsv_t_dir [TSV TEMPLATE DIRECTORY] : directory of the tsv template file\n--sleep [TIME SLEEP] : amount of time (in seconds) for the script to hold, between search cycles"
-ARGUMENT_OPTIONS = ["--in_dir", "--out_dir", "--tsv_t_n", "--tsv_t_dir"]
-
-
-####################         5 - Main functions          #####################
-
-
-class PreMain:
-
-    start_time: float
-    folder_files: list = []
-
-    fastq_dir: str
-    start_time: float
-    real_sleep: int = 5
-    fastq_depth: int = -1
-
-    processed: Processed
-    fastq_avail: pd.DataFrame = pd.DataFrame()
-
-    def __init__(
-        self,
-        run_metadata: RunConfig,
-
-    ):
-        self.fastq_dir = run_metadata.fastq_dir
-        self.run_metadata = run_metadata
-        self.start_time = time.time()
-        self.real_sleep = run_metadata.sleep_time
-
-        self.processed = Processed(
-            output_dir=self.run_metadata.logs_dir)
-
-        self.log_dir = os.path.join(
-            self.run_metadata.logs_dir,
-        )
-
-    def prep_output_dirs(self):
-        """
-        create output directories
-        """
-        os.makedirs(self.run_metadata.output_dir, exist_ok=True)
-        os.makedirs(self.log_dir, exist_ok=True)
-        return self
-
-    def assess_depth_fastqs(self):
-
-        utils = Utils()
-        fastq_depth = -1
-
-        if utils.seqs_in_dir(self.fastq_dir):
-            fastq_depth = 0
-
-        if utils.seqs_in_subdir(self.fastq_dir):
-            fastq_depth = 1
-
-        self.fastq_depth = fastq_depth
-
-        return self
-
-    def assess_proceed(self):
-        """
-        assess if proceed
-        """
-        if self.fastq_depth == -1:
-            print("No fastq files found in: ", self.fastq_dir)
-
-        return self
-
-    def get_directories_to_process(self):
-        """
-        get directories to process
-        """
-
-        utils = Utils()
-
-        if self.fastq_depth == 0:
-            return [self.fastq_dir]
-
-        else:
-            return utils.get_subdirectories(self.fastq_dir)
-
-    def get_directory_processing(self, fastq_dir: str):
-        return DirectoryProcessingSimple(fastq_dir, self.run_metadata, self.processed, self.start_time)
-
-    def process_fastq_dict(self):
-        """
-        process fastq dict
-        """
-        for fastq_dir in self.get_directories_to_process():
-            directory_processing = self.get_directory_processing(
-                fastq_dir=fastq_dir,
-            )
-
-            directory_processing.process_folder()
-
-        return self
-
-    def run(self):
-        """
-        run single pass
-        """
-        (self.prep_output_dirs()
-         .assess_depth_fastqs()
-         .assess_proceed()
-         .process_fastq_dict())
-
-        self.processed.export(
-            self.run_metadata.logs_dir
-        )
-
-    def run_until_killed(self):
-        """
-        run until killed
-        """
-        try:
-            while True:
-                self.run()
-                print("Sleeping for: ", self.real_sleep, " seconds")
-                time.sleep(self.real_sleep)
-
-        except KeyboardInterrupt:
-
-            print("KeyboardInterrupt")
-            return
-
-
-class DirectoryProcessing():
-    """
-    class to process a directory
-    copies all files to a single directory. checks if already processed.
-    creates directory specific output subdirectory in output directory.
-    """
-
-    merged_dir_name = "merged_files"
-    outfiles_dir_name = "out_files"
-
-    def __init__(self, fastq_dir: str, run_metadata: RunConfig, processed: Processed, start_time: float):
-        self.fastq_dir = fastq_dir
-        self.run_metadata = run_metadata
-        self.start_time = start_time
-        self.processed = processed
-
-        self.merged_gz_dir = os.path.join(
-            self.run_metadata.output_dir,
-            os.path.basename(self.fastq_dir.strip("/")),)
-
-    def time_since_start(self):
-        """
-        returns the time since the start of the program
-        """
-        return time.time() - self.start_time
-
-    def prep_output_dirs(self):
-        """create output dirs"""
-
-        for dir in [
-            self.merged_gz_dir,
-        ]:
-            os.makedirs(dir, exist_ok=True)
-
-    def match_to_processed(self, fastq_file, fastq_dir):
-        """
-        match to process dict
-        """
-
-        return self.processed.file_exists(
-            fastq_file=fastq_file,
-            fastq_dir=fastq_dir
-        )
-
-    @staticmethod
-    def check_file_open_linux(file_path):
-        """
-        check if file is open
-        """
-        command = f"lsof -t {file_path} | wc -l"
-        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE)
-        output, error = process.communicate()
-
-        output = output.decode("utf-8").strip()
-
-        return int(output) > 1
-
-    def check_file_open_windows(self, file_path):
-        """
-        check if file is open
-        """
-        return True
-
-    def check_file_open(self, file_path):
-        """
-        check if file is open
-        """
-
-        platform = sys.platform
-
-        if platform == "linux":
-            return self.check_file_open_linux(file_path)
-
-        elif platform == "win32":
-            return self.check_file_open_windows(file_path)
-
-        return True
-
-    def check_file_for_process(self, fastq_file, fastq_dir):
-        """
-        check if file is open
-        """
-
-        file_path = os.path.join(
-            fastq_dir,
-            fastq_file)
-
-        if not os.path.isfile(file_path):
-            return False
-
-        if self.match_to_processed(fastq_file, fastq_dir):
-            return False
-
-        return False if self.check_file_open(file_path) else True
-
-    def get_files(self):
-        """
-        get folders and files
-        """
-
-        utils = Utils()
-
-        folder_files = utils.search_folder_for_seq_files(self.fastq_dir)
-        folder_files = [
-            x for x in folder_files if self.check_file_for_process(x, self.fastq_dir)]
-
-        if folder_files == []:
-            print("No new files in ", self.fastq_dir)
-
-        folder_files = [os.path.join(self.fastq_dir, x) for x in folder_files]
-
-        return folder_files
-
-    def append_to_file(self, fastq_file, destination_file):
-        """
-        append to file
-        """
-        utils = Utils()
-
-        utils.append_file_to_gz(
-            fastq_file, destination_file
-        )
-
-    def get_merged_file_name(self, fastq_file, fastq_dir):
-
-        _, run_num = self.processed.get_run_barcode(
-            fastq_file, fastq_dir)
-
-        merged_name_prefix = os.path.basename(os.path.dirname(fastq_file))
-
-        first_run_barcode = self.processed.get_dir_barcode_first(fastq_dir)
-        if first_run_barcode == "":
-            first_run_barcode = run_num
-
-        if self.run_metadata.name_tag:
-            merged_name_prefix = f"{merged_name_prefix}_{self.run_metadata.name_tag}"
-
-        merged_name = f"{merged_name_prefix}_{first_run_barcode}-{run_num}.fastq.gz"
-
-        merged_name = os.path.join(self.merged_gz_dir, merged_name)
-
-        return merged_name
-
-    def prep_merged_file(self, fastq_file, fastq_dir):
-        """
-        get merged name
-        """
-        utils = Utils()
-
-        merged_name = self.get_merged_file_name(fastq_file, fastq_dir)
-
-        open(merged_name, 'a').close()
-
-        return merged_name
-
-    def update_processed(self, fastq_file, fastq_dir, merged_file):
-        """
-        update processed
-        """
-
-        time_elapsed = self.time_since_start()
-
-        self.processed.update(
-            fastq_file=fastq_file,
-            fastq_dir=fastq_dir,
-            time_elapsed=time_elapsed,
-            merged_file=merged_file
-        )
-
-    def read_tsv_template(self, template_tsv) -> pd.DataFrame:
-        """
-        read tsv template
-        """
-
-        try:
-            template_tsv = pd.read_csv(
-                template_tsv, sep='\t')
-
-        except FileNotFoundError:
-            template_tsv = pd.DataFrame(
-                columns=["sample name", "fastq1", "time elapsed"])
-
-        return template_tsv
-
-    def set_destination_filepath(self, fastq_file, fastq_dir):
-        """
-        set destination filepath"""
-
-        if self.run_metadata.keep_name:
-            return os.path.join(
-                self.merged_gz_dir,
-                os.path.basename(fastq_file)
-            )
-
-        else:
-            return self.get_merged_file_name(fastq_file, fastq_dir)
-
-
-class DirectoryProcessingSimple(DirectoryProcessing):
-    """
-    class to process a directory
-    copies all files to a single directory. checks if already processed.
-    creates directory specific output subdirectory in output directory.
-    """
-
-    merged_dir_name = "merged_files"
-    outfiles_dir_name = "out_files"
-
-    def __init__(self, fastq_dir: str, run_metadata: RunConfig, processed: Processed, start_time: float):
-        super().__init__(fastq_dir, run_metadata, processed, start_time)
-
-    def process_file(self, fastq_file: str):
-
-        destination_file = fastq_file
-
-        if self.run_metadata.actions:
-            destination_file = self.set_destination_filepath(
-                fastq_file, self.fastq_dir)
-
-            self.append_to_file(fastq_file, destination_file)
-
-            sample_id = self.processed.get_sample_id_from_merged(
-                destination_file)
-
-            for process_action in self.run_metadata.actions:
-
-                process_action.process(
-                    destination_file, sample_id, self.processed)
-
-        self.update_processed(fastq_file, self.fastq_dir,
-                              destination_file)
-
-        return self
-
-    def local_process(self):
-
-        files_to_process = self.get_files()
-
-        for ix, fastq_file in enumerate(files_to_process):
-            self.process_file(fastq_file)
-
-    def process_folder(self):
-        """
-        process folder, merge and update metadata
-        submit to televir only the last file.
-        """
-        self.prep_output_dirs()
-        self.local_process()
-
-############################ SYSTEM STUFF ##########################
-
-# TESTING
-
-# # print("barcoding on and gz")
-# minion_file_dir="C:\\Users\\andre\\OneDrive - FCT NOVA\\André\\Mestrado - Bioinfo\\2º Ano\\Projeto em Multi-Ómicas - INSA\\teste_1\\testing_automatic\\test_fastq_gz_bar\\fastq_gz_barcoding"
-# output_dir="q"
-# # output_dir="C:\\Users\\andre\\OneDrive - FCT NOVA\\André\\Mestrado - Bioinfo\\2º Ano\\Projeto em Multi-Ómicas - INSA\\teste_1\\testing_files\\testing_merging_and_metadata_files\\barcoded_samples"
-# tsv_temp_name="template_metadata.tsv"
-# tsv_temp_dir="C:\\Users\\andre\\OneDrive - FCT NOVA\\André\\Mestrado - Bioinfo\\2º Ano\\Projeto em Multi-Ómicas - INSA\\teste_1\\testing_files\\testing_merging_and_metadata_files\\barcoded_samples"
-# main(minion_file_dir, output_dir, tsv_temp_name, tsv_temp_dir, sleep_time=5)
-
-
-# # print("barcoding off and gz")
-# minion_file_dir="C:\\Users\\andre\\OneDrive - FCT NOVA\\André\\Mestrado - Bioinfo\\2º Ano\\Projeto em Multi-Ómicas - INSA\\teste_1\\testing_automatic\\test_fastq_gz_n_bar\\fastq_gz_n_barcoding"
-# output_dir="q"
-# # output_dir="C:\\Users\\andre\\OneDrive - FCT NOVA\\André\\Mestrado - Bioinfo\\2º Ano\\Projeto em Multi-Ómicas - INSA\\teste_1\\testing_files\\testing_merging_and_metadata_files\\barcoded_samples"
-# tsv_temp_name="template_metadata.tsv"
-# tsv_temp_dir="C:\\Users\\andre\\OneDrive - FCT NOVA\\André\\Mestrado - Bioinfo\\2º Ano\\Projeto em Multi-Ómicas - INSA\\teste_1\\testing_files\\testing_merging_and_metadata_files\\barcoded_samples"
-# main(minion_file_dir, output_dir, tsv_temp_name, tsv_temp_dir, sleep_time=5)
-
-
-# # print("barcoding on and fastq")
-# minion_file_dir="C:\\Users\\andre\\OneDrive - FCT NOVA\\André\\Mestrado - Bioinfo\\2º Ano\\Projeto em Multi-Ómicas - INSA\\teste_1\\testing_automatic\\test_fastq_bar\\fastq_barcoding"
-# output_dir="q"
-# # output_dir="C:\\Users\\andre\\OneDrive - FCT NOVA\\André\\Mestrado - Bioinfo\\2º Ano\\Projeto em Multi-Ómicas - INSA\\teste_1\\testing_files\\testing_merging_and_metadata_files\\barcoded_samples"
-# tsv_temp_name="template_metadata.tsv"
-# tsv_temp_dir="C:\\Users\\andre\\OneDrive - FCT NOVA\\André\\Mestrado - Bioinfo\\2º Ano\\Projeto em Multi-Ómicas - INSA\\teste_1\\testing_files\\testing_merging_and_metadata_files\\barcoded_samples"
-# main(minion_file_dir, output_dir, tsv_temp_name, tsv_temp_dir, sleep_time=5)
-
-
-# # print("barcoding off and fastq")
-# minion_file_dir="C:\\Users\\andre\\OneDrive - FCT NOVA\\André\\Mestrado - Bioinfo\\1º Ano\\2º Semestre\\Projeto em Multi-Ómicas - INSA\\teste_1\\testing_automatic\\test_fastq_n_bar\\fastq_n_barcoding"
-# output_dir="q"
-# # output_dir="C:\\Users\\andre\\OneDrive - FCT NOVA\\André\\Mestrado - Bioinfo\\2º Ano\\Projeto em Multi-Ómicas - INSA\\teste_1\\testing_files\\testing_merging_and_metadata_files\\barcoded_samples"
-# tsv_temp_name="template_metadata.tsv"
-# tsv_temp_dir="C:\\Users\\andre\\OneDrive - FCT NOVA\\André\\Mestrado - Bioinfo\\1º Ano\\2º Semestre\\Projeto em Multi-Ómicas - INSA\\teste_1\\testing_files\\testing_merging_and_metadata_files\\barcoded_samples"
-# main(minion_file_dir, output_dir, tsv_temp_name, tsv_temp_dir, sleep_time=5)
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Feb 17 14:20:20 2023
+
+@author: andre
+"""
+
+import contextlib
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import fields
+from typing import (BinaryIO, ContextManager, Dict, List, Optional, Set,
+                    Tuple, Type)
+
+import pandas as pd
+
+from fastq_handler.bgzf import BgzfCodec
+from fastq_handler.compression import (AdaptiveCodec, CompressionLevelAdvisor,
+                                       GzipCodec, get_codec, get_default_codec,
+                                       set_default_codec)
+from fastq_handler.fastq_stats import FastqStatsCollector
+from fastq_handler.records import (ProcessActionMergeWithLast, Processed,
+                                   RunConfig)
+from fastq_handler.utilities import (SEQ_FILE_EXTENTIONS, FastqDirectoryIndex,
+                                     Utils)
+from fastq_handler.watchers import DirectoryWatcher, get_directory_watcher
+
+pd.options.mode.chained_assignment = None  # default='warn'
+
+
+"""
+Notes:
+- Now automatically detects if there's barcoding or not and also the format.
+- Now it always creates .fastq.gz merged files.
+
+TO DO:
+- de sleep em sleep fazer uma pasta com 'lattest_compilation_to_upload' todos os últimos concatenados por amostra
+(barcode10, barcode11, etc) + um ficheiro de metadata com todos os dados respetivos dos concatenados totais.
+
+"""
+
+HELP = " _________________________________________________\n | mfmc.py - MERGING FASTQ AND METADATA CREATION | \n _________________________________________________\nExample of usage:\npython mfmc.py --in_dir C:\\users\\samples --out_dir C:\\users\processed_files --tsv_t_name template.tsv --tsv_t_dir C:\\users\\templates \n\nOptions and arguments:\n--in_dir [DIRECTORY OF THE FAST_PASS] : directory of the files being produced by the sequencing machine (typically the 'fast_pass' folder).\n--out_dir [OUTPUT DIRECTORY or 'q' for the default] : desired directory to storage the output files\n--tsv_t_n [TSV TEMPLATE FILE NAME] : name of the tsv template\n--tsv_t_dir [TSV TEMPLATE DIRECTORY] : directory of the tsv template file\n--sleep [TIME SLEEP] : amount of time (in seconds) for the script to hold, between search cycles"
+ARGUMENT_OPTIONS = ["--in_dir", "--out_dir", "--tsv_t_n", "--tsv_t_dir"]
+
+
+####################         5 - Main functions          #####################
+
+
+class OpenFilesSnapshot:
+    """
+    class to hold the (dev, inode) of sequence files open for writing by any process.
+    /proc is scanned once per refresh, lookups are then answered from memory.
+    only processes readable by the current user are seen, as with lsof.
+    """
+
+    proc_dir = "/proc"
+
+    def __init__(self):
+        self.open_for_writing: Set[Tuple[int, int]] = set()
+
+    @staticmethod
+    def fd_open_for_writing(fdinfo_path: str) -> bool:
+        """
+        read access mode from /proc/<pid>/fdinfo/<fd>
+        """
+        with open(fdinfo_path, "r") as fdinfo:
+            for line in fdinfo:
+                if line.startswith("flags:"):
+                    flags = int(line.split()[1], 8)
+                    return flags & os.O_ACCMODE != os.O_RDONLY
+
+        return False
+
+    def refresh(self):
+        """
+        scan /proc/*/fd
+        """
+        open_for_writing = set()
+
+        try:
+            pids = [pid for pid in os.listdir(
+                self.proc_dir) if pid.isdigit()]
+        except FileNotFoundError:
+            pids = []
+
+        for pid in pids:
+            fd_dir = os.path.join(self.proc_dir, pid, "fd")
+
+            try:
+                fds = os.listdir(fd_dir)
+            except OSError:
+                continue
+
+            for fd in fds:
+                fd_path = os.path.join(fd_dir, fd)
+
+                try:
+                    target = os.readlink(fd_path)
+
+                    if not target.endswith(SEQ_FILE_EXTENTIONS):
+                        continue
+
+                    if not self.fd_open_for_writing(
+                            os.path.join(self.proc_dir, pid, "fdinfo", fd)):
+                        continue
+
+                    fd_stat = os.stat(fd_path)
+
+                except OSError:
+                    continue
+
+                open_for_writing.add((fd_stat.st_dev, fd_stat.st_ino))
+
+        self.open_for_writing = open_for_writing
+
+        return self
+
+    def is_open(self, file_path: str) -> bool:
+        """
+        check if file is open for writing
+        """
+        try:
+            file_stat = os.stat(file_path)
+        except FileNotFoundError:
+            return False
+
+        return (file_stat.st_dev, file_stat.st_ino) in self.open_for_writing
+
+
+class CompletenessDetector(ABC):
+    """
+    abstract class to decide if a sequence file is finished and can be processed
+    """
+
+    def refresh(self):
+        """
+        called once per cycle, before any is_complete
+        """
+        return self
+
+    def refresh_directory(self, directory: str):
+        """
+        called once directory is listed, before is_complete on its files
+        """
+        return self
+
+    @abstractmethod
+    def is_complete(self, file_path: str) -> bool:
+        pass
+
+
+class OpenFilesDetector(CompletenessDetector):
+    """
+    file is complete if no process has it open for writing.
+    open files are scanned again after each directory is listed, a file
+    created while earlier directories were merged is in the snapshot.
+    """
+
+    def __init__(self):
+        self.open_files = OpenFilesSnapshot()
+
+    def refresh(self):
+        self.open_files.refresh()
+        return self
+
+    def refresh_directory(self, directory: str):
+        return self.refresh()
+
+    def is_complete(self, file_path: str) -> bool:
+        return not self.open_files.is_open(file_path)
+
+
+class SizeQuiescenceDetector(CompletenessDetector):
+    """
+    file is complete if its size and mtime did not change since the previous cycle.
+    only files looked at during the last cycle are remembered.
+    """
+
+    def __init__(self):
+        self.observed: Dict[str, tuple] = {}
+        self.seen: Set[str] = set()
+
+    def refresh(self):
+        self.observed = {
+            file_path: state for file_path, state in self.observed.items() if file_path in self.seen
+        }
+        self.seen = set()
+        return self
+
+    def file_state(self, file_path: str) -> tuple:
+        file_stat = os.stat(file_path)
+        return (file_stat.st_size, file_stat.st_mtime_ns)
+
+    def is_complete(self, file_path: str) -> bool:
+        try:
+            state = self.file_state(file_path)
+        except FileNotFoundError:
+            return False
+
+        previous = self.observed.get(file_path)
+        self.observed[file_path] = state
+        self.seen.add(file_path)
+
+        return previous == state
+
+
+class GzipTrailerDetector(SizeQuiescenceDetector):
+    """
+    checks the gzip framing of .gz files without decompressing: header,
+    BGZF end-of-file block, trailer ISIZE against file size, and that the
+    trailer bytes did not change since the previous cycle.
+    other files fall back to size quiescence.
+    """
+
+    min_member_size = 20
+    max_deflate_ratio = 1032
+    bgzf_eof = bytes.fromhex(
+        "1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+    def read_tail(self, file_path: str, file_size: int) -> bytes:
+        with open(file_path, "rb") as f_in:
+            f_in.seek(max(0, file_size - len(self.bgzf_eof)))
+            return f_in.read()
+
+    def file_state(self, file_path: str) -> tuple:
+        file_stat = os.stat(file_path)
+        tail = self.read_tail(file_path, file_stat.st_size)
+        return (file_stat.st_size, file_stat.st_mtime_ns, tail)
+
+    def is_complete(self, file_path: str) -> bool:
+
+        if not file_path.endswith(".gz"):
+            return super().is_complete(file_path)
+
+        try:
+            file_size = os.path.getsize(file_path)
+
+            if file_size < self.min_member_size or not Utils.is_gzip_file(file_path):
+                return False
+
+            tail = self.read_tail(file_path, file_size)
+
+        except FileNotFoundError:
+            return False
+
+        if tail == self.bgzf_eof:
+            return True
+
+        isize = int.from_bytes(tail[-4:], "little")
+        if isize > file_size * self.max_deflate_ratio:
+            return False
+
+        return super().is_complete(file_path)
+
+
+def get_completeness_detector(name: str = "open_files") -> CompletenessDetector:
+    """
+    open_files, quiescence or gzip_trailer.
+    open_files needs /proc, other platforms use quiescence.
+    """
+
+    if name == "gzip_trailer":
+        return GzipTrailerDetector()
+
+    if name == "quiescence" or sys.platform != "linux":
+        return SizeQuiescenceDetector()
+
+    return OpenFilesDetector()
+
+
+def get_run_codec(run_metadata: RunConfig) -> GzipCodec:
+    """
+    gzip codec for the run, auto picks the fastest backend here.
+    bgzf output uses its own writer.
+    """
+    if run_metadata.bgzf:
+        return BgzfCodec(run_metadata.compresslevel)
+
+    return get_codec(run_metadata.codec,
+                     compresslevel=run_metadata.compresslevel,
+                     threads=run_metadata.compress_threads)
+
+
+class PreMain:
+
+    start_time: float
+    folder_files: list = []
+
+    fastq_dir: str
+    start_time: float
+    real_sleep: int = 5
+    fastq_depth: int = -1
+
+    processed: Processed
+    processed_class: Type[Processed] = Processed
+    fastq_avail: pd.DataFrame = pd.DataFrame()
+    watcher: Optional[DirectoryWatcher] = None
+    pool: Optional[ProcessPoolExecutor] = None
+    level_advisor: Optional[CompressionLevelAdvisor] = None
+
+    def __init__(
+        self,
+        run_metadata: RunConfig,
+
+    ):
+        self.fastq_dir = run_metadata.fastq_dir
+        self.run_metadata = run_metadata
+        self.start_time = time.time()
+        self.real_sleep = run_metadata.sleep_time
+
+        self.processed = self.processed_class(
+            output_dir=self.run_metadata.logs_dir)
+        self.recover_interrupted()
+
+        self.completeness_detector = get_completeness_detector(
+            run_metadata.completeness)
+        self.directory_index = FastqDirectoryIndex()
+
+        self.codec = get_run_codec(run_metadata)
+
+        if run_metadata.adaptive_level:
+            self.level_advisor = CompressionLevelAdvisor(
+                type(self.codec), default_level=run_metadata.compresslevel,
+                threads=run_metadata.compress_threads).calibrate()
+            self.codec = AdaptiveCodec(
+                type(self.codec), self.level_advisor, threads=run_metadata.compress_threads)
+
+        set_default_codec(self.codec)
+
+        self.log_dir = os.path.join(
+            self.run_metadata.logs_dir,
+        )
+
+    def recover_interrupted(self):
+        """
+        remove partial writes of an interrupted run, forget records
+        whose merged file did not survive it.
+        """
+        if os.path.isdir(self.run_metadata.output_dir):
+            removed = Utils.remove_stale_parts(self.run_metadata.output_dir)
+
+            if removed:
+                print(f"Removed {removed} partial files")
+
+        dropped = self.processed.validate_tail()
+
+        if dropped:
+            print(f"{dropped} records without merged file, reprocessing")
+            self.processed.export(self.run_metadata.logs_dir)
+
+        return self
+
+    def prep_output_dirs(self):
+        """
+        create output directories
+        """
+        os.makedirs(self.run_metadata.output_dir, exist_ok=True)
+        os.makedirs(self.log_dir, exist_ok=True)
+        return self
+
+    def assess_depth_fastqs(self):
+
+        fastq_depth = -1
+
+        if self.directory_index.seqs_in_dir(self.fastq_dir):
+            fastq_depth = 0
+
+        if self.directory_index.seqs_in_subdir(self.fastq_dir):
+            fastq_depth = 1
+
+        self.fastq_depth = fastq_depth
+
+        return self
+
+    def assess_proceed(self):
+        """
+        assess if proceed
+        """
+        if self.fastq_depth == -1:
+            print("No fastq files found in: ", self.fastq_dir)
+
+        return self
+
+    def get_directories_to_process(self):
+        """
+        get directories to process
+        """
+
+        if self.fastq_depth == 0:
+            return [self.fastq_dir]
+
+        else:
+            return self.directory_index.get_subdirectories(self.fastq_dir)
+
+    def get_directory_processing(self, fastq_dir: str):
+        return DirectoryProcessingSimple(fastq_dir, self.run_metadata, self.processed, self.start_time,
+                                         detector=self.completeness_detector,
+                                         directory_index=self.directory_index)
+
+    def worker_run_config(self) -> RunConfig:
+        """
+        plain RunConfig copy of run_metadata, picklable for worker processes
+        """
+        run_config = RunConfig(**{
+            run_field.name: getattr(self.run_metadata, run_field.name) for run_field in fields(RunConfig)
+        })
+        run_config.output_dir = self.run_metadata.output_dir
+        run_config.logs_dir = self.run_metadata.logs_dir
+        run_config.codec = self.codec.name
+
+        if self.level_advisor is not None:
+            run_config.compresslevel = self.level_advisor.choose_level()
+            run_config.adaptive_level = False
+
+        return run_config
+
+    def get_pool(self) -> ProcessPoolExecutor:
+        """
+        worker pool, kept for the whole run. spawned, callers may be threaded.
+        """
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(
+                max_workers=self.run_metadata.workers,
+                mp_context=multiprocessing.get_context("spawn"))
+
+        return self.pool
+
+    def shutdown_workers(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def process_fastq_dict_workers(self):
+        """
+        merge each directory in a worker process, directories are independent.
+        listing, completeness checks and post processing stay in this process,
+        worker records are merged back in directory order.
+        """
+        directories = [
+            self.get_directory_processing(fastq_dir=fastq_dir) for fastq_dir in self.get_directories_to_process()
+        ]
+
+        worker_config = self.worker_run_config()
+        pool = self.get_pool()
+
+        jobs = []
+        for directory_processing in directories:
+            directory_processing.prep_output_dirs()
+            files_to_process = directory_processing.get_files()
+
+            if not files_to_process:
+                jobs.append(None)
+                continue
+
+            jobs.append(pool.submit(
+                merge_directory_files,
+                directory_processing.fastq_dir,
+                files_to_process,
+                worker_config,
+                self.processed.dir_subset(directory_processing.fastq_dir),
+                self.start_time,
+            ))
+
+        for directory_processing, job in zip(directories, jobs):
+            if job is not None:
+                self.processed.extend(job.result())
+
+            directory_processing.post_process()
+
+        return self
+
+    def process_fastq_dict(self):
+        """
+        process fastq dict
+        """
+        self.completeness_detector.refresh()
+
+        if self.run_metadata.workers > 1:
+            return self.process_fastq_dict_workers()
+
+        for fastq_dir in self.get_directories_to_process():
+            directory_processing = self.get_directory_processing(
+                fastq_dir=fastq_dir,
+            )
+
+            directory_processing.process_folder()
+
+        return self
+
+    def run(self):
+        """
+        run single pass
+        """
+        (self.prep_output_dirs()
+         .assess_depth_fastqs()
+         .assess_proceed()
+         .process_fastq_dict())
+
+        self.processed.export(
+            self.run_metadata.logs_dir
+        )
+
+    def wait_for_files(self, timeout: float) -> bool:
+        """
+        wait for new files for at most timeout seconds.
+        returns early on inotify events in watch mode.
+        """
+        if self.watcher is None:
+            self.watcher = get_directory_watcher(
+                self.fastq_dir, watch=self.run_metadata.watch)
+
+        return self.watcher.wait(timeout)
+
+    def run_until_killed(self):
+        """
+        run until killed
+        """
+        try:
+            while True:
+                self.run()
+                print("Sleeping for: ", self.real_sleep, " seconds")
+                self.wait_for_files(self.real_sleep)
+
+        except KeyboardInterrupt:
+
+            print("KeyboardInterrupt")
+            return
+
+        finally:
+            if self.watcher is not None:
+                self.watcher.close()
+
+            self.shutdown_workers()
+
+
+class DirectoryProcessing():
+    """
+    class to process a directory
+    copies all files to a single directory. checks if already processed.
+    creates directory specific output subdirectory in output directory.
+    """
+
+    merged_dir_name = "merged_files"
+    outfiles_dir_name = "out_files"
+
+    def __init__(self, fastq_dir: str, run_metadata: RunConfig, processed: Processed, start_time: float,
+                 detector: Optional[CompletenessDetector] = None,
+                 directory_index: Optional[FastqDirectoryIndex] = None):
+        self.fastq_dir = fastq_dir
+        self.run_metadata = run_metadata
+        self.start_time = start_time
+        self.processed = processed
+        self.detector = detector
+        self.directory_index = directory_index
+
+        self.merged_gz_dir = os.path.join(
+            self.run_metadata.output_dir,
+            os.path.basename(self.fastq_dir.strip("/")),)
+
+    def time_since_start(self):
+        """
+        returns the time since the start of the program
+        """
+        return time.time() - self.start_time
+
+    def prep_output_dirs(self):
+        """create output dirs"""
+
+        for dir in [
+            self.merged_gz_dir,
+        ]:
+            os.makedirs(dir, exist_ok=True)
+
+    def match_to_processed(self, fastq_file, fastq_dir):
+        """
+        match to process dict
+        """
+
+        return self.processed.file_exists(
+            fastq_file=fastq_file,
+            fastq_dir=fastq_dir
+        )
+
+    @staticmethod
+    def check_file_open_linux(file_path):
+        """
+        check if file is open
+        """
+        command = f"lsof -t {file_path} | wc -l"
+        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE)
+        output, error = process.communicate()
+
+        output = output.decode("utf-8").strip()
+
+        return int(output) > 1
+
+    def check_file_open_windows(self, file_path):
+        """
+        check if file is open
+        """
+        return True
+
+    def check_file_open(self, file_path):
+        """
+        check if file is open
+        """
+
+        platform = sys.platform
+
+        if self.detector is not None:
+            return not self.detector.is_complete(file_path)
+
+        if platform == "linux":
+            return self.check_file_open_linux(file_path)
+
+        elif platform == "win32":
+            return self.check_file_open_windows(file_path)
+
+        return True
+
+    def check_file_for_process(self, fastq_file, fastq_dir):
+        """
+        check if file is open
+        """
+
+        file_path = os.path.join(
+            fastq_dir,
+            fastq_file)
+
+        if self.match_to_processed(fastq_file, fastq_dir):
+            return False
+
+        if not os.path.isfile(file_path):
+            return False
+
+        return False if self.check_file_open(file_path) else True
+
+    def get_files(self):
+        """
+        get folders and files
+        """
+
+        if self.directory_index is not None:
+            folder_files = self.directory_index.get_seq_files(self.fastq_dir)
+        else:
+            folder_files = Utils().search_folder_for_seq_files(self.fastq_dir)
+
+        if self.detector is not None:
+            self.detector.refresh_directory(self.fastq_dir)
+
+        folder_files = [
+            x for x in folder_files if self.check_file_for_process(x, self.fastq_dir)]
+
+        if folder_files == []:
+            print("No new files in ", self.fastq_dir)
+
+        folder_files = [os.path.join(self.fastq_dir, x) for x in folder_files]
+
+        return folder_files
+
+    def get_stats_collector(self) -> Optional[FastqStatsCollector]:
+        """
+        read statistics collector if enabled
+        """
+        if self.run_metadata.stats:
+            return FastqStatsCollector()
+
+        return None
+
+    @staticmethod
+    def get_stats(collector: Optional[FastqStatsCollector]) -> Optional[dict]:
+        if collector is None:
+            return None
+
+        if collector.skipped:
+            print("Skipping read stats, ", collector.skip_reason)
+            return None
+
+        return collector.finish().summary()
+
+    def append_to_file(self, fastq_file, destination_file, collector: Optional[FastqStatsCollector] = None,
+                       tee: Optional[BinaryIO] = None):
+        """
+        write to a part file, moved over destination once complete
+        """
+        utils = Utils()
+
+        utils.discard_part(destination_file)
+        utils.append_file_to_gz(
+            fastq_file, utils.get_part_path(destination_file), collector=collector, tee=tee
+        )
+        utils.commit_part(destination_file)
+
+    def upload_stream(self, destination_file: str, n_files: int = 1) -> ContextManager[Optional[BinaryIO]]:
+        """
+        stream receiving the merged output of n_files new files as it is
+        written, e.g. to upload it at the same time. the actions run inside
+        the block, the merged file is complete when it exits. None, no stream.
+        """
+        return contextlib.nullcontext()
+
+    def get_merged_file_name(self, fastq_file, fastq_dir, first_fastq_file: Optional[str] = None, offset: int = 0):
+        """
+        merged file name, first-last run. first_fastq_file and offset
+        place fastq_file at the end of a batch not yet recorded.
+        """
+
+        _, run_num = self.processed.get_run_barcode(
+            fastq_file, fastq_dir, offset=offset)
+
+        merged_name_prefix = os.path.basename(os.path.dirname(fastq_file))
+
+        first_run_barcode = self.processed.get_dir_barcode_first(fastq_dir)
+        if first_run_barcode == "":
+            first_run_barcode = run_num
+
+            if first_fastq_file is not None:
+                _, first_run_barcode = self.processed.get_run_barcode(
+                    first_fastq_file, fastq_dir)
+
+        if self.run_metadata.name_tag:
+            merged_name_prefix = f"{merged_name_prefix}_{self.run_metadata.name_tag}"
+
+        merged_name = f"{merged_name_prefix}_{first_run_barcode}-{run_num}.fastq.gz"
+
+        merged_name = os.path.join(self.merged_gz_dir, merged_name)
+
+        return merged_name
+
+    def prep_merged_file(self, fastq_file, fastq_dir):
+        """
+        get merged name
+        """
+        utils = Utils()
+
+        merged_name = self.get_merged_file_name(fastq_file, fastq_dir)
+
+        open(merged_name, 'a').close()
+
+        return merged_name
+
+    def update_processed(self, fastq_file, fastq_dir, merged_file, folded: bool = False,
+                         details: Optional[dict] = None):
+        """
+        update processed
+        """
+
+        time_elapsed = self.time_since_start()
+
+        self.processed.update(
+            fastq_file=fastq_file,
+            fastq_dir=fastq_dir,
+            time_elapsed=time_elapsed,
+            merged_file=merged_file,
+            folded=folded,
+            details=details,
+        )
+
+    def read_tsv_template(self, template_tsv) -> pd.DataFrame:
+        """
+        read tsv template
+        """
+
+        try:
+            template_tsv = pd.read_csv(
+                template_tsv, sep='\t')
+
+        except FileNotFoundError:
+            template_tsv = pd.DataFrame(
+                columns=["sample name", "fastq1", "time elapsed"])
+
+        return template_tsv
+
+    def set_destination_filepath(self, fastq_file, fastq_dir):
+        """
+        set destination filepath"""
+
+        if self.run_metadata.keep_name:
+            return os.path.join(
+                self.merged_gz_dir,
+                os.path.basename(fastq_file)
+            )
+
+        else:
+            return self.get_merged_file_name(fastq_file, fastq_dir)
+
+
+class DirectoryProcessingSimple(DirectoryProcessing):
+    """
+    class to process a directory
+    copies all files to a single directory. checks if already processed.
+    creates directory specific output subdirectory in output directory.
+    """
+
+    merged_dir_name = "merged_files"
+    outfiles_dir_name = "out_files"
+
+    def __init__(self, fastq_dir: str, run_metadata: RunConfig, processed: Processed, start_time: float,
+                 detector: Optional[CompletenessDetector] = None,
+                 directory_index: Optional[FastqDirectoryIndex] = None):
+        super().__init__(fastq_dir, run_metadata, processed, start_time,
+                         detector=detector, directory_index=directory_index)
+
+    def is_passthrough(self, fastq_file: str, collector: Optional[FastqStatsCollector] = None,
+                       tee: Optional[BinaryIO] = None) -> bool:
+        """
+        keep names output of a gzip chunk is the chunk itself, byte for byte,
+        if nothing needs to see the data on the way.
+        """
+        return self.run_metadata.keep_name and collector is None and tee is None \
+            and Utils.is_raw_appendable(fastq_file, get_default_codec())
+
+    def process_file(self, fastq_file: str):
+
+        destination_file = fastq_file
+        collector = None
+        details = None
+
+        if self.run_metadata.actions:
+            destination_file = self.set_destination_filepath(
+                fastq_file, self.fastq_dir)
+
+            collector = self.get_stats_collector()
+
+            sample_id = self.processed.get_sample_id_from_merged(
+                destination_file)
+
+            with self.upload_stream(destination_file) as tee:
+                if self.is_passthrough(fastq_file, collector, tee):
+                    details = {"copy_method": Utils.link_file(
+                        fastq_file, destination_file)}
+                else:
+                    self.append_to_file(
+                        fastq_file, destination_file, collector, tee=tee)
+
+                for process_action in self.run_metadata.actions:
+
+                    process_action.process(
+                        destination_file, sample_id, self.processed, self.run_metadata)
+
+        if collector is not None:
+            details = self.get_stats(collector)
+
+        self.update_processed(fastq_file, self.fastq_dir,
+                              destination_file, details=details)
+
+        return self
+
+    def is_backlog(self, files_to_process: List[str]) -> bool:
+        """
+        more new files than the coalesce threshold
+        """
+        return self.run_metadata.coalesce_threshold > 0 and \
+            len(files_to_process) > self.run_metadata.coalesce_threshold
+
+    def is_batch(self, files_to_process: List[str]) -> bool:
+        """
+        merge files_to_process in one pass. only with merge, the cumulative
+        snapshot of the last file then holds the others, keep names writes
+        one file per chunk.
+        """
+        return (self.run_metadata.batch or self.is_backlog(files_to_process)) \
+            and ProcessActionMergeWithLast in (self.run_metadata.actions or []) \
+            and not self.run_metadata.keep_name and len(files_to_process) > 1
+
+    def process_batch(self, files_to_process: List[str]):
+        """
+        append all new files to one merged file, run actions once.
+        one processed record per file, all but the last folded into the snapshot.
+        """
+        destination_file = self.get_merged_file_name(
+            files_to_process[-1], self.fastq_dir,
+            first_fastq_file=files_to_process[0], offset=len(files_to_process) - 1)
+
+        collectors = [self.get_stats_collector() for _ in files_to_process]
+
+        Utils.discard_part(destination_file)
+
+        sample_id = self.processed.get_sample_id_from_merged(
+            destination_file)
+
+        with self.upload_stream(destination_file, n_files=len(files_to_process)) as tee:
+            Utils.append_files_to_gz(
+                files_to_process, Utils.get_part_path(destination_file), collectors=collectors, tee=tee)
+
+            Utils.commit_part(destination_file)
+
+            for process_action in self.run_metadata.actions:
+
+                process_action.process(
+                    destination_file, sample_id, self.processed, self.run_metadata)
+
+        for ix, fastq_file in enumerate(files_to_process):
+            self.update_processed(fastq_file, self.fastq_dir,
+                                  destination_file,
+                                  folded=ix < len(files_to_process) - 1,
+                                  details=self.get_stats(collectors[ix]))
+
+        return self
+
+    def process_files(self, files_to_process: List[str]):
+
+        if self.is_batch(files_to_process):
+            self.process_batch(files_to_process)
+            return
+
+        for ix, fastq_file in enumerate(files_to_process):
+            self.process_file(fastq_file)
+
+    def local_process(self):
+
+        files_to_process = self.get_files()
+
+        self.process_files(files_to_process)
+
+    def post_process(self):
+        """
+        after new files are merged and recorded
+        """
+        pass
+
+    def process_folder(self):
+        """
+        process folder, merge and update metadata
+        submit to televir only the last file.
+        """
+        self.prep_output_dirs()
+        self.local_process()
+        self.post_process()
+
+
+def merge_directory_files(fastq_dir: str, files_to_process: List[str], run_metadata: RunConfig,
+                          processed: Processed, start_time: float) -> List[dict]:
+    """
+    worker process entry point: merge files of one directory,
+    return the new processed records.
+    """
+    n_records = len(processed)
+
+    set_default_codec(get_run_codec(run_metadata))
+
+    directory_processing = DirectoryProcessingSimple(
+        fastq_dir, run_metadata, processed, start_time)
+    directory_processing.process_files(files_to_process)
+
+    return processed.records_since(n_records)
+
+############################ SYSTEM STUFF ##########################
+
+# TESTING
+
+# # print("barcoding on and gz")
+# minion_file_dir="C:\\Users\\andre\\OneDrive - FCT NOVA\\André\\Mestrado - Bioinfo\\2º Ano\\Projeto em Multi-Ómicas - INSA\\teste_1\\testing_automatic\\test_fastq_gz_bar\\fastq_gz_barcoding"
+# output_dir="q"
+# # output_dir="C:\\Users\\andre\\OneDrive - FCT NOVA\\André\\Mestrado - Bioinfo\\2º Ano\\Projeto em Multi-Ómicas - INSA\\teste_1\\testing_files\\testing_merging_and_metadata_files\\barcoded_samples"
+# tsv_temp_name="template_metadata.tsv"
+# tsv_temp_dir="C:\\Users\\andre\\OneDrive - FCT NOVA\\André\\Mestrado - Bioinfo\\2º Ano\\Projeto em Multi-Ómicas - INSA\\teste_1\\testing_files\\testing_merging_and_metadata_files\\barcoded_samples"
+# main(minion_file_dir, output_dir, tsv_temp_name, tsv_temp_dir, sleep_time=5)
+
+
+# # print("barcoding off and gz")
+# minion_file_dir="C:\\Users\\andre\\OneDrive - FCT NOVA\\André\\Mestrado - Bioinfo\\2º Ano\\Projeto em Multi-Ómicas - INSA\\teste_1\\testing_automatic\\test_fastq_gz_n_bar\\fastq_gz_n_barcoding"
+# output_dir="q"
+# # output_dir="C:\\Users\\andre\\OneDrive - FCT NOVA\\André\\Mestrado - Bioinfo\\2º Ano\\Projeto em Multi-Ómicas - INSA\\teste_1\\testing_files\\testing_merging_and_metadata_files\\barcoded_samples"
+# tsv_temp_name="template_metadata.tsv"
+# tsv_temp_dir="C:\\Users\\andre\\OneDrive - FCT NOVA\\André\\Mestrado - Bioinfo\\2º Ano\\Projeto em Multi-Ómicas - INSA\\teste_1\\testing_files\\testing_merging_and_metadata_files\\barcoded_samples"
+# main(minion_file_dir, output_dir, tsv_temp_name, tsv_temp_dir, sleep_time=5)
+
+
+# # print("barcoding on and fastq")
+# minion_file_dir="C:\\Users\\andre\\OneDrive - FCT NOVA\\André\\Mestrado - Bioinfo\\2º Ano\\Projeto em Multi-Ómicas - INSA\\teste_1\\testing_automatic\\test_fastq_bar\\fastq_barcoding"
+# output_dir="q"
+# # output_dir="C:\\Users\\andre\\OneDrive - FCT NOVA\\André\\Mestrado - Bioinfo\\2º Ano\\Projeto em Multi-Ómicas - INSA\\teste_1\\testing_files\\testing_merging_and_metadata_files\\barcoded_samples"
+# tsv_temp_name="template_metadata.tsv"
+# tsv_temp_dir="C:\\Users\\andre\\OneDrive - FCT NOVA\\André\\Mestrado - Bioinfo\\2º Ano\\Projeto em Multi-Ómicas - INSA\\teste_1\\testing_files\\testing_merging_and_metadata_files\\barcoded_samples"
+# main(minion_file_dir, output_dir, tsv_temp_name, tsv_temp_dir, sleep_time=5)
+
+
+# # print("barcoding off and fastq")
+# minion_file_dir="C:\\Users\\andre\\OneDrive - FCT NOVA\\André\\Mestrado - Bioinfo\\1º Ano\\2º Semestre\\Projeto em Multi-Ómicas - INSA\\teste_1\\testing_automatic\\test_fastq_n_bar\\fastq_n_barcoding"
+# output_dir="q"
+# # output_dir="C:\\Users\\andre\\OneDrive - FCT NOVA\\André\\Mestrado - Bioinfo\\2º Ano\\Projeto em Multi-Ómicas - INSA\\teste_1\\testing_files\\testing_merging_and_metadata_files\\barcoded_samples"
+# tsv_temp_name="template_metadata.tsv"
+# tsv_temp_dir="C:\\Users\\andre\\OneDrive - FCT NOVA\\André\\Mestrado - Bioinfo\\1º Ano\\2º Semestre\\Projeto em Multi-Ómicas - INSA\\teste_1\\testing_files\\testing_merging_and_metadata_files\\barcoded_samples"
+# main(minion_file_dir, output_dir, tsv_temp_name, tsv_temp_dir, sleep_time=5)
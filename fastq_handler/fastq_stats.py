@@ -0,0 +1,171 @@
+import zlib
+from typing import Dict, Optional
+
+import numpy as np
+
+
+class FastqStatsCollector:
+    """
+    read count, bases, length histogram, N50 and mean phred of a fastq stream.
+    data is fed in buffers as it is copied, complete 4-line records are parsed
+    with numpy, a partial record is kept for the next buffer.
+    """
+
+    newline = ord("\n")
+    carriage_return = ord("\r")
+    phred_offset = 33
+    gzip_wbits = 31
+
+    def __init__(self):
+        self.reads = 0
+        self.bases = 0
+        self.qual_sum = 0
+        self.length_counts = np.zeros(0, dtype=np.int64)
+        self.leftover = b""
+        self.decompressor: Optional["zlib._Decompress"] = None
+        self.skipped = False
+        self.skip_reason = ""
+
+    def feed(self, data: bytes):
+        """
+        add uncompressed fastq data
+        """
+        if self.skipped:
+            return self
+
+        if self.leftover:
+            data = self.leftover + data
+
+        buffer = np.frombuffer(data, dtype=np.uint8)
+        line_ends = np.flatnonzero(buffer == self.newline)
+
+        n_records = len(line_ends) // 4
+        if n_records == 0:
+            self.leftover = data
+            return self
+
+        used = line_ends[4 * n_records - 1] + 1
+        self.leftover = data[used:]
+
+        record_ends = line_ends[:4 * n_records].reshape(n_records, 4)
+
+        seq_starts = record_ends[:, 0] + 1
+        seq_ends = self.strip_carriage_return(buffer, record_ends[:, 1])
+        qual_starts = record_ends[:, 2] + 1
+        qual_ends = self.strip_carriage_return(buffer, record_ends[:, 3])
+
+        lengths = seq_ends - seq_starts
+
+        qual_cumsum = np.concatenate(
+            ([0], np.cumsum(buffer[:used], dtype=np.int64)))
+        qual_sums = qual_cumsum[qual_ends] - qual_cumsum[qual_starts] - \
+            self.phred_offset * (qual_ends - qual_starts)
+
+        self.reads += n_records
+        self.bases += int(lengths.sum())
+        self.qual_sum += int(qual_sums.sum())
+        self.add_lengths(lengths)
+
+        return self
+
+    def strip_carriage_return(self, buffer: np.ndarray, line_ends: np.ndarray) -> np.ndarray:
+        """
+        line end positions excluding a windows carriage return.
+        a line end at the start of buffer has no carriage return before it.
+        """
+        previous = buffer[np.maximum(line_ends - 1, 0)]
+
+        return line_ends - ((line_ends > 0) & (previous == self.carriage_return))
+
+    def add_lengths(self, lengths: np.ndarray):
+        counts = np.bincount(lengths)
+
+        if len(counts) > len(self.length_counts):
+            counts[:len(self.length_counts)] += self.length_counts
+            self.length_counts = counts
+        else:
+            self.length_counts[:len(counts)] += counts
+
+    def feed_compressed(self, data: bytes):
+        """
+        add gzip data, members may span buffers.
+        data that does not decompress, e.g. trailing garbage, stops
+        collecting for this stream, the copy itself goes on.
+        """
+        while data and not self.skipped:
+            if self.decompressor is None:
+                self.decompressor = zlib.decompressobj(self.gzip_wbits)
+
+            try:
+                self.feed(self.decompressor.decompress(data))
+            except zlib.error as error:
+                self.skip_reason = f"gzip data not readable: {error}"
+                self.skipped = True
+                break
+
+            if not self.decompressor.eof:
+                break
+
+            data = self.decompressor.unused_data
+            self.decompressor = None
+
+        return self
+
+    def finish(self):
+        """
+        count a last record with no newline after its quality line.
+        a record cut short stays uncounted.
+        """
+        if self.leftover and not self.skipped:
+            self.feed(b"\n")
+            self.leftover = b""
+
+        return self
+
+    @property
+    def n50(self) -> int:
+        """
+        read length at which half of the bases are in reads as long or longer
+        """
+        if self.bases == 0:
+            return 0
+
+        bases_by_length = np.arange(
+            len(self.length_counts), dtype=np.int64) * self.length_counts
+        bases_from_longest = np.cumsum(bases_by_length[::-1])
+        position = np.searchsorted(bases_from_longest, self.bases / 2)
+
+        return int(len(self.length_counts) - 1 - position)
+
+    @property
+    def mean_qual(self) -> float:
+        if self.bases == 0:
+            return 0.0
+
+        return self.qual_sum / self.bases
+
+    def length_histogram(self) -> str:
+        """
+        read counts in power of two length bins: [0,1], [2,3], [4,7], ...
+        comma separated.
+        """
+        if self.reads == 0:
+            return ""
+
+        lengths = np.arange(len(self.length_counts))
+        bins = np.floor(np.log2(np.maximum(lengths, 1))).astype(np.int64)
+        histogram = np.bincount(bins, weights=self.length_counts)
+
+        return ",".join(str(int(count)) for count in histogram)
+
+    def summary(self) -> Dict[str, object]:
+        """
+        stats as processed columns, call finish first at the end of the stream
+        """
+        return {
+            "reads": self.reads,
+            "bases": self.bases,
+            "n50": self.n50,
+            "mean_qual": round(self.mean_qual, 2),
+            "length_hist": self.length_histogram(),
+        }
@@ -1,52 +1,239 @@
 
 
+import csv
+import io
 import os
 from abc import ABC, ABCMeta, abstractmethod
-from dataclasses import dataclass
-from typing import List, Optional, Type
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple, Type
 
 import pandas as pd
 
-from fastq_handler.utilities import Utils
+from fastq_handler.bgzf import BlockIndex
+from fastq_handler.utilities import ConstantsSettings, Utils
+
+
+@dataclass
+class RecordSpan:
+    """
+    class to track the first and last records of a group, ordered by time
+    """
+    count: int = 0
+    first: int = -1
+    first_time: float = 0
+    last: int = -1
+    last_time: float = 0
+    records: List[int] = field(default_factory=list)
+
+    def add(self, record_ix: int, time_elapsed: float):
+        """
+        add record, ties keep the earliest record first and the latest record last
+        """
+        if self.count == 0 or time_elapsed < self.first_time:
+            self.first = record_ix
+            self.first_time = time_elapsed
+
+        if self.count == 0 or time_elapsed >= self.last_time:
+            self.last = record_ix
+            self.last_time = time_elapsed
+
+        self.records.append(record_ix)
+        self.count += 1
 
 
 class Processed:
     """
-    class to keep track of processed files
+    class to keep track of processed files.
+    records are indexed by (dir, fastq), dir and sample_id,
+    the dataframe is only built when requested.
+    new records are appended to a journal file on export,
+    the journal is folded into the output file every journal_compact_rows.
     """
     output_file = "processed.tsv"
+    journal_suffix = ".journal"
+    journal_compact_rows = 1000
+
+    columns = [
+        "sample_id",
+        "fastq",
+        "dir",
+        "barcode",
+        "time",
+        "merged",
+        "folded",
+        "reads",
+        "bases",
+        "n50",
+        "mean_qual",
+        "length_hist",
+        "copy_method",
+    ]
 
     processed_template = pd.DataFrame(
-        columns=[
-            "sample_id",
-            "fastq",
-            "dir",
-            "barcode",
-            "time",
-            "merged",
-        ]
+        columns=columns
     )
 
     def __init__(self, output_dir: str):
         self.output_dir = output_dir
-        self.processed = self.read_processed()
+        self._journal_rows = 0
+        processed = self.read_processed()
+        self.processed = processed
+        self.mark_persisted()
+        self._rewrite = not os.path.exists(self.processed_file) or \
+            list(processed.columns) != self.columns
 
-    def read_processed(self):
+    @property
+    def processed(self) -> pd.DataFrame:
+        """
+        processed records as a dataframe, built lazily
+        """
+        if self._processed is None:
+            self._processed = pd.DataFrame(
+                self._records, columns=self.columns)
+
+        return self._processed
+
+    @processed.setter
+    def processed(self, processed: pd.DataFrame):
+        """
+        replace records, rebuild indexes
+        """
+        self.reset_index()
+
+        processed = processed.reindex(columns=self.columns)
+
+        for record in processed.to_dict("records"):
+            self.add_record(record)
+
+    def reset_index(self):
         """
-        read processed tsv
+        clear records and indexes
         """
+        self._records: List[dict] = []
+        self._file_index: Dict[Tuple[str, str], int] = {}
+        self._dir_index: Dict[str, RecordSpan] = {}
+        self._sample_index: Dict[str, RecordSpan] = {}
+        self._processed: Optional[pd.DataFrame] = None
+        self._persisted = 0
+        self._rewrite = True
 
-        processed_file = os.path.join(
+    def add_record(self, record: dict):
+        """
+        add record, update indexes
+        """
+        record_ix = len(self._records)
+        self._records.append(record)
+        self._processed = None
+
+        self._file_index.setdefault(
+            (record["dir"], record["fastq"]), record_ix)
+
+        self._dir_index.setdefault(record["dir"], RecordSpan()).add(
+            record_ix, record["time"])
+
+        self._sample_index.setdefault(record["sample_id"], RecordSpan()).add(
+            record_ix, record["time"])
+
+    def __len__(self):
+        return len(self._records)
+
+    def records_since(self, n_records: int) -> List[dict]:
+        """
+        records added after the first n_records
+        """
+        return self._records[n_records:]
+
+    def extend(self, records: List[dict]):
+        """
+        add records, e.g. returned by a worker process
+        """
+        for record in records:
+            self.add_record(dict(record))
+
+    def dir_subset(self, fastq_dir: str) -> "Processed":
+        """
+        in-memory Processed holding only the records of fastq_dir.
+        not exported, used to hand a directory to a worker process.
+        """
+        subset = Processed.__new__(Processed)
+        subset.output_dir = self.output_dir
+        subset._journal_rows = 0
+        subset.reset_index()
+
+        dir_span = self._dir_index.get(fastq_dir, RecordSpan())
+        subset.extend([self._records[record_ix]
+                      for record_ix in dir_span.records])
+
+        return subset
+
+    @property
+    def processed_file(self) -> str:
+        return os.path.join(
             self.output_dir,
             self.output_file
         )
 
+    @property
+    def journal_file(self) -> str:
+        return self.processed_file + self.journal_suffix
+
+    @property
+    def dirty(self) -> bool:
+        """
+        records changed since last export
+        """
+        return self._rewrite or len(self._records) > self._persisted
+
+    def mark_persisted(self):
+        """
+        records match processed and journal files
+        """
+        self._persisted = len(self._records)
+        self._rewrite = False
+
+    def read_journal(self) -> pd.DataFrame:
+        """
+        read journal, ignore a partially written last line
+        """
+
+        try:
+            with open(self.journal_file, "r") as journal:
+                journal_text = journal.read()
+        except FileNotFoundError:
+            return self.processed_template.copy()
+
+        journal_text = journal_text[:journal_text.rfind("\n") + 1]
+
+        if not journal_text:
+            return self.processed_template.copy()
+
+        return pd.read_csv(io.StringIO(journal_text), sep='\t')
+
+    def read_processed(self):
+        """
+        read processed tsv, replay journal.
+        journal rows already in the processed file are skipped, e.g. after a
+        crash between compaction and removing the journal.
+        """
+
         try:
             processed = pd.read_csv(
-                processed_file, sep='\t')
+                self.processed_file, sep='\t')
         except FileNotFoundError:
             processed = self.processed_template.copy()
 
+        journal = self.read_journal()
+        self._journal_rows = len(journal)
+
+        if len(journal) and len(processed):
+            compacted = set(zip(processed["dir"], processed["fastq"]))
+            journal = journal[[
+                (fastq_dir, fastq) not in compacted for fastq_dir, fastq in zip(journal["dir"], journal["fastq"])
+            ]]
+
+        if len(journal):
+            processed = pd.concat([processed, journal], ignore_index=True)
+
         processed["barcode"] = processed.barcode.apply(
             lambda x: str(x).zfill(2) if not pd.isna(x) else x
         )
@@ -58,15 +245,7 @@ class Processed:
         match to process dict
         """
 
-        processed = self.processed.loc[
-            (self.processed["dir"] == fastq_dir) & (
-                self.processed["fastq"] == fastq_file)
-        ]
-
-        if len(processed) > 0:
-            return True
-        else:
-            return False
+        return (fastq_dir, fastq_file) in self._file_index
 
     @staticmethod
     def get_run_num_from_filename(filename: str):
@@ -99,15 +278,14 @@ class Processed:
 
         return run_name, run_num
 
-    def generate_barcode(self, fastq_dir: str) -> str:
+    def generate_barcode(self, fastq_dir: str, offset: int = 0) -> str:
         """
-        generate barcode
+        generate barcode. offset counts files not yet recorded.
         """
 
-        dir_processed = self.processed.loc[self.processed["dir"] == fastq_dir].sort_values(
-            by="time", ascending=True)
+        dir_span = self._dir_index.get(fastq_dir, RecordSpan())
 
-        barcode = str(len(dir_processed))
+        barcode = str(dir_span.count + offset)
         barcode = barcode.zfill(2)
 
         return barcode
@@ -117,10 +295,9 @@ class Processed:
         get first run
         """
 
-        dir_processed = self.processed.loc[self.processed["dir"] == fastq_dir].sort_values(
-            by="time", ascending=True)
-        if len(dir_processed) > 0:
-            return dir_processed["barcode"].iloc[0]
+        dir_span = self._dir_index.get(fastq_dir)
+        if dir_span is not None:
+            return self._records[dir_span.first]["barcode"]
         else:
             return ""
 
@@ -129,10 +306,9 @@ class Processed:
         get last run
         """
 
-        dir_processed = self.processed.loc[self.processed["dir"] == fastq_dir].sort_values(
-            by="time", ascending=False)
-        if len(dir_processed) > 0:
-            return dir_processed["merged"].iloc[0]
+        dir_span = self._dir_index.get(fastq_dir)
+        if dir_span is not None:
+            return self._records[dir_span.last]["merged"]
         else:
             return ""
 
@@ -141,11 +317,10 @@ class Processed:
         get last run
         """
 
-        dir_processed = self.processed.loc[self.processed["sample_id"] == sample_id].sort_values(
-            by="time", ascending=False)
+        sample_span = self._sample_index.get(sample_id)
 
-        if len(dir_processed) > 0:
-            return dir_processed["merged"].iloc[0]
+        if sample_span is not None:
+            return self._records[sample_span.last]["merged"]
         else:
             return ""
 
@@ -154,24 +329,22 @@ class Processed:
         get time
         """
 
-        time_elapsed = self.processed.loc[
-            (self.processed["dir"] == fastq_dir) & (
-                self.processed["fastq"] == os.path.basename(fastq_file))
-        ]["time"]
+        record_ix = self._file_index.get(
+            (fastq_dir, os.path.basename(fastq_file)))
 
-        if len(time_elapsed) > 0:
-            return time_elapsed.iloc[0]
+        if record_ix is not None:
+            return self._records[record_ix]["time"]
 
         return 0
 
-    def get_run_barcode(self, fastq_file, fastq_dir):
+    def get_run_barcode(self, fastq_file, fastq_dir, offset: int = 0):
         """
         get run info
         """
 
         run_name, barcode = self.get_run_info(fastq_file)
         if barcode == "":
-            barcode = self.generate_barcode(fastq_dir)
+            barcode = self.generate_barcode(fastq_dir, offset=offset)
 
         return run_name, barcode
 
@@ -195,23 +368,150 @@ class Processed:
 
         return "_".join(sample_id[:-1])
 
-    def update(self, fastq_file, fastq_dir, time_elapsed, merged_file):
+    @staticmethod
+    def is_valid_merged(merged_file) -> bool:
+        """
+        merged file exists, gzip output starts with a gzip member and
+        ends with a complete one
+        """
+        if not isinstance(merged_file, str) or not os.path.isfile(merged_file):
+            return False
+
+        if merged_file.endswith(".gz"):
+            return Utils.is_gzip_file(merged_file) and Utils.is_gzip_complete(merged_file)
+
+        return True
+
+    def validate_tail(self) -> int:
         """
-        update processed
+        drop the latest records of each sample whose merged file is missing or
+        invalid, e.g. after a crash before the output was written. those files
+        are processed again. return the number of records dropped.
+        """
+        dropped = set()
+
+        for sample_span in self._sample_index.values():
+            for record_ix in sorted(sample_span.records,
+                                    key=lambda ix: self._records[ix]["time"], reverse=True):
+                if self.is_valid_merged(self._records[record_ix]["merged"]):
+                    break
+
+                dropped.add(record_ix)
+
+        if not dropped:
+            return 0
+
+        records = [record for record_ix, record in enumerate(self._records)
+                   if record_ix not in dropped]
+
+        self.reset_index()
+        self.extend(records)
+
+        return len(dropped)
+
+    @staticmethod
+    def is_folded(folded) -> bool:
+        """
+        record merged into a later snapshot, missing in older processed files
+        """
+        return not pd.isna(folded) and bool(folded)
+
+    def update(self, fastq_file, fastq_dir, time_elapsed, merged_file, folded: bool = False,
+               details: Optional[dict] = None):
+        """
+        update processed. details fills optional columns, e.g. read stats
         """
 
         _, barcode = self.get_run_barcode(fastq_file, fastq_dir)
         sample_id = self.get_sample_id_from_merged(merged_file)
 
-        self.processed.loc[len(self.processed)] = [
-            sample_id, os.path.basename(fastq_file), fastq_dir, barcode, time_elapsed, merged_file]
+        record = {
+            "sample_id": sample_id,
+            "fastq": os.path.basename(fastq_file),
+            "dir": fastq_dir,
+            "barcode": barcode,
+            "time": time_elapsed,
+            "merged": merged_file,
+            "folded": folded,
+        }
+
+        if details is not None:
+            record.update(details)
+
+        self.add_record(record)
+
+    @staticmethod
+    def format_value(value):
+        """
+        format value as written by DataFrame.to_csv
+        """
+        if value is None or (isinstance(value, float) and pd.isna(value)):
+            return ""
+
+        return value
+
+    def append_journal(self):
+        """
+        append records not yet persisted to journal, fsync
+        """
+        write_header = not os.path.exists(self.journal_file) or \
+            os.path.getsize(self.journal_file) == 0
+
+        with open(self.journal_file, "a", newline="") as journal:
+            writer = csv.writer(journal, delimiter="\t",
+                                lineterminator="\n")
+            if write_header:
+                writer.writerow(self.columns)
+
+            for record in self._records[self._persisted:]:
+                writer.writerow([self.format_value(record.get(column))
+                                for column in self.columns])
+
+            journal.flush()
+            os.fsync(journal.fileno())
+
+        self._journal_rows += len(self._records) - self._persisted
+        self.mark_persisted()
+
+    def compact(self):
+        """
+        rewrite processed file with all records, remove journal
+        """
+        tmp_file = self.processed_file + ".tmp"
+
+        with open(tmp_file, "w", newline="") as output:
+            self.processed.to_csv(output, sep="\t", index=False)
+            output.flush()
+            os.fsync(output.fileno())
+
+        os.replace(tmp_file, self.processed_file)
+
+        if os.path.exists(self.journal_file):
+            os.remove(self.journal_file)
+
+        self._journal_rows = 0
+        self.mark_persisted()
 
     def export(self, output_dir: str, output_file: str = "processed.tsv"):
         """
-        export processed
+        export processed. own output file is journaled, skipped if nothing changed.
         """
-        self.processed.to_csv(os.path.join(
-            output_dir, output_file), sep="\t", index=False)
+        if os.path.abspath(os.path.join(output_dir, output_file)) != \
+                os.path.abspath(self.processed_file):
+            self.processed.to_csv(os.path.join(
+                output_dir, output_file), sep="\t", index=False)
+
+            return self
+
+        if not self.dirty:
+            return self
+
+        new_rows = len(self._records) - self._persisted
+
+        if self._rewrite or self._journal_rows + new_rows >= self.journal_compact_rows:
+            self.compact()
+        else:
+            self.append_journal()
 
         return self
 
@@ -220,16 +520,7 @@ class Processed:
         delete records
         """
         print("Deleting records...")
-        self.processed = pd.DataFrame(
-            columns=[
-                "sample_id",
-                "fastq",
-                "dir",
-                "barcode",
-                "time",
-                "merged",
-            ]
-        )
+        self.reset_index()
 
 
 class ProcessAction(ABCMeta):
@@ -239,19 +530,26 @@ class ProcessAction(ABCMeta):
 
     @staticmethod
     @abstractmethod
-    def process(fastq_file: str, sample_id: str, processed: Processed):
+    def process(fastq_file: str, sample_id: str, processed: Processed,
+                run_metadata: Optional["RunConfig"] = None):
         """
-        process
+        process. run_metadata holds run settings, e.g. size caps
         """
         pass
 
 
 class ProcessActionMergeWithLast(ProcessAction):
-    """get_dir_merged_last
-    class to merge with last"""
+    """
+    class to merge with last.
+    the new cumulative file is a clone of the last merged file for the sample
+    followed by the gzip members already written to fastq_file, so only the
+    new chunk is copied."""
+
+    tmp_suffix = ".tmp"
 
     @staticmethod
-    def process(fastq_file: str, sample_id: str, processed: Processed):
+    def process(fastq_file: str, sample_id: str, processed: Processed,
+                run_metadata: Optional["RunConfig"] = None):
         """
         process
         """
@@ -262,10 +560,124 @@ class ProcessActionMergeWithLast(ProcessAction):
             return
 
         utils = Utils()
+        cumulative_file = fastq_file + ProcessActionMergeWithLast.tmp_suffix
 
-        utils.append_file_to_gz(
-            last_run_file, fastq_file
-        )
+        last_index = BlockIndex.load(last_run_file)
+        new_index = BlockIndex.load(fastq_file)
+        last_size = os.path.getsize(last_run_file)
+
+        try:
+            utils.clone_file(last_run_file, cumulative_file)
+            utils.append_gz_raw(fastq_file, cumulative_file)
+            os.replace(cumulative_file, fastq_file)
+
+        finally:
+            if os.path.exists(cumulative_file):
+                os.remove(cumulative_file)
+
+        if last_index is not None and new_index is not None:
+            last_index.extend(new_index, last_size).save(fastq_file)
+        else:
+            BlockIndex.remove(fastq_file)
+
+
+class ProcessActionSubsample(ProcessAction):
+    """
+    class to cap the size of uploads.
+    merged files larger than the cap get a randomly subsampled copy
+    in the upload subdirectory, used for upload. the merged file is unchanged.
+    the copy samples all reads of the file at one fraction, cap / size. for a
+    cumulative merged file it is rebuilt from the upload copy of the last
+    merged file, sampled again at the lower fraction, and the new chunk."""
+
+    max_bytes = 629916160  # insaflu reduces larger fastq files to this size
+    size_margin = 0.95
+    upload_dirname = "upload"
+
+    @staticmethod
+    def get_upload_path(fastq_file: str) -> str:
+        """
+        upload copy path, same file name
+        """
+        return os.path.join(
+            os.path.dirname(fastq_file),
+            ProcessActionSubsample.upload_dirname,
+            os.path.basename(fastq_file))
+
+    @staticmethod
+    def get_upload_source(fastq_file: str) -> str:
+        """
+        file to upload for fastq_file, the subsampled copy if there is one
+        """
+        upload_file = ProcessActionSubsample.get_upload_path(fastq_file)
+
+        if os.path.exists(upload_file):
+            return upload_file
+
+        return fastq_file
+
+    @staticmethod
+    def get_last_upload(fastq_file: str, sample_id: str, processed: Optional[Processed],
+                        run_metadata: Optional["RunConfig"]) -> Tuple[Optional[str], int]:
+        """
+        with merge, fastq_file starts with the last merged file of the sample.
+        return the upload source of that file and its size, where the new chunk
+        starts in fastq_file. None, 0 if fastq_file is not cumulative.
+        """
+        if processed is None or run_metadata is None or \
+                ProcessActionMergeWithLast not in (run_metadata.actions or []):
+            return None, 0
+
+        last_run_file = processed.get_id_merged_last(sample_id)
+
+        if last_run_file == "" or last_run_file == fastq_file:
+            return None, 0
+
+        last_size = Utils.get_size(last_run_file)
+
+        if last_size is None or last_size >= os.path.getsize(fastq_file):
+            return None, 0
+
+        return ProcessActionSubsample.get_upload_source(last_run_file), last_size
+
+    @staticmethod
+    def process(fastq_file: str, sample_id: str, processed: Processed,
+                run_metadata: Optional["RunConfig"] = None):
+        """
+        process
+        """
+        max_bytes = ProcessActionSubsample.max_bytes
+        if run_metadata is not None:
+            max_bytes = run_metadata.max_upload_bytes
+
+        upload_file = ProcessActionSubsample.get_upload_path(fastq_file)
+        file_size = os.path.getsize(fastq_file)
+
+        if file_size <= max_bytes:
+            if os.path.exists(upload_file):
+                os.remove(upload_file)
+            return
+
+        os.makedirs(os.path.dirname(upload_file), exist_ok=True)
+
+        base, offset = ProcessActionSubsample.get_last_upload(
+            fastq_file, sample_id, processed, run_metadata)
+
+        sources = [(fastq_file, 0)]
+        if base is not None:
+            sources = [(base, 0), (fastq_file, offset)]
+
+        fraction = min(1, ProcessActionSubsample.size_margin *
+                       max_bytes / file_size)
+
+        Utils.subsample_fastq(
+            sources, upload_file, fraction, seed=sample_id)
+
+        while os.path.getsize(upload_file) > max_bytes:
+            fraction *= ProcessActionSubsample.size_margin
+
+            Utils.subsample_fastq(
+                [(upload_file, 0)], upload_file, fraction, seed=sample_id)
 
 
 @dataclass
@@ -286,6 +698,18 @@ class RunParams:
     actions: Optional[List[Type[ProcessAction]]] = None
     keep_name: bool = False
     sleep_time: int = 10
+    watch: bool = False
+    completeness: str = "open_files"
+    workers: int = 1
+    batch: bool = False
+    coalesce_threshold: int = 0
+    codec: str = "auto"
+    compress_threads: int = 1
+    compresslevel: int = ConstantsSettings.gzip_compresslevel
+    adaptive_level: bool = False
+    max_upload_bytes: int = ProcessActionSubsample.max_bytes
+    stats: bool = False
+    bgzf: bool = False
 
 
 @dataclass
@@ -1,13 +1,33 @@
 import gzip
+import hashlib
+import io
 import os
 import shutil
+import sys
+import time
 import unittest
 
 import pandas as pd
 
-from fastq_handler.fastq_handler import DirectoryProcessing, PreMain, RunConfig
-from fastq_handler.records import ProcessActionMergeWithLast, Processed
-from fastq_handler.utilities import ConstantsSettings, Utils
+from fastq_handler.bgzf import BgzfCodec, BgzfWriter, BlockIndex
+from fastq_handler.compression import (CODECS, AdaptiveCodec,
+                                       CompressionLevelAdvisor, ZlibCodec,
+                                       available_codecs, benchmark_sample,
+                                       get_codec)
+from fastq_handler.fastq_handler import (DirectoryProcessing,
+                                         DirectoryProcessingSimple,
+                                         GzipTrailerDetector,
+                                         OpenFilesDetector, OpenFilesSnapshot,
+                                         PreMain, RunConfig,
+                                         SizeQuiescenceDetector)
+from fastq_handler.fastq_stats import FastqStatsCollector
+from fastq_handler.records import (ProcessActionMergeWithLast,
+                                   ProcessActionSubsample, Processed,
+                                   RunParams)
+from fastq_handler.utilities import (ConstantsSettings, FastqDirectoryIndex,
+                                     Utils)
+from fastq_handler.watchers import (InotifyWatcher, PollingWatcher,
+                                    get_directory_watcher)
 
 
 class TestRunConfig(unittest.TestCase):
@@ -136,6 +156,281 @@ class TestPreMain(unittest.TestCase):
 
         self.premain.processed.delete_records()
 
+    def test_process_fastq_dict_workers(self):
+
+        for barcode in ["barcode01", "barcode02"]:
+            os.makedirs(os.path.join(self.fastq_dir, barcode), exist_ok=True)
+            for ix in range(2):
+                with open(os.path.join(self.fastq_dir, barcode, f"chunk_{ix}.fastq"), "w") as f:
+                    f.write(f"@{barcode}_{ix}\nACGT\n+\nIIII\n")
+
+        self.run_metadata.workers = 2
+        self.premain.prep_output_dirs().assess_depth_fastqs()
+
+        try:
+            self.premain.process_fastq_dict()
+        finally:
+            self.premain.shutdown_workers()
+
+        processed = self.premain.processed.processed
+        assert len(processed) == 4
+        assert sorted(processed.dir.apply(os.path.basename)) == [
+            "barcode01", "barcode01", "barcode02", "barcode02"]
+
+        for barcode in ["barcode01", "barcode02"]:
+            last_merged = self.premain.processed.get_dir_merged_last(
+                os.path.join(self.fastq_dir, barcode))
+
+            with gzip.open(last_merged, "rt") as f:
+                assert f.read() == f"@{barcode}_0\nACGT\n+\nIIII\n@{barcode}_1\nACGT\n+\nIIII\n"
+
+        self.premain.processed.delete_records()
+
+    def test_process_fastq_dict_batch(self):
+
+        os.makedirs(self.fastq_dir, exist_ok=True)
+        for ix in range(3):
+            with open(os.path.join(self.fastq_dir, f"chunk_{ix}.fastq"), "w") as f:
+                f.write(f"@r{ix}\nACGT\n+\nIIII\n")
+
+        self.run_metadata.batch = True
+        self.premain.prep_output_dirs().assess_depth_fastqs().\
+            process_fastq_dict()
+
+        output_dir_merged = os.path.join(
+            self.output_dir,
+            os.path.basename(self.fastq_dir))
+
+        output_file = f"{os.path.basename(self.fastq_dir)}_test_0-2.fastq.gz"
+        output_path = os.path.join(
+            self.run_metadata.output_dir, os.path.basename(self.fastq_dir), output_file)
+
+        assert os.listdir(output_dir_merged) == [output_file]
+
+        processed = self.premain.processed.processed
+        assert list(processed.barcode) == ["0", "1", "2"]
+        assert set(processed.merged) == {output_path}
+        assert list(processed.folded) == [True, True, False]
+
+        with gzip.open(output_path, "rt") as f:
+            assert f.read() == "".join(
+                f"@r{ix}\nACGT\n+\nIIII\n" for ix in range(3))
+
+        self.premain.processed.delete_records()
+
+    def test_process_fastq_dict_batch_no_merge(self):
+
+        os.makedirs(self.fastq_dir, exist_ok=True)
+        for ix in range(2):
+            with open(os.path.join(self.fastq_dir, f"chunk_{ix}.fastq"), "w") as f:
+                f.write(f"@r{ix}\nACGT\n+\nIIII\n")
+
+        self.run_metadata.batch = True
+        self.run_metadata.actions = [ProcessActionSubsample]
+        self.premain.prep_output_dirs().assess_depth_fastqs().\
+            process_fastq_dict()
+
+        processed = self.premain.processed.processed
+        assert len(set(processed.merged)) == 2
+        assert not processed.folded.any()
+
+        self.premain.processed.delete_records()
+
+    def test_process_fastq_dict_stats(self):
+
+        os.makedirs(self.fastq_dir, exist_ok=True)
+        with open(os.path.join(self.fastq_dir, "chunk_0.fastq"), "w") as f:
+            f.write("@r0\nACGT\n+\nIIII\n@r1\nAC\n+\nII\n")
+
+        self.run_metadata.stats = True
+        self.premain.prep_output_dirs().assess_depth_fastqs().\
+            process_fastq_dict()
+
+        record = self.premain.processed.processed.iloc[0]
+        assert record.reads == 2
+        assert record.bases == 6
+        assert record.n50 == 4
+        assert record.mean_qual == 40
+
+        self.premain.processed.delete_records()
+
+    def test_process_fastq_dict_keep_names(self):
+
+        os.makedirs(self.fastq_dir, exist_ok=True)
+        with gzip.open(os.path.join(self.fastq_dir, "chunk_0.fastq.gz"), "wb") as f:
+            f.write(b"@r0\nACGT\n+\nIIII\n")
+
+        self.run_metadata.keep_name = True
+        self.premain.prep_output_dirs().assess_depth_fastqs().\
+            process_fastq_dict()
+
+        output_file = os.path.join(
+            self.run_metadata.output_dir, os.path.basename(self.fastq_dir), "chunk_0.fastq.gz")
+
+        assert os.path.samefile(
+            os.path.join(self.fastq_dir, "chunk_0.fastq.gz"), output_file) is True
+
+        record = self.premain.processed.processed.iloc[0]
+        assert record.merged == output_file
+        assert record.copy_method == "hardlink"
+
+        self.premain.processed.delete_records()
+
+    def test_process_fastq_dict_keep_names_no_actions(self):
+
+        os.makedirs(self.fastq_dir, exist_ok=True)
+        with gzip.open(os.path.join(self.fastq_dir, "chunk_0.fastq.gz"), "wb") as f:
+            f.write(b"@r0\nACGT\n+\nIIII\n")
+
+        self.run_metadata.actions = []
+        self.run_metadata.keep_name = True
+        self.premain.prep_output_dirs().assess_depth_fastqs().\
+            process_fastq_dict()
+
+        record = self.premain.processed.processed.iloc[0]
+        assert record.merged == os.path.join(
+            self.fastq_dir, "chunk_0.fastq.gz")
+        assert os.listdir(os.path.join(
+            self.run_metadata.output_dir, os.path.basename(self.fastq_dir))) == []
+
+        self.premain.processed.delete_records()
+
+    def test_process_fastq_dict_coalesce(self):
+
+        os.makedirs(self.fastq_dir, exist_ok=True)
+        for ix in range(3):
+            with open(os.path.join(self.fastq_dir, f"chunk_{ix}.fastq"), "w") as f:
+                f.write(f"@r{ix}\nACGT\n+\nIIII\n")
+
+        self.run_metadata.coalesce_threshold = 2
+        self.premain.prep_output_dirs().assess_depth_fastqs().\
+            process_fastq_dict()
+
+        output_dir_merged = os.path.join(
+            self.output_dir,
+            os.path.basename(self.fastq_dir))
+
+        assert os.listdir(output_dir_merged) == [
+            f"{os.path.basename(self.fastq_dir)}_test_0-2.fastq.gz"]
+
+        processed = self.premain.processed.processed
+        assert list(processed.folded) == [True, True, False]
+
+        with open(os.path.join(self.fastq_dir, "chunk_3.fastq"), "w") as f:
+            f.write("@r3\nACGT\n+\nIIII\n")
+
+        self.premain.process_fastq_dict()
+
+        assert sorted(os.listdir(output_dir_merged)) == [
+            f"{os.path.basename(self.fastq_dir)}_test_0-2.fastq.gz",
+            f"{os.path.basename(self.fastq_dir)}_test_0-3.fastq.gz"]
+        assert list(self.premain.processed.processed.folded) == [
+            True, True, False, False]
+
+        self.premain.processed.delete_records()
+
+
+class TestOpenFilesSnapshot(unittest.TestCase):
+    test_directory = "tests_open/"
+
+    def setUp(self) -> None:
+
+        os.makedirs(self.test_directory, exist_ok=True)
+
+    def tearDown(self) -> None:
+
+        shutil.rmtree(self.test_directory)
+
+    @unittest.skipUnless(sys.platform == "linux", "/proc is linux only")
+    def test_is_open(self):
+
+        file_path = f"{self.test_directory}/test.fastq"
+        open_files = OpenFilesSnapshot()
+
+        with open(file_path, "w") as f:
+            f.write("@r1\n")
+            assert open_files.refresh().is_open(file_path) is True
+
+        assert open_files.refresh().is_open(file_path) is False
+
+        with open(file_path, "r") as f:
+            assert open_files.refresh().is_open(file_path) is False
+
+
+class TestCompletenessDetectors(unittest.TestCase):
+    test_directory = "tests_complete/"
+
+    def setUp(self) -> None:
+
+        os.makedirs(self.test_directory, exist_ok=True)
+
+    def tearDown(self) -> None:
+
+        shutil.rmtree(self.test_directory)
+
+    def test_size_quiescence(self):
+
+        file_path = f"{self.test_directory}/test.fastq"
+        detector = SizeQuiescenceDetector()
+
+        with open(file_path, "w") as f:
+            f.write("@r1\n")
+
+        assert detector.refresh().is_complete(file_path) is False
+        assert detector.refresh().is_complete(file_path) is True
+
+        with open(file_path, "a") as f:
+            f.write("ACGT\n")
+
+        assert detector.refresh().is_complete(file_path) is False
+        assert detector.refresh().is_complete(file_path) is True
+
+        detector.refresh()
+        detector.refresh()
+        assert detector.observed == {}
+
+    def test_gzip_trailer(self):
+
+        file_path = f"{self.test_directory}/test.fastq.gz"
+        detector = GzipTrailerDetector()
+
+        with open(file_path, "wb") as f:
+            f.write(b"\x1f\x8b")
+
+        assert detector.refresh().is_complete(file_path) is False
+        assert detector.refresh().is_complete(file_path) is False
+
+        with gzip.open(file_path, "wb") as f:
+            f.write(b"@r1\nACGT\n+\nIIII\n")
+
+        assert detector.refresh().is_complete(file_path) is False
+        assert detector.refresh().is_complete(file_path) is True
+
+        with open(file_path, "ab") as f:
+            f.write(GzipTrailerDetector.bgzf_eof)
+
+        assert detector.refresh().is_complete(file_path) is True
+
+
+    @unittest.skipUnless(sys.platform == "linux", "/proc is linux only")
+    def test_open_files_after_refresh(self):
+
+        fastq_dir = f"{self.test_directory}/barcode01"
+        os.makedirs(fastq_dir)
+
+        detector = OpenFilesDetector()
+        detector.refresh()
+
+        run_config = RunConfig(output_dir=f"{self.test_directory}/output")
+        directory_processing = DirectoryProcessingSimple(
+            fastq_dir, run_config, Processed(run_config.logs_dir), time.time(), detector=detector)
+
+        with open(f"{fastq_dir}/chunk_0.fastq", "w") as f:
+            f.write("@r1\n")
+            assert directory_processing.get_files() == []
+
+        assert directory_processing.get_files() == [f"{fastq_dir}/chunk_0.fastq"]
+
 
 class DontTestConstantsSettings(unittest.TestCase):
 
@@ -278,6 +573,677 @@ class TestUtils(unittest.TestCase):
         assert utils.search_folder_for_seq_files(
             folder_find) == ["test.fastq"]
 
+    def test_is_gzip_file(self):
+        utils = Utils()
+
+        with gzip.open(f"{self.test_directory}/test.fastq.gz", "wb") as f:
+            f.write(b"@r1\nACGT\n+\nIIII\n")
+        with open(f"{self.test_directory}/test.fastq", "wb") as f:
+            f.write(b"@r1\nACGT\n+\nIIII\n")
+
+        assert utils.is_gzip_file(f"{self.test_directory}/test.fastq.gz") is True
+        assert utils.is_gzip_file(f"{self.test_directory}/test.fastq") is False
+
+    def test_append_file_to_gz_raw(self):
+        utils = Utils()
+        record = b"@r1\nACGT\n+\nIIII\n"
+
+        with gzip.open(f"{self.test_directory}/test.fastq.gz", "wb") as f:
+            f.write(record)
+
+        destination = f"{self.test_directory}/merged.fastq.gz"
+        utils.append_file_to_gz(f"{self.test_directory}/test.fastq.gz", destination)
+        utils.append_file_to_gz(f"{self.test_directory}/test.fastq.gz", destination)
+
+        with open(f"{self.test_directory}/test.fastq.gz", "rb") as f:
+            source_bytes = f.read()
+        with open(destination, "rb") as f:
+            assert f.read() == source_bytes * 2
+
+        with gzip.open(destination, "rb") as f:
+            assert f.read() == record * 2
+
+    def test_append_file_to_gz_truncated(self):
+        utils = Utils()
+        records = [f"@r{ix}\nACGT\n+\nIIII\n".encode() for ix in range(2)]
+
+        with gzip.open(f"{self.test_directory}/test_0.fastq.gz", "wb") as f:
+            f.write(records[0])
+        with open(f"{self.test_directory}/test_1.fastq.gz", "wb") as f:
+            f.write(gzip.compress(records[1])[:-6])
+
+        destination = f"{self.test_directory}/merged.fastq.gz"
+        utils.append_file_to_gz(f"{self.test_directory}/test_0.fastq.gz", destination)
+
+        assert utils.is_raw_appendable(
+            f"{self.test_directory}/test_1.fastq.gz", ZlibCodec()) is False
+
+        with self.assertRaises(EOFError):
+            utils.append_file_to_gz(f"{self.test_directory}/test_1.fastq.gz", destination)
+        with self.assertRaises(EOFError):
+            utils.append_files_to_gz(
+                [f"{self.test_directory}/test_1.fastq.gz"], destination)
+        with self.assertRaises(EOFError):
+            utils.append_gz_raw(f"{self.test_directory}/test_1.fastq.gz", destination)
+
+        with gzip.open(destination, "rb") as f:
+            assert f.read() == records[0]
+
+    def test_append_file_to_gz_plain(self):
+        utils = Utils()
+        record = b"@r1\nACGT\n+\nIIII\n"
+
+        with open(f"{self.test_directory}/test.fastq", "wb") as f:
+            f.write(record)
+
+        destination = f"{self.test_directory}/merged.fastq.gz"
+        utils.append_file_to_gz(f"{self.test_directory}/test.fastq", destination)
+
+        assert utils.is_gzip_file(destination) is True
+        with gzip.open(destination, "rb") as f:
+            assert f.read() == record
+
+    def test_append_files_to_gz(self):
+        utils = Utils()
+        records = [f"@r{ix}\nACGT\n+\nIIII\n".encode() for ix in range(3)]
+
+        with open(f"{self.test_directory}/test_0.fastq", "wb") as f:
+            f.write(records[0])
+        with open(f"{self.test_directory}/test_1.fastq", "wb") as f:
+            f.write(records[1])
+        with gzip.open(f"{self.test_directory}/test_2.fastq.gz", "wb") as f:
+            f.write(records[2])
+
+        destination = f"{self.test_directory}/merged.fastq.gz"
+        utils.append_files_to_gz([
+            f"{self.test_directory}/test_0.fastq",
+            f"{self.test_directory}/test_1.fastq",
+            f"{self.test_directory}/test_2.fastq.gz",
+        ], destination)
+
+        with open(f"{self.test_directory}/test_2.fastq.gz", "rb") as f:
+            gz_bytes = f.read()
+        with open(destination, "rb") as f:
+            assert f.read().endswith(gz_bytes)
+
+        with gzip.open(destination, "rb") as f:
+            assert f.read() == b"".join(records)
+
+    def test_append_file_to_gz_tee(self):
+        utils = Utils()
+
+        with open(f"{self.test_directory}/test.fastq", "wb") as f:
+            f.write(b"@r1\nACGT\n+\nIIII\n")
+        with gzip.open(f"{self.test_directory}/test.fastq.gz", "wb") as f:
+            f.write(b"@r2\nACGT\n+\nIIII\n")
+
+        destination = f"{self.test_directory}/merged.fastq.gz"
+        tee = io.BytesIO()
+
+        utils.append_file_to_gz(
+            f"{self.test_directory}/test.fastq", destination, tee=tee)
+        utils.append_files_to_gz(
+            [f"{self.test_directory}/test.fastq.gz"], destination, tee=tee)
+
+        with open(destination, "rb") as f:
+            assert f.read() == tee.getvalue()
+
+        assert gzip.decompress(tee.getvalue()) == \
+            b"@r1\nACGT\n+\nIIII\n@r2\nACGT\n+\nIIII\n"
+
+    def test_append_files_to_gz_interrupted(self):
+        utils = Utils()
+
+        with open(f"{self.test_directory}/test_0.fastq", "wb") as f:
+            f.write(b"@r0\nACGT\n+\nIIII\n")
+
+        destination = f"{self.test_directory}/merged.fastq.gz"
+        utils.append_files_to_gz(
+            [f"{self.test_directory}/test_0.fastq"], destination)
+        size = os.path.getsize(destination)
+
+        with self.assertRaises(FileNotFoundError):
+            utils.append_files_to_gz([
+                f"{self.test_directory}/test_0.fastq",
+                f"{self.test_directory}/missing.fastq",
+            ], destination)
+
+        assert os.path.getsize(destination) == size
+
+        with self.assertRaises(FileNotFoundError):
+            utils.append_file_to_gz(
+                f"{self.test_directory}/missing.fastq", f"{self.test_directory}/new.fastq.gz")
+
+        assert not os.path.exists(f"{self.test_directory}/new.fastq.gz")
+
+    def test_remove_stale_parts(self):
+        utils = Utils()
+        os.makedirs(f"{self.test_directory}/merged", exist_ok=True)
+
+        for name in ["a.fastq.gz.part", "a.fastq.gz.part.blocks", "b.fastq.gz.tmp",
+                     "b.fastq.gz", "notes.tmp"]:
+            with open(f"{self.test_directory}/merged/{name}", "wb") as f:
+                f.write(b"x")
+
+        assert utils.remove_stale_parts(self.test_directory) == 3
+        assert sorted(os.listdir(f"{self.test_directory}/merged")) == [
+            "b.fastq.gz", "notes.tmp"]
+
+    def test_sha256_file(self):
+        utils = Utils()
+        data = os.urandom(1000)
+
+        with open(f"{self.test_directory}/test.fastq.gz", "wb") as f:
+            f.write(data)
+
+        checksum, prefix_checksum = utils.sha256_file(
+            f"{self.test_directory}/test.fastq.gz", prefix_size=600)
+
+        assert checksum == hashlib.sha256(data).hexdigest()
+        assert prefix_checksum == hashlib.sha256(data[:600]).hexdigest()
+        assert utils.sha256_file(
+            f"{self.test_directory}/test.fastq.gz")[1] is None
+
+    def test_clone_file(self):
+        utils = Utils()
+
+        with open(f"{self.test_directory}/test.fastq", "wb") as f:
+            f.write(b"@r1\nACGT\n+\nIIII\n")
+
+        method = utils.clone_file(f"{self.test_directory}/test.fastq",
+                                  f"{self.test_directory}/clone.fastq")
+
+        assert method in ["reflink", "copy_file_range", "copy"]
+        with open(f"{self.test_directory}/clone.fastq", "rb") as f:
+            assert f.read() == b"@r1\nACGT\n+\nIIII\n"
+
+    def test_link_file(self):
+        utils = Utils()
+
+        with gzip.open(f"{self.test_directory}/test.fastq.gz", "wb") as f:
+            f.write(b"@r1\nACGT\n+\nIIII\n")
+
+        destination = f"{self.test_directory}/out.fastq.gz"
+        open(destination, "w").close()
+
+        method = utils.link_file(f"{self.test_directory}/test.fastq.gz", destination)
+
+        assert method == "hardlink"
+        assert os.path.samefile(
+            f"{self.test_directory}/test.fastq.gz", destination) is True
+        assert os.path.exists(destination + ".tmp") is False
+
+    def test_merge_with_last(self):
+        processed = Processed(self.test_directory)
+        processed.delete_records()
+
+        last_merged = f"{self.test_directory}/barcode01_00-00.fastq.gz"
+        new_merged = f"{self.test_directory}/barcode01_00-01.fastq.gz"
+
+        with gzip.open(last_merged, "wb") as f:
+            f.write(b"@r1\nACGT\n+\nIIII\n")
+        with gzip.open(new_merged, "wb") as f:
+            f.write(b"@r2\nTTTT\n+\nIIII\n")
+
+        with open(last_merged, "rb") as f:
+            last_bytes = f.read()
+        with open(new_merged, "rb") as f:
+            new_bytes = f.read()
+
+        processed.update("chunk_0.fastq.gz", "barcode01", 0, last_merged)
+        ProcessActionMergeWithLast.process(new_merged, "barcode01", processed)
+
+        with open(new_merged, "rb") as f:
+            assert f.read() == last_bytes + new_bytes
+        with gzip.open(new_merged, "rb") as f:
+            assert f.read() == b"@r1\nACGT\n+\nIIII\n@r2\nTTTT\n+\nIIII\n"
+
+        assert os.path.exists(new_merged + ".tmp") is False
+
+    def test_subsample(self):
+        reads = [
+            f"@r{ix}\n{'ACGT' * 25}\n+\n{'I' * 100}\n".encode() for ix in range(5000)]
+        merged = f"{self.test_directory}/barcode01_00-01.fastq.gz"
+
+        with gzip.open(merged, "wb", compresslevel=1) as f:
+            f.write(b"".join(reads))
+        with open(merged, "rb") as f:
+            merged_bytes = f.read()
+
+        upload_path = ProcessActionSubsample.get_upload_path(merged)
+        assert os.path.basename(upload_path) == os.path.basename(merged)
+        assert ProcessActionSubsample.get_upload_source(merged) == merged
+
+        run_config = RunConfig(max_upload_bytes=len(merged_bytes) // 2)
+        ProcessActionSubsample.process(merged, "barcode01", None, run_config)
+
+        assert ProcessActionSubsample.get_upload_source(merged) == upload_path
+        assert os.path.getsize(upload_path) <= len(merged_bytes) // 2
+        assert ProcessActionSubsample.max_bytes == RunParams.max_upload_bytes
+
+        with gzip.open(upload_path, "rb") as f:
+            sampled = f.read()
+
+        sampled_lines = sampled.splitlines(keepends=True)
+        sampled_reads = [b"".join(sampled_lines[ix: ix + 4])
+                         for ix in range(0, len(sampled_lines), 4)]
+
+        assert 0 < len(sampled_reads) < len(reads)
+        assert set(sampled_reads).issubset(reads)
+
+        with open(merged, "rb") as f:
+            assert f.read() == merged_bytes
+
+        run_config = RunConfig(max_upload_bytes=len(merged_bytes))
+        ProcessActionSubsample.process(merged, "barcode01", None, run_config)
+
+        assert os.path.exists(upload_path) is False
+
+    def test_subsample_cumulative(self):
+        processed = Processed(self.test_directory)
+        processed.delete_records()
+
+        chunks = [[f"@r{chunk}_{ix}\n{'ACGT' * 25}\n+\n{'I' * 100}\n".encode() for ix in range(3000)]
+                  for chunk in range(5)]
+
+        with gzip.open(f"{self.test_directory}/chunk.fastq.gz", "wb", compresslevel=1) as f:
+            f.write(b"".join(chunks[0]))
+
+        run_config = RunConfig(
+            actions=[ProcessActionMergeWithLast, ProcessActionSubsample],
+            max_upload_bytes=os.path.getsize(f"{self.test_directory}/chunk.fastq.gz") * 3 // 2)
+
+        uploads = []
+
+        for chunk, reads in enumerate(chunks):
+            merged = f"{self.test_directory}/barcode01_00-0{chunk}.fastq.gz"
+
+            with gzip.open(merged, "wb", compresslevel=1) as f:
+                f.write(b"".join(reads))
+
+            ProcessActionMergeWithLast.process(
+                merged, "barcode01", processed, run_config)
+            ProcessActionSubsample.process(
+                merged, "barcode01", processed, run_config)
+            processed.update(
+                f"chunk_{chunk}.fastq.gz", "barcode01", chunk, merged)
+
+            upload_source = ProcessActionSubsample.get_upload_source(merged)
+            assert os.path.getsize(
+                upload_source) <= run_config.max_upload_bytes
+
+            with gzip.open(upload_source, "rb") as f:
+                sampled_lines = f.read().splitlines(keepends=True)
+
+            uploads.append(set(b"".join(sampled_lines[ix: ix + 4])
+                           for ix in range(0, len(sampled_lines), 4)))
+
+        assert uploads[0] == set(chunks[0])
+
+        for chunk in range(1, len(chunks)):
+            assert uploads[chunk].issubset(
+                set().union(*chunks[:chunk + 1]))
+            assert uploads[chunk] & set(chunks[chunk])
+
+        last_counts = [len(uploads[-1] & set(reads)) for reads in chunks]
+        assert min(last_counts) > max(last_counts) // 2
+
+        assert uploads[-1] != uploads[-2]
+
+
+class TestCompression(unittest.TestCase):
+    test_directory = "tests_codec/"
+
+    def setUp(self) -> None:
+
+        os.makedirs(self.test_directory, exist_ok=True)
+
+    def tearDown(self) -> None:
+
+        shutil.rmtree(self.test_directory)
+
+    def test_available_codecs(self):
+
+        assert "zlib" in available_codecs()
+
+        with self.assertRaises(ValueError):
+            get_codec("lz4")
+
+    def test_codecs_roundtrip(self):
+        sample = benchmark_sample(n_reads=100)
+        destination = f"{self.test_directory}/merged.fastq.gz"
+
+        for name in available_codecs():
+            for threads in [1, 2]:
+                codec = CODECS[name](threads=threads)
+
+                with open(destination, "wb") as f_out:
+                    f_out.write(b"prefix")
+                with open(destination, "ab") as f_out:
+                    with codec.open_writer(f_out) as writer:
+                        writer.write(sample)
+
+                with open(destination, "rb") as f:
+                    assert f.read(6) == b"prefix"
+                    with gzip.open(f, "rb") as f_gz:
+                        assert f_gz.read() == sample, name
+
+    def test_auto_codec(self):
+
+        codec = get_codec("auto")
+
+        assert codec.name in available_codecs()
+        assert get_codec("auto").name == codec.name
+
+    def test_level_advisor(self):
+        advisor = CompressionLevelAdvisor(ZlibCodec, default_level=3)
+
+        advisor.record_compression(1, 100, 50, 1)
+        advisor.record_compression(9, 100, 25, 4)
+
+        assert advisor.choose_level() == 3
+
+        advisor.record_upload(10, 1)
+        assert advisor.upload_rate is None
+
+        advisor.record_upload(10 * advisor.min_upload_bytes, 1)
+        assert advisor.choose_level() == 1
+
+        advisor.upload_rate = 1
+        assert advisor.choose_level() == 9
+
+    def test_level_advisor_bounds(self):
+        advisor = CompressionLevelAdvisor(ZlibCodec, default_level=3)
+        advisor.calibrate(benchmark_sample(n_reads=100))
+
+        assert 0 not in advisor.compress_rate
+
+        advisor.record_compression(0, 100, 100, 1e-6)
+
+        for upload_rate in [1e3, 1e6, 1e9, 1e12]:
+            advisor.upload_rate = upload_rate
+            assert 1 <= advisor.choose_level() <= max(ZlibCodec.levels)
+
+    def test_adaptive_codec(self):
+        sample = benchmark_sample(n_reads=100)
+        destination = f"{self.test_directory}/merged.fastq.gz"
+
+        advisor = CompressionLevelAdvisor(ZlibCodec, default_level=3)
+        codec = AdaptiveCodec(ZlibCodec, advisor)
+
+        with open(destination, "ab") as f_out:
+            with codec.open_writer(f_out) as writer:
+                writer.write(sample)
+
+        with gzip.open(destination, "rb") as f:
+            assert f.read() == sample
+
+        assert list(advisor.compress_rate) == [3]
+        assert advisor.ratio[3] == os.path.getsize(destination) / len(sample)
+
+        advisor.calibrate(sample)
+        assert sorted(advisor.compress_rate) == advisor.candidate_levels
+        assert advisor.candidate_levels == [1, 3, 6, 9]
+
+    def test_append_file_to_gz_codec(self):
+        record = b"@r1\nACGT\n+\nIIII\n"
+
+        with open(f"{self.test_directory}/test.fastq", "wb") as f:
+            f.write(record)
+
+        destination = f"{self.test_directory}/merged.fastq.gz"
+        Utils.append_file_to_gz(
+            f"{self.test_directory}/test.fastq", destination, codec=ZlibCodec())
+        Utils.append_files_to_gz(
+            [f"{self.test_directory}/test.fastq"], destination, codec=ZlibCodec())
+
+        with gzip.open(destination, "rb") as f:
+            assert f.read() == record * 2
+
+
+class TestBgzf(unittest.TestCase):
+    test_directory = "tests_bgzf/"
+    reads = [
+        f"@r{ix}\n{'ACGT' * 100}\n+\n{'I' * 400}\n".encode() for ix in range(500)]
+
+    def setUp(self) -> None:
+
+        os.makedirs(self.test_directory, exist_ok=True)
+
+    def tearDown(self) -> None:
+
+        shutil.rmtree(self.test_directory)
+
+    def test_blocks_and_index(self):
+        data = b"".join(self.reads)
+        destination = f"{self.test_directory}/merged.fastq.gz"
+
+        with open(destination, "ab") as f_out:
+            with BgzfCodec(3).open_writer(f_out) as writer:
+                for start in range(0, len(data), 1000):
+                    writer.write(data[start: start + 1000])
+
+        with gzip.open(destination, "rb") as f:
+            assert f.read() == data
+
+        with open(destination, "rb") as f:
+            assert f.read()[-28:] == BgzfWriter.eof_block
+
+        index = BlockIndex.load(destination)
+        assert len(index.blocks) > 1
+        assert index.reads == len(self.reads)
+        assert index.uncompressed_end == len(data)
+
+        with open(destination, "rb") as f:
+            for compressed_offset, uncompressed_offset, uncompressed_size, reads in index.blocks:
+                f.seek(compressed_offset)
+                header = f.read(18)
+                block_size = int.from_bytes(header[16:18], "little") + 1
+
+                block = header + f.read(block_size - 18)
+                block_data = gzip.decompress(block)
+
+                assert len(block_data) == uncompressed_size
+                assert block_data == data[uncompressed_offset: uncompressed_offset + uncompressed_size]
+                assert block_data.count(b"\n") == 4 * reads
+
+    def test_merge_with_last_index(self):
+        processed = Processed(self.test_directory)
+        processed.delete_records()
+
+        last_merged = f"{self.test_directory}/barcode01_00-00.fastq.gz"
+        new_merged = f"{self.test_directory}/barcode01_00-01.fastq.gz"
+
+        for merged, reads in [(last_merged, self.reads[:200]), (new_merged, self.reads[200:])]:
+            with open(merged, "ab") as f_out:
+                with BgzfCodec(3).open_writer(f_out) as writer:
+                    writer.write(b"".join(reads))
+
+        processed.update("chunk_0.fastq.gz", "barcode01", 0, last_merged)
+        ProcessActionMergeWithLast.process(new_merged, "barcode01", processed)
+
+        index = BlockIndex.load(new_merged)
+        assert index.reads == len(self.reads)
+        assert index.uncompressed_end == len(b"".join(self.reads))
+
+        with open(new_merged, "rb") as f:
+            f.seek(index.blocks[-1][0])
+            assert gzip.decompress(f.read()).endswith(self.reads[-1])
+
+
+class TestFastqStats(unittest.TestCase):
+    test_directory = "tests_stats/"
+    reads = [
+        b"@r1\nACGT\n+\nIIII\n",
+        b"@r2\nACGTACGTAC\n+\n+++++55555\n",
+        b"@r3\r\nAC\r\n+\r\n!!\r\n",
+    ]
+
+    def setUp(self) -> None:
+
+        os.makedirs(self.test_directory, exist_ok=True)
+
+    def tearDown(self) -> None:
+
+        shutil.rmtree(self.test_directory)
+
+    def check_summary(self, summary: dict):
+
+        assert summary["reads"] == 3
+        assert summary["bases"] == 16
+        assert summary["n50"] == 10
+        assert summary["mean_qual"] == round((4 * 40 + 5 * 10 + 5 * 20) / 16, 2)
+        assert summary["length_hist"] == "0,1,1,1"
+
+    def test_feed_split_buffers(self):
+        data = b"".join(self.reads)
+
+        for buffer_size in [1, 7, len(data)]:
+            collector = FastqStatsCollector()
+
+            for start in range(0, len(data), buffer_size):
+                collector.feed(data[start: start + buffer_size])
+
+            self.check_summary(collector.summary())
+
+    def test_feed_compressed(self):
+        data = b"".join(gzip.compress(read) for read in self.reads)
+
+        collector = FastqStatsCollector()
+        for start in range(0, len(data), 5):
+            collector.feed_compressed(data[start: start + 5])
+
+        self.check_summary(collector.summary())
+
+    def test_feed_line_end_first(self):
+        collector = FastqStatsCollector()
+        collector.feed(b"@r1\nACGT\n+\nIIII")
+        collector.feed(b"\r")
+        collector.feed(b"\n" + b"".join(self.reads[:2]))
+
+        assert collector.reads == 3
+        assert collector.bases == 18
+
+        collector = FastqStatsCollector()
+        collector.feed(b"\n\n\n\n\r")
+
+        assert collector.reads == 1
+        assert collector.bases == 0
+        assert collector.leftover == b"\r"
+
+    def test_finish_no_final_newline(self):
+        data = b"".join(self.reads).rstrip(b"\r\n")
+
+        collector = FastqStatsCollector()
+        collector.feed_compressed(gzip.compress(data))
+
+        assert collector.reads == 2
+
+        self.check_summary(DirectoryProcessing.get_stats(collector))
+        self.check_summary(collector.finish().summary())
+
+        collector = FastqStatsCollector()
+        collector.feed(b"".join(self.reads) + b"@r4\nACGT\n+")
+
+        self.check_summary(collector.finish().summary())
+
+    def test_feed_compressed_trailing_garbage(self):
+        data = gzip.compress(b"".join(self.reads)) + b"\x00garbage"
+
+        collector = FastqStatsCollector()
+        collector.feed_compressed(data)
+
+        assert collector.skipped is True
+        assert collector.skip_reason.startswith("gzip data not readable")
+        assert DirectoryProcessing.get_stats(collector) is None
+
+        source = f"{self.test_directory}/test_0.fastq.gz"
+        destination = f"{self.test_directory}/merged.fastq.gz"
+        with open(source, "wb") as f:
+            f.write(data)
+
+        collector = FastqStatsCollector()
+        with self.assertRaises(EOFError):
+            Utils.append_file_to_gz(source, destination, collector=collector)
+
+        assert not os.path.exists(destination)
+
+    def test_append_file_to_gz_stats(self):
+        destination = f"{self.test_directory}/merged.fastq.gz"
+
+        with open(f"{self.test_directory}/test_0.fastq", "wb") as f:
+            f.write(b"".join(self.reads[:2]))
+        with gzip.open(f"{self.test_directory}/test_1.fastq.gz", "wb") as f:
+            f.write(self.reads[2])
+
+        collectors = [FastqStatsCollector(), FastqStatsCollector()]
+        Utils.append_file_to_gz(
+            f"{self.test_directory}/test_0.fastq", destination, collector=collectors[0])
+        Utils.append_file_to_gz(
+            f"{self.test_directory}/test_1.fastq.gz", destination, collector=collectors[1])
+
+        assert collectors[0].reads == 2
+        assert collectors[1].reads == 1
+        assert collectors[0].bases + collectors[1].bases == 16
+
+        with gzip.open(destination, "rb") as f:
+            assert f.read() == b"".join(self.reads)
+
+
+class TestFastqDirectoryIndex(unittest.TestCase):
+    test_directory = "tests_index/"
+
+    def setUp(self) -> None:
+
+        os.makedirs(f"{self.test_directory}/barcode01", exist_ok=True)
+
+    def tearDown(self) -> None:
+
+        shutil.rmtree(self.test_directory)
+
+    def test_get_seq_files(self):
+
+        index = FastqDirectoryIndex()
+        barcode_dir = f"{self.test_directory}/barcode01"
+
+        assert index.get_seq_files(barcode_dir) == []
+
+        for chunk in ["run_10.fastq.gz", "run_2.fastq.gz", "notes.txt"]:
+            open(f"{barcode_dir}/{chunk}", "w").close()
+
+        assert index.get_seq_files(barcode_dir) == [
+            "run_2.fastq.gz", "run_10.fastq.gz"]
+
+        open(f"{barcode_dir}/run_3.fastq.gz", "w").close()
+
+        assert index.get_seq_files(barcode_dir) == [
+            "run_2.fastq.gz", "run_3.fastq.gz", "run_10.fastq.gz"]
+
+    def test_unchanged_directory_not_listed(self):
+
+        index = FastqDirectoryIndex()
+        barcode_dir = f"{self.test_directory}/barcode01"
+        open(f"{barcode_dir}/run_1.fastq", "w").close()
+
+        index.mtime_margin_ns = -1
+        assert index.get_seq_files(barcode_dir) == ["run_1.fastq"]
+
+        index.seq_files[barcode_dir] = ["cached.fastq"]
+        assert index.get_seq_files(barcode_dir) == ["cached.fastq"]
+
+    def test_subdirectories(self):
+
+        index = FastqDirectoryIndex()
+
+        assert index.get_subdirectories(self.test_directory) == [
+            os.path.join(self.test_directory, "barcode01")]
+        assert index.seqs_in_dir(self.test_directory) is False
+        assert index.seqs_in_subdir(self.test_directory) is False
+
+        open(f"{self.test_directory}/barcode01/run_1.fastq", "w").close()
+
+        assert index.seqs_in_subdir(self.test_directory) is True
+
 
 class TestProcessed(unittest.TestCase):
     test_directory = "tests/"
@@ -339,6 +1305,34 @@ class TestProcessed(unittest.TestCase):
         assert self.processed.get_file_time("test.fastq", "tests/") == 0
         self.processed.delete_records()
 
+    def test_validate_tail(self):
+        self.processed.delete_records()
+        os.makedirs(self.test_directory, exist_ok=True)
+
+        merged = [f"{self.test_directory}sample_01-0{ix}.fastq.gz" for ix in range(3)]
+        for merged_file in merged[:2]:
+            with gzip.open(merged_file, "wb") as f:
+                f.write(b"@r1\nACGT\n+\nIIII\n")
+
+        for ix, merged_file in enumerate(merged):
+            self.processed.update(f"test{ix}.fastq", "tests/", ix, merged_file)
+
+        assert self.processed.validate_tail() == 1
+        assert len(self.processed) == 2
+        assert self.processed.get_id_merged_last("sample") == merged[1]
+        assert not self.processed.file_exists("test2.fastq", "tests/")
+        assert self.processed.validate_tail() == 0
+
+        with open(merged[1], "r+b") as f:
+            f.truncate(os.path.getsize(merged[1]) - 4)
+
+        assert self.processed.is_valid_merged(merged[0]) is True
+        assert self.processed.is_valid_merged(merged[1]) is False
+        assert self.processed.validate_tail() == 1
+        assert self.processed.get_id_merged_last("sample") == merged[0]
+
+        self.processed.delete_records()
+
     def test_get_dir_merged_last(self):
 
         self.processed.update("test.fastq", "tests/", 0, "merged.fastq")
@@ -359,7 +1353,7 @@ class TestProcessed(unittest.TestCase):
 
     def test_file_exists(self):
 
-        self.processed.processed = pd.DataFrame(
+        processed = pd.DataFrame(
             columns=[
                 "fastq",
                 "dir",
@@ -368,7 +1362,143 @@ class TestProcessed(unittest.TestCase):
                 "merged",
             ]
         )
-        self.processed.processed.loc[0] = [
+        processed.loc[0] = [
             "test.fastq", "tests/", "barcode", 0, False]
+        self.processed.processed = processed
         assert self.processed.file_exists("test.fastq", "tests/") == True
         self.processed.delete_records()
+
+    def test_get_dir_barcode_first(self):
+
+        self.processed.delete_records()
+        self.processed.update("test_03.fastq", "tests/", 2, "merged2.fastq")
+        self.processed.update("test_01.fastq", "tests/", 1, "merged1.fastq")
+
+        assert self.processed.get_dir_barcode_first("tests/") == "01"
+        assert self.processed.get_dir_barcode_first("other/") == ""
+        assert self.processed.generate_barcode("tests/") == "02"
+        self.processed.delete_records()
+
+    def test_get_id_merged_last(self):
+
+        self.processed.delete_records()
+        self.processed.update("test.fastq", "tests/", 0, "sample_00-00.fastq.gz")
+        self.processed.update("test2.fastq", "tests/", 1, "sample_00-01.fastq.gz")
+
+        assert self.processed.get_id_merged_last(
+            "sample") == "sample_00-01.fastq.gz"
+        assert self.processed.get_id_merged_last("other") == ""
+        self.processed.delete_records()
+
+    def test_processed_dataframe(self):
+
+        self.processed.delete_records()
+        self.processed.update("test.fastq", "tests/", 0, "merged.fastq")
+
+        assert len(self.processed.processed) == 1
+
+        self.processed.update("test2.fastq", "tests/", 1, "merged2.fastq")
+
+        assert len(self.processed.processed) == 2
+        assert self.processed.processed.fastq.tolist() == [
+            "test.fastq", "test2.fastq"]
+        self.processed.delete_records()
+
+    def test_export_journal(self):
+
+        journal_dir = "tests_journal/"
+        os.makedirs(journal_dir, exist_ok=True)
+
+        processed = Processed(journal_dir)
+        processed.update("test.fastq", "tests/", 0, "merged.fastq")
+        processed.export(journal_dir)
+
+        assert os.path.exists(processed.processed_file) is True
+        assert processed.dirty is False
+
+        processed.update("test2.fastq", "tests/", 1, "merged2.fastq")
+        processed.export(journal_dir)
+
+        assert os.path.exists(processed.journal_file) is True
+        assert len(pd.read_csv(processed.processed_file, sep="\t")) == 1
+
+        with open(processed.journal_file, "a") as journal:
+            journal.write("sample\ttest3.fastq")
+
+        replayed = Processed(journal_dir)
+        assert replayed.processed.fastq.tolist() == [
+            "test.fastq", "test2.fastq"]
+        assert replayed.get_id_merged_last("merged2.fastq") == "merged2.fastq"
+
+        replayed.compact()
+        assert os.path.exists(replayed.journal_file) is False
+        assert len(pd.read_csv(replayed.processed_file, sep="\t")) == 2
+
+        shutil.rmtree(journal_dir)
+
+    def test_compact_interrupted(self):
+
+        journal_dir = "tests_journal/"
+        os.makedirs(journal_dir, exist_ok=True)
+
+        processed = Processed(journal_dir)
+        processed.update("test.fastq", "tests/", 0, "sample_00-00.fastq.gz")
+        processed.export(journal_dir)
+        processed.update("test2.fastq", "tests/", 1, "sample_00-01.fastq.gz")
+        processed.export(journal_dir)
+
+        # crash after the processed file is replaced, before the journal is removed
+        processed.processed.to_csv(
+            processed.processed_file, sep="\t", index=False)
+        assert os.path.exists(processed.journal_file) is True
+
+        replayed = Processed(journal_dir)
+        assert replayed.processed.fastq.tolist() == [
+            "test.fastq", "test2.fastq"]
+        assert replayed.generate_barcode("tests/") == "02"
+
+        replayed.update("test3.fastq", "tests/", 2, "sample_00-02.fastq.gz")
+        replayed.export(journal_dir)
+
+        assert Processed(journal_dir).processed.fastq.tolist() == [
+            "test.fastq", "test2.fastq", "test3.fastq"]
+
+        shutil.rmtree(journal_dir)
+
+
+class TestWatchers(unittest.TestCase):
+    test_directory = "tests_watch/"
+
+    def setUp(self) -> None:
+
+        os.makedirs(f"{self.test_directory}/barcode01", exist_ok=True)
+
+    def tearDown(self) -> None:
+
+        shutil.rmtree(self.test_directory)
+
+    def test_polling_watcher(self):
+
+        watcher = get_directory_watcher(self.test_directory, watch=False)
+
+        assert isinstance(watcher, PollingWatcher)
+        assert watcher.wait(0) is True
+
+    @unittest.skipUnless(sys.platform == "linux", "inotify is linux only")
+    def test_inotify_watcher(self):
+
+        watcher = InotifyWatcher(self.test_directory)
+        watcher.debounce = 0.01
+
+        assert watcher.wait(0.01) is False
+
+        open(f"{self.test_directory}/barcode01/test.fastq", "w").close()
+        assert watcher.wait(1) is True
+
+        os.makedirs(f"{self.test_directory}/barcode02")
+        assert watcher.wait(1) is True
+
+        open(f"{self.test_directory}/barcode02/test.fastq", "w").close()
+        assert watcher.wait(1) is True
+
+        watcher.close()
@@ -1,13 +1,41 @@
+import bisect
+import contextlib
+import gzip
+import hashlib
+import io
 import itertools as it
 import os
 import shutil
+import time
+import zlib
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
 
-from natsort import natsorted
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+from natsort import natsort_keygen, natsorted
 from xopen import xopen
 
+from fastq_handler.bgzf import BlockIndex
+from fastq_handler.compression import GzipCodec, get_default_codec
+from fastq_handler.fastq_stats import FastqStatsCollector
+
 
 class ConstantsSettings:
 
+    gzip_magic = b"\x1f\x8b"
+    gzip_deflate_method = 8
+    gzip_reserved_flags = 0xE0
+    gzip_compresslevel = 3
+    gzip_wbits = 31
+    gzip_member_start = b"\x1f\x8b\x08"
+    gzip_min_member_size = 20
+    copy_buffer_size = 1024 * 1024
+    ficlone_request = 0x40049409  # linux FICLONE ioctl
+    subsample_key_size = 8
+
     seq_extentions = [".fastq", ".fq"]
     gzip_extentions = ["", ".gz"]
 
@@ -24,8 +52,52 @@ class ConstantsSettings:
         return possible_extentions
 
 
+SEQ_FILE_EXTENTIONS = tuple(ConstantsSettings().possible_extentions)
+
+
+class TeeFile(io.RawIOBase):
+    """
+    local file also writing every byte to a second stream, e.g. an upload.
+    file descriptor and name are the local file's, the tee is left open.
+    """
+
+    def __init__(self, fileobj: BinaryIO, tee: BinaryIO):
+        super().__init__()
+        self.fileobj = fileobj
+        self.tee = tee
+
+    @property
+    def name(self):
+        return self.fileobj.name
+
+    def fileno(self) -> int:
+        return self.fileobj.fileno()
+
+    def writable(self):
+        return True
+
+    def write(self, data) -> int:
+        n_bytes = self.fileobj.write(data)
+        self.tee.write(bytes(data))
+
+        return n_bytes
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        if self.closed:
+            return
+
+        super().close()
+        self.fileobj.close()
+
+
 class Utils:
 
+    part_suffix = ".part"
+    stale_suffixes = (part_suffix, ".tmp")
+
     def __init__(self):
         pass
 
@@ -63,45 +135,29 @@ class Utils:
         """
         Check if there are any fastq files in the directory
         """
-        ext = ""
-        constans = ConstantsSettings()
-
-        path_content = os.listdir(fastq_dir)
-
-        for element in path_content:
-            if os.path.isfile(
-                os.path.join(fastq_dir, element)
-            ):
-                if self.check_extention(element, constans.possible_extentions):
-
+        with os.scandir(fastq_dir) as path_content:
+            for element in path_content:
+                if element.name.endswith(SEQ_FILE_EXTENTIONS) and element.is_file():
                     return True
 
         return False
 
     def seqs_in_subdir(self, fastq_dir: str):
-        path_content = os.listdir(fastq_dir)
-
-        for element in path_content:
-            element_path = os.path.join(fastq_dir, element)
-            if os.path.isdir(element_path):
-                if self.seqs_in_dir(
-                    element_path
-                ):
-                    return True
+
+        for element_path in self.get_subdirectories(fastq_dir):
+            if self.seqs_in_dir(
+                element_path
+            ):
+                return True
 
         return False
 
     @staticmethod
     def get_subdirectories(fastq_dir: str):
-        path_content = os.listdir(fastq_dir)
 
-        subdirs = []
-        for element in path_content:
-            element_path = os.path.join(fastq_dir, element)
-            if os.path.isdir(element_path):
-                subdirs.append(
-                    element_path
-                )
+        with os.scandir(fastq_dir) as path_content:
+            subdirs = [
+                element.path for element in path_content if element.is_dir()]
 
         return subdirs
 
@@ -119,12 +175,10 @@ class Utils:
         Takes:                  Returns:
             str                     list
         """
-        constants_settings = ConstantsSettings()
-        possible_extentions = constants_settings.possible_extentions
         cur_files = os.listdir(cwd)
 
-        cur_files = [file for file in cur_files if self.check_extention(
-            file, possible_extentions)]
+        cur_files = [
+            file for file in cur_files if file.endswith(SEQ_FILE_EXTENTIONS)]
 
         cur_files = natsorted(cur_files)
 
@@ -133,18 +187,607 @@ class Utils:
     ########################          3 - Reading          ########################
 
     @staticmethod
-    def append_file_to_gz(filepath, filedest):
+    def is_gzip_file(filepath: str) -> bool:
+        """
+        check the gzip member header of filepath: magic bytes, deflate method
+        and reserved flag bits. does not decompress.
+        """
+        try:
+            with open(filepath, 'rb') as f_in:
+                header = f_in.read(4)
+        except IsADirectoryError:
+            return False
+
+        if len(header) < 4:
+            return False
+
+        if header[:2] != ConstantsSettings.gzip_magic:
+            return False
+
+        if header[2] != ConstantsSettings.gzip_deflate_method:
+            return False
+
+        return header[3] & ConstantsSettings.gzip_reserved_flags == 0
+
+    @staticmethod
+    def gzip_members_end(f_in: BinaryIO, start: int) -> Optional[bool]:
+        """
+        decompress gzip members from offset start of f_in, crc and size are
+        checked by zlib. True if they end exactly at the end of the file,
+        False if a member was complete but what follows it is not,
+        None if no member could be completed from start."""
+
+        f_in.seek(start)
+        decompressor = zlib.decompressobj(ConstantsSettings.gzip_wbits)
+        members = 0
+        started = False
+        pending = b""
+
+        while True:
+            data = pending or f_in.read(ConstantsSettings.copy_buffer_size)
+            pending = b""
+
+            if not data:
+                break
+
+            started = True
+
+            try:
+                decompressor.decompress(data)
+            except zlib.error:
+                return False if members else None
+
+            if decompressor.eof:
+                members += 1
+                pending = decompressor.unused_data
+                decompressor = zlib.decompressobj(
+                    ConstantsSettings.gzip_wbits)
+                started = False
+
+        if not members:
+            return None
+
+        return not started
+
+    @staticmethod
+    def is_gzip_complete(filepath: str) -> bool:
+        """
+        check that filepath ends with a complete gzip member, e.g. was not
+        cut short by a crash. the last member boundary is searched from the
+        end of the file, only the members after it are decompressed."""
+
+        file_size = os.path.getsize(filepath)
+        window = ConstantsSettings.copy_buffer_size
+        window_end = file_size
+
+        if file_size < ConstantsSettings.gzip_min_member_size:
+            return False
+
+        with open(filepath, 'rb') as f_in:
+            while window_end > 0:
+                window_start = max(0, window_end - window)
+                f_in.seek(window_start)
+                block = f_in.read(
+                    window_end - window_start + len(ConstantsSettings.gzip_member_start) - 1)
+
+                limit = len(block)
+                while True:
+                    position = block.rfind(
+                        ConstantsSettings.gzip_member_start, 0, limit)
+                    if position < 0:
+                        break
+
+                    limit = position + len(ConstantsSettings.gzip_member_start) - 1
+                    if window_start + position >= window_end:
+                        continue
+
+                    members_end = Utils.gzip_members_end(
+                        f_in, window_start + position)
+                    if members_end is not None:
+                        return members_end
+
+                window_end = window_start
+                window *= 2
+
+        return False
+
+    @staticmethod
+    def copy_stream(f_in, f_out, collector: Optional[FastqStatsCollector] = None, compressed: bool = False):
+        """
+        Copies f_in to f_out in buffers, feeding each buffer to collector.
+        compressed buffers are decompressed for the collector only."""
+
+        if collector is None:
+            shutil.copyfileobj(f_in, f_out, ConstantsSettings.copy_buffer_size)
+            return
+
+        while True:
+            buffer = f_in.read(ConstantsSettings.copy_buffer_size)
+            if not buffer:
+                break
+
+            f_out.write(buffer)
+
+            if compressed:
+                collector.feed_compressed(buffer)
+            else:
+                collector.feed(buffer)
+
+    @staticmethod
+    def open_append(filedest, tee: Optional[BinaryIO] = None) -> BinaryIO:
+        """
+        filedest opened for appending, written to tee as well if given"""
+
+        f_out = open(filedest, 'ab')
+
+        if tee is None:
+            return f_out
+
+        return TeeFile(f_out, tee)
+
+    @staticmethod
+    def is_raw_appendable(filepath: str, codec: GzipCodec) -> bool:
+        """
+        filepath can be appended as raw gzip members: the codec allows it and
+        the file is gzip ending with a complete member. others go through the
+        decompress path, which fails on a truncated file."""
+
+        return codec.raw_append and Utils.is_gzip_file(filepath) \
+            and Utils.is_gzip_complete(filepath)
+
+    @staticmethod
+    def append_gz_raw(filepath, filedest, collector: Optional[FastqStatsCollector] = None,
+                      tee: Optional[BinaryIO] = None):
+        """
+        Appends the gzip file 'filepath' to filedest byte for byte.
+        gzip allows several members in one file, so no recompression is needed.
+        a file not ending with a complete member is rejected, nothing is written."""
+
+        if not Utils.is_gzip_complete(filepath):
+            raise EOFError(f"gzip file not complete: {filepath}")
+
+        with open(filepath, 'rb') as f_in:
+            with Utils.open_append(filedest, tee) as f_out:
+                Utils.copy_stream(f_in, f_out, collector, compressed=True)
+
+    @staticmethod
+    def sha256_file(filepath, prefix_size: Optional[int] = None) -> Tuple[str, Optional[str]]:
+        """
+        sha256 hex digest of filepath and, if prefix_size is given,
+        of its first prefix_size bytes, in one read."""
+
+        digest = hashlib.sha256()
+        prefix_digest = None
+        position = 0
+
+        with open(filepath, 'rb') as f_in:
+            while True:
+                size = ConstantsSettings.copy_buffer_size
+                if prefix_size is not None and position < prefix_size:
+                    size = min(size, prefix_size - position)
+
+                buffer = f_in.read(size)
+
+                if prefix_size is not None and position == prefix_size:
+                    prefix_digest = digest.hexdigest()
+
+                if not buffer:
+                    break
+
+                digest.update(buffer)
+                position += len(buffer)
+
+        return digest.hexdigest(), prefix_digest
+
+    @staticmethod
+    def clone_file(filepath, filedest) -> str:
+        """
+        Copies 'filepath' to filedest sharing data blocks where the filesystem allows it.
+        tries a reflink (FICLONE), then in-kernel os.copy_file_range, then a plain copy.
+        returns the method used."""
+
+        with open(filepath, 'rb') as f_in:
+            with open(filedest, 'wb') as f_out:
+
+                if fcntl is not None:
+                    try:
+                        fcntl.ioctl(
+                            f_out.fileno(), ConstantsSettings.ficlone_request, f_in.fileno())
+                        return "reflink"
+                    except OSError:
+                        pass
+
+                if hasattr(os, "copy_file_range"):
+                    size = os.fstat(f_in.fileno()).st_size
+                    copied = 0
+                    try:
+                        while copied < size:
+                            n_bytes = os.copy_file_range(
+                                f_in.fileno(), f_out.fileno(), size - copied)
+                            if n_bytes == 0:
+                                break
+                            copied += n_bytes
+                    except OSError:
+                        pass
+
+                    if copied == size:
+                        return "copy_file_range"
+
+                    f_in.seek(0)
+                    f_out.seek(0)
+                    f_out.truncate()
+
+                shutil.copyfileobj(
+                    f_in, f_out, ConstantsSettings.copy_buffer_size)
+
+        return "copy"
+
+    @staticmethod
+    def link_file(filepath, filedest) -> str:
+        """
+        Makes filedest an identical copy of 'filepath' without copying data where possible.
+        tries a hard link, then clone_file. filedest is replaced atomically.
+        returns the method used."""
+
+        tmp_file = filedest + ".tmp"
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+        try:
+            try:
+                os.link(filepath, tmp_file)
+                method = "hardlink"
+            except OSError:
+                method = Utils.clone_file(filepath, tmp_file)
+
+            os.replace(tmp_file, filedest)
+
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+        return method
+
+    @staticmethod
+    def get_size(filepath) -> Optional[int]:
+        """
+        file size, None if missing"""
+
+        try:
+            return os.path.getsize(filepath)
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def restore_size(filepath, size: Optional[int]):
+        """
+        Undoes a failed append: truncates filepath back to size, removes it if it
+        did not exist. a block index written alongside no longer matches and is removed."""
+
+        if size is None:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+        else:
+            os.truncate(filepath, size)
+
+        BlockIndex.remove(filepath)
+
+    @staticmethod
+    def get_part_path(filedest) -> str:
+        return filedest + Utils.part_suffix
+
+    @staticmethod
+    def discard_part(filedest):
+        """
+        remove a partial write of filedest left by an interrupted run"""
+
+        part_file = Utils.get_part_path(filedest)
+
+        if os.path.exists(part_file):
+            os.remove(part_file)
+
+        BlockIndex.remove(part_file)
+
+    @staticmethod
+    def remove_stale_parts(directory) -> int:
         """
-        Copies the file 'filepath' to gzip file filedest."""
+        remove partial writes of sequence files below directory, and their
+        block indexes, left by an interrupted run. return the count"""
+
+        removed = 0
+
+        for root, _, files in os.walk(directory):
+            for file in files:
+                stem = file[:-len(BlockIndex.suffix)] \
+                    if file.endswith(BlockIndex.suffix) else file
+
+                if not stem.endswith(Utils.stale_suffixes):
+                    continue
+
+                if not os.path.splitext(stem)[0].endswith(SEQ_FILE_EXTENTIONS):
+                    continue
+
+                os.remove(os.path.join(root, file))
+                removed += 1
+
+        return removed
+
+    @staticmethod
+    def commit_part(filedest):
+        """
+        move the finished part file, and its block index if any, over filedest"""
+
+        part_file = Utils.get_part_path(filedest)
+
+        BlockIndex.remove(filedest)
+        os.replace(part_file, filedest)
+
+        if os.path.exists(BlockIndex.get_path(part_file)):
+            os.replace(BlockIndex.get_path(part_file),
+                       BlockIndex.get_path(filedest))
+
+    @staticmethod
+    def append_file_to_gz(filepath, filedest, codec: Optional[GzipCodec] = None,
+                          collector: Optional[FastqStatsCollector] = None,
+                          tee: Optional[BinaryIO] = None):
+        """
+        Copies the file 'filepath' to gzip file filedest.
+        gzip input is appended as raw members if the codec allows it,
+        other input is compressed with codec.
+        collector, if given, sees the fastq data on the way,
+        tee, if given, gets the bytes written to filedest."""
+
+        if codec is None:
+            codec = get_default_codec()
+
+        pre_size = Utils.get_size(filedest)
 
         try:
+            if Utils.is_raw_appendable(filepath, codec):
+                with open(filepath, 'rb') as f_in:
+                    with Utils.open_append(filedest, tee) as f_out:
+                        Utils.copy_stream(
+                            f_in, f_out, collector, compressed=True)
+                return
+
             with xopen(filepath, 'rb') as f_in:
-                with xopen(filedest, 'ab', threads=0, compresslevel=3) as f_out:
-                    shutil.copyfileobj(f_in, f_out)
+                with Utils.open_append(filedest, tee) as f_out:
+                    with codec.open_writer(f_out) as compressor:
+                        Utils.copy_stream(f_in, compressor, collector)
+
+        except FileNotFoundError:
+            Utils.restore_size(filedest, pre_size)
+            print("File not found: ", filepath)
+            raise FileNotFoundError
+
+        except BaseException:
+            Utils.restore_size(filedest, pre_size)
+            raise
+
+    @staticmethod
+    def append_files_to_gz(filepaths: List[str], filedest, codec: Optional[GzipCodec] = None,
+                           collectors: Optional[List[FastqStatsCollector]] = None,
+                           tee: Optional[BinaryIO] = None):
+        """
+        Copies the files 'filepaths' to gzip file filedest, opening it once.
+        gzip inputs are appended as raw members if the codec allows it,
+        consecutive other inputs are compressed with codec into a single member.
+        collectors, if given, has one collector per file, tee gets the bytes written."""
+
+        if codec is None:
+            codec = get_default_codec()
+
+        if collectors is None:
+            collectors = [None] * len(filepaths)
+
+        filepath = None
+        pre_size = Utils.get_size(filedest)
+
+        try:
+            with Utils.open_append(filedest, tee) as f_out:
+                compressor = None
+
+                for filepath, collector in zip(filepaths, collectors):
+                    if Utils.is_raw_appendable(filepath, codec):
+                        if compressor is not None:
+                            compressor.close()
+                            compressor = None
+
+                        with open(filepath, 'rb') as f_in:
+                            Utils.copy_stream(
+                                f_in, f_out, collector, compressed=True)
+                        continue
+
+                    if compressor is None:
+                        compressor = codec.open_writer(f_out)
+
+                    with xopen(filepath, 'rb') as f_in:
+                        Utils.copy_stream(f_in, compressor, collector)
+
+                if compressor is not None:
+                    compressor.close()
 
         except FileNotFoundError:
+            Utils.restore_size(filedest, pre_size)
             print("File not found: ", filepath)
             raise FileNotFoundError
 
-        except KeyboardInterrupt:
-            os.remove(filedest)
+        except BaseException:
+            Utils.restore_size(filedest, pre_size)
+            raise
+
+    @staticmethod
+    @contextlib.contextmanager
+    def open_reads(filepath, offset: int = 0) -> Iterator[BinaryIO]:
+        """
+        fastq reads of filepath, decompressed. offset, a gzip member
+        boundary, skips the members before it."""
+
+        if offset == 0:
+            with xopen(filepath, 'rb') as f_in:
+                yield f_in
+            return
+
+        with open(filepath, 'rb') as f_in:
+            f_in.seek(offset)
+
+            with gzip.GzipFile(fileobj=f_in, mode='rb') as reads:
+                yield reads
+
+    @staticmethod
+    def subsample_key(header: bytes, seed: bytes = b"") -> float:
+        """
+        hash of a read header in [0, 1), the same for the same read and seed"""
+
+        digest = hashlib.blake2b(
+            header, digest_size=ConstantsSettings.subsample_key_size, key=seed).digest()
+
+        return int.from_bytes(digest, "big") / (1 << (8 * ConstantsSettings.subsample_key_size))
+
+    @staticmethod
+    def subsample_fastq(sources: List[Tuple[str, int]], filedest, fraction: float, seed: str = "",
+                        codec: Optional[GzipCodec] = None) -> int:
+        """
+        Writes a random subset of the reads of sources, (file, gzip member offset)
+        pairs, to gzip file filedest in one pass. a read is kept if the hash of its
+        header is below fraction, so a subsample is a subset of any subsample of the
+        same reads at a larger fraction and can be subsampled again in place of them.
+        a source that is itself a subsample at a lower fraction lowers it for the
+        sources after it, the sample stays uniform. returns the number of reads kept."""
+
+        if codec is None:
+            codec = get_default_codec()
+
+        seed_key = seed.encode()[:hashlib.blake2b.MAX_KEY_SIZE]
+        tmp_file = filedest + ".tmp"
+        kept = 0
+
+        try:
+            with open(tmp_file, 'wb') as f_out:
+                with codec.open_writer(f_out) as compressor:
+
+                    for filepath, offset in sources:
+                        highest = None
+
+                        with Utils.open_reads(filepath, offset) as f_in:
+                            for read in zip(f_in, f_in, f_in, f_in):
+                                key = Utils.subsample_key(read[0], seed_key)
+
+                                if highest is None or key > highest:
+                                    highest = key
+
+                                if key >= fraction:
+                                    continue
+
+                                compressor.write(b"".join(read))
+                                kept += 1
+
+                        if highest is not None:
+                            fraction = min(fraction, highest)
+
+            os.replace(tmp_file, filedest)
+
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+        return kept
+
+
+class FastqDirectoryIndex:
+    """
+    persistent index of sequence files and subdirectories, listed with os.scandir.
+    directories whose mtime did not change since the last scan are not listed again,
+    new files are inserted into the natsorted file list.
+    """
+
+    # directories modified this close to the last scan are listed again,
+    # filesystem mtimes can be coarser than the time between two changes.
+    mtime_margin_ns = 1_000_000_000
+
+    def __init__(self):
+        self.seq_files: Dict[str, List[str]] = {}
+        self.sort_keys: Dict[str, list] = {}
+        self.subdirs: Dict[str, List[str]] = {}
+        self.scanned: Dict[str, Tuple[int, int]] = {}
+        self.sort_key = natsort_keygen()
+
+    def is_current(self, directory: str, mtime_ns: int) -> bool:
+        """
+        check directory did not change since last scan
+        """
+        if directory not in self.scanned:
+            return False
+
+        scan_mtime_ns, scan_time_ns = self.scanned[directory]
+
+        return mtime_ns == scan_mtime_ns and scan_time_ns - mtime_ns > self.mtime_margin_ns
+
+    def insert_seq_file(self, directory: str, file_name: str):
+        """
+        insert file keeping natsort order
+        """
+        file_key = self.sort_key(file_name)
+        position = bisect.bisect(self.sort_keys[directory], file_key)
+
+        self.sort_keys[directory].insert(position, file_key)
+        self.seq_files[directory].insert(position, file_name)
+
+    def scan(self, directory: str):
+        """
+        list directory if changed
+        """
+        mtime_ns = os.stat(directory).st_mtime_ns
+
+        if self.is_current(directory, mtime_ns):
+            return self
+
+        scan_time_ns = time.time_ns()
+        seq_files = []
+        subdirs = []
+
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    subdirs.append(entry.path)
+
+                elif entry.name.endswith(SEQ_FILE_EXTENTIONS) and entry.is_file():
+                    seq_files.append(entry.name)
+
+        known_files = set(self.seq_files.get(directory, []))
+
+        if known_files.issubset(seq_files):
+            self.seq_files.setdefault(directory, [])
+            self.sort_keys.setdefault(directory, [])
+
+            for file_name in seq_files:
+                if file_name not in known_files:
+                    self.insert_seq_file(directory, file_name)
+
+        else:
+            self.seq_files[directory] = natsorted(seq_files)
+            self.sort_keys[directory] = [
+                self.sort_key(file_name) for file_name in self.seq_files[directory]]
+
+        self.subdirs[directory] = subdirs
+        self.scanned[directory] = (mtime_ns, scan_time_ns)
+
+        return self
+
+    def get_seq_files(self, directory: str) -> List[str]:
+        """
+        natsorted sequence file names in directory
+        """
+        return list(self.scan(directory).seq_files[directory])
+
+    def get_subdirectories(self, directory: str) -> List[str]:
+        """
+        subdirectory paths of directory
+        """
+        return list(self.scan(directory).subdirs[directory])
+
+    def seqs_in_dir(self, directory: str) -> bool:
+        return len(self.scan(directory).seq_files[directory]) > 0
+
+    def seqs_in_subdir(self, directory: str) -> bool:
+        return any(self.seqs_in_dir(subdir) for subdir in self.get_subdirectories(directory))
@@ -0,0 +1,203 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, List, Tuple
+
+
+class DirectoryWatcher(ABC):
+    """
+    abstract class to wait for changes in the fastq directory
+    """
+
+    @abstractmethod
+    def wait(self, timeout: float) -> bool:
+        """
+        block until files change or timeout, return True if changes were seen
+        """
+        pass
+
+    def close(self):
+        """
+        release resources
+        """
+        pass
+
+
+class PollingWatcher(DirectoryWatcher):
+    """
+    sleep for the full timeout, caller re-lists directories
+    """
+
+    def wait(self, timeout: float) -> bool:
+        time.sleep(timeout)
+        return True
+
+
+class InotifyWatcher(DirectoryWatcher):
+    """
+    linux inotify watcher on the fastq directory and its barcode subdirectories.
+    wakes on IN_CLOSE_WRITE / IN_MOVED_TO, bursts are debounced.
+    """
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    watch_mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    event_header = struct.Struct("iIII")
+    read_size = 64 * 1024
+
+    debounce = 0.2
+    max_debounce = 2
+
+    def __init__(self, fastq_dir: str):
+        self.fastq_dir = fastq_dir
+        self.watches: Dict[int, str] = {}
+
+        libc_name = ctypes.util.find_library("c") or "libc.so.6"
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+        try:
+            self.add_watch(fastq_dir)
+
+            for entry in os.scandir(fastq_dir):
+                if entry.is_dir():
+                    self.add_watch(entry.path)
+
+        except OSError:
+            self.close()
+            raise
+
+    def add_watch(self, path: str):
+        """
+        add inotify watch on path
+        """
+        wd = self.libc.inotify_add_watch(
+            self.fd, os.fsencode(path), self.watch_mask)
+
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+
+        self.watches[wd] = path
+
+    def read_events(self) -> List[Tuple[int, int, str]]:
+        """
+        read pending events, return (wd, mask, name)
+        """
+        events = []
+
+        try:
+            buffer = os.read(self.fd, self.read_size)
+        except BlockingIOError:
+            return events
+
+        offset = 0
+        while offset + self.event_header.size <= len(buffer):
+            wd, mask, _, name_len = self.event_header.unpack_from(
+                buffer, offset)
+            offset += self.event_header.size
+
+            name = buffer[offset: offset + name_len].rstrip(b"\0")
+            offset += name_len
+
+            events.append((wd, mask, os.fsdecode(name)))
+
+        return events
+
+    def drain(self) -> bool:
+        """
+        handle pending events, watch new subdirectories.
+        return True if a file was closed or moved in, or a directory was created.
+        """
+        changed = False
+
+        for wd, mask, name in self.read_events():
+
+            if mask & self.IN_Q_OVERFLOW:
+                changed = True
+                continue
+
+            if mask & self.IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+
+            parent = self.watches.get(wd)
+            if parent is None:
+                continue
+
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    try:
+                        self.add_watch(os.path.join(parent, name))
+                    except OSError:
+                        pass
+                    changed = True
+                continue
+
+            if mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO):
+                changed = True
+
+        return changed
+
+    def wait(self, timeout: float) -> bool:
+        deadline = time.time() + timeout
+        changed = False
+
+        while not changed:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+
+            ready, _, _ = select.select([self.fd], [], [], remaining)
+            if not ready:
+                return False
+
+            changed = self.drain()
+
+        burst_end = time.time() + self.max_debounce
+
+        while time.time() < burst_end:
+            ready, _, _ = select.select([self.fd], [], [], self.debounce)
+            if not ready:
+                break
+
+            self.drain()
+
+        return True
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def get_directory_watcher(fastq_dir: str, watch: bool = True) -> DirectoryWatcher:
+    """
+    inotify watcher on linux, polling otherwise or if inotify is unavailable
+    """
+
+    if not watch or sys.platform != "linux":
+        return PollingWatcher()
+
+    try:
+        return InotifyWatcher(fastq_dir)
+
+    except (OSError, AttributeError) as error:
+        print("inotify unavailable, polling instead: ", error)
+        return PollingWatcher()
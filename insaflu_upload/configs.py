@@ -23,6 +23,7 @@ class InfluParams(RunParams):
     """
     deploy_televir: bool = False
     monitor: bool = False
+    stream_upload: bool = False
 
 
 @dataclass
@@ -1,8 +1,14 @@
 import configparser
+import hashlib
+import io
+import os
 import subprocess
 import sys
+import threading
+import time
 from abc import ABC, abstractmethod
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, List, Optional, Set
 
 import paramiko
 
@@ -21,6 +27,12 @@ class Connector(ABC):
     def execute_command(self, command: str) -> str:
         pass
 
+    @abstractmethod
+    def execute_commands(self, commands: List[str]) -> List[str]:
+        """
+        run commands concurrently, outputs in order"""
+        pass
+
     @abstractmethod
     def check_file_exists(self, file_path: str) -> bool:
         pass
@@ -29,10 +41,22 @@ class Connector(ABC):
     def upload_file(self, file_path: str, remote_path: str):
         pass
 
+    @abstractmethod
+    def upload_file_range(self, file_path: str, remote_path: str, offset: int):
+        """
+        write file_path from offset on into remote_path at the same offset"""
+        pass
+
     @abstractmethod
     def download_file(self, file_path: str, remote_path: str):
         pass
 
+    @abstractmethod
+    def open_upload_stream(self, remote_path: str, offset: int = 0) -> "UploadStream":
+        """
+        remote_path written from offset on, its first offset bytes kept"""
+        pass
+
     @abstractmethod
     def __enter__(self):
         pass
@@ -42,13 +66,155 @@ class Connector(ABC):
         pass
 
 
+class UploadStream(io.RawIOBase):
+    """
+    writable remote file. a failed write is kept in error and later writes
+    are dropped, so a local write teeing to the stream is not interrupted.
+    bytes_written and seconds, time spent writing, measure the upload,
+    sha256 is the digest of the bytes written, to check the remote file.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.error: Optional[Exception] = None
+        self.bytes_written = 0
+        self.seconds = 0.0
+        self.digest = hashlib.sha256()
+
+    @property
+    def sha256(self) -> str:
+        return self.digest.hexdigest()
+
+    def writable(self):
+        return True
+
+    @abstractmethod
+    def write_remote(self, data: bytes):
+        pass
+
+    @abstractmethod
+    def close_remote(self):
+        pass
+
+    def write(self, data) -> int:
+        if self.error is None:
+            start = time.perf_counter()
+
+            try:
+                self.write_remote(data)
+                self.bytes_written += len(data)
+                self.digest.update(data)
+            except Exception as error:
+                self.error = error
+
+            self.seconds += time.perf_counter() - start
+
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+
+        super().close()
+        start = time.perf_counter()
+
+        try:
+            self.close_remote()
+        except Exception as error:
+            if self.error is None:
+                self.error = error
+
+        self.seconds += time.perf_counter() - start
+
+
+class SftpUploadStream(UploadStream):
+    """
+    remote file opened over sftp, pipelined writes
+    """
+
+    def __init__(self, connector: "ConnectorParamiko", remote_path: str, offset: int = 0):
+        super().__init__()
+
+        with connector:
+            self.remote_file = connector.get_sftp().open(
+                remote_path, "r+b" if offset else "wb")
+
+        self.remote_file.seek(offset)
+        self.remote_file.set_pipelined(True)
+
+    def write_remote(self, data: bytes):
+        self.remote_file.write(data)
+
+    def close_remote(self):
+        self.remote_file.close()
+
+
+class DockerUploadStream(UploadStream):
+    """
+    stdin of dd running in the container, writing from offset on
+    """
+
+    def __init__(self, server_name: str, remote_path: str, offset: int = 0):
+        super().__init__()
+
+        self.process = subprocess.Popen(
+            ["docker", "exec", "-i", server_name, "dd", f"of={remote_path}",
+             f"seek={offset}", "oflag=seek_bytes", "status=none"],
+            stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+
+    def write_remote(self, data: bytes):
+        self.process.stdin.write(data)
+
+    def close_remote(self):
+        self.process.stdin.close()
+
+        if self.process.wait() != 0:
+            raise OSError(
+                f"docker exec dd exited with code {self.process.returncode}")
+
+
 class ConnectorParamiko(Connector):
+    """
+    ssh connector keeping one session open: the transport is opened on first
+    use, kept alive and reopened if it drops. remote commands open a channel
+    on it, file transfers share one sftp client.
+    large files are uploaded in ranges over several sftp channels at once.
+    """
+
+    keepalive_interval = 30
+    max_channels = 8  # below the openssh MaxSessions default of 10
+    window_size = 16 * 1024 * 1024
+    max_packet_size = 64 * 1024
+    upload_streams = 4
+    parallel_upload_threshold = 64 * 1024 * 1024
+    upload_block_size = 1024 * 1024
+    ranges_suffix = ".ranges"
+    done_suffix = ".done"
+    resume_range_size = 64 * 1024 * 1024
+    sftp: Optional[paramiko.SFTPClient] = None
+    reconnect_lock = threading.Lock()
 
     def __init__(self, config_file: str) -> None:
         super().__init__()
         self.prep_input(config_file)
+        self.input_options(config_file)
         self.connect()
 
+    def input_options(self, config_file: str):
+        """
+        optional max_channels and upload_streams in the SSH section of the config file"""
+
+        config = configparser.ConfigParser()
+        config.read(config_file)
+
+        if "SSH" not in config:
+            return
+
+        self.max_channels = config["SSH"].getint(
+            "max_channels", self.max_channels)
+        self.upload_streams = config["SSH"].getint(
+            "upload_streams", self.upload_streams)
+
     def input_config(self, config_file: str):
 
         config = configparser.ConfigParser()
@@ -93,15 +259,74 @@ class ConnectorParamiko(Connector):
         self.conn.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         self.test_connection()
 
+    def is_connected(self) -> bool:
+        transport = self.conn.get_transport()
+
+        return transport is not None and transport.is_active()
+
+    def open_session(self):
+        """
+        (re)connect, keepalive on the transport"""
+
+        self.close()
+
+        self.conn.connect(
+            hostname=f"{self.ip_address}",
+            username=f"{self.username}",
+            pkey=self.rsa_key
+        )
+
+        transport = self.conn.get_transport()
+        transport.set_keepalive(self.keepalive_interval)
+        transport.default_window_size = self.window_size
+        transport.default_max_packet_size = self.max_packet_size
+
+    def close(self):
+        """
+        close sftp client and session"""
+
+        if self.sftp is not None:
+            self.sftp.close()
+            self.sftp = None
+
+        self.conn.close()
+
+    def get_sftp(self) -> paramiko.SFTPClient:
+        """
+        sftp client on the current session, opened once"""
+
+        if self.sftp is None or self.sftp.get_channel().closed or \
+                self.sftp.get_channel().get_transport() is not self.conn.get_transport():
+            self.sftp = self.conn.open_sftp()
+
+        return self.sftp
+
+    def call(self, call: Callable):
+        """
+        run call on the session. if it fails because the session
+        dropped, reconnect and retry once. only for calls safe to repeat,
+        remote commands are run with run_command."""
+
+        with self:
+            try:
+                return call()
+            except Exception:
+                if self.is_connected():
+                    raise
+
+            print("SSH session lost, reconnecting")
+            self.open_session()
+
+            return call()
+
     def __enter__(self):
 
+        if self.is_connected():
+            return self
+
         try:
 
-            self.conn.connect(
-                hostname=f"{self.ip_address}",
-                username=f"{self.username}",
-                pkey=self.rsa_key
-            )
+            self.open_session()
 
         except paramiko.ssh_exception.SSHException as error:
             print("SSH connection error")
@@ -118,20 +343,17 @@ class ConnectorParamiko(Connector):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.conn.close()
+        """
+        session is kept for the next call, see close"""
+        pass
 
     def test_connection(self) -> None:
         """
-        test using paramiko using rsa key. If successful, close connection, else exit
+        test using paramiko using rsa key. If successful, keep the session, else exit
         """
 
         try:
-            self.conn.connect(
-                hostname=f"{self.ip_address}",
-                username=f"{self.username}",
-                pkey=self.rsa_key
-            )
-            self.conn.close()
+            self.open_session()
         except Exception:
             print("Authentication failed, please verify your credentials")
             sys.exit(1)
@@ -142,43 +364,214 @@ class ConnectorParamiko(Connector):
 
         print("executing command: ", command)
 
-        with self as conn:
+        with self:
+            return self.run_command(command)
+
+    def open_channel(self) -> paramiko.Channel:
+        """
+        new channel on the session. if it can not be opened because the
+        session dropped, reconnect and open it again, no command ran yet."""
+
+        try:
+            return self.conn.get_transport().open_session()
+        except Exception:
+            if self.is_connected():
+                raise
+
+        with self.reconnect_lock:
+            if not self.is_connected():
+                print("SSH session lost, reconnecting")
+                self.open_session()
+
+        return self.conn.get_transport().open_session()
+
+    def run_command(self, command: str) -> str:
+        """
+        run command on a new channel of the session. a command is never
+        run twice, a session lost once it started raises."""
+
+        channel = self.open_channel()
+
+        try:
+            channel.exec_command(command)
+
+            with channel.makefile("rb") as stdout:
+                return stdout.read().decode("utf-8")
+        finally:
+            channel.close()
 
-            stdin, stdout, stderr = self.conn.exec_command(command)
-            stdout = stdout.read().decode("utf-8")
+    def execute_commands(self, commands: List[str]) -> List[str]:
+        """
+        run commands on parallel channels of the session, at most
+        max_channels at a time. outputs in order."""
+
+        if not commands:
+            return []
+
+        for command in commands:
+            print("executing command: ", command)
 
-            return stdout
+        with self, ThreadPoolExecutor(max_workers=min(self.max_channels, len(commands))) as executor:
+            return list(executor.map(self.run_command, commands))
 
     def check_file_exists(self, file_path: str) -> bool:
         """
         check file exists using paramiko"""
 
-        with self as conn:
+        def list_file():
             stdin, stdout, stderr = self.conn.exec_command(f"ls {file_path}")
+            return stdout.read().decode("utf-8")
 
-            if len(stdout.read().decode("utf-8")) > 0:
-                if "cannot access" in stdout.read().decode("utf-8"):
-                    return False
+        output = self.call(list_file)
 
-                return True
+        if len(output) > 0:
+            if "cannot access" in output:
+                return False
 
-            return False
+            return True
+
+        return False
 
     def upload_file(self, file_path: str, remote_path: str):
         """
-        upload file using paramiko"""
-        with self as conn:
-            ftp_client = self.conn.open_sftp()
-            ftp_client.put(file_path, remote_path)
-            ftp_client.close()
+        upload file using paramiko, in parallel ranges if large"""
+
+        if self.get_upload_streams(os.path.getsize(file_path)) > 1:
+            self.call(lambda: self.upload_ranges(file_path, remote_path))
+        else:
+            self.call(lambda: self.get_sftp().put(file_path, remote_path))
+
+    def upload_file_range(self, file_path: str, remote_path: str, offset: int):
+        """
+        write the tail of file_path from offset into remote_path"""
+
+        length = os.path.getsize(file_path) - offset
+
+        self.call(lambda: self.upload_range(
+            file_path, remote_path, offset, length))
+
+    def get_upload_streams(self, size: int) -> int:
+        """
+        number of parallel ranges for a file of size bytes"""
+
+        if size < self.parallel_upload_threshold:
+            return 1
+
+        return max(1, min(self.upload_streams, self.max_channels))
+
+    def upload_range(self, file_path: str, remote_path: str, offset: int, length: int):
+        """
+        write length bytes of file_path from offset into remote_path,
+        pipelined over its own sftp channel"""
+
+        sftp = self.conn.open_sftp()
+
+        try:
+            with open(file_path, "rb") as local_file, sftp.open(remote_path, "r+b") as remote_file:
+                remote_file.set_pipelined(True)
+                local_file.seek(offset)
+                remote_file.seek(offset)
+
+                while length > 0:
+                    data = local_file.read(
+                        min(self.upload_block_size, length))
+
+                    if not data:
+                        raise EOFError(f"{file_path} shorter than expected")
+
+                    remote_file.write(data)
+                    length -= len(data)
+        finally:
+            sftp.close()
+
+    def read_done_ranges(self, ranges_path: str, header: str) -> Set[int]:
+        """
+        offsets of the ranges already in ranges_path, from its journal.
+        empty if either is missing or the journal is of another upload"""
+
+        try:
+            self.get_sftp().stat(ranges_path)
+
+            with self.get_sftp().open(ranges_path + self.done_suffix, "rb") as journal:
+                lines = journal.read().decode("utf-8").splitlines()
+        except IOError:
+            return set()
+
+        if not lines or lines[0] != header:
+            return set()
+
+        return {int(line) for line in lines[1:]}
+
+    def write_done_ranges(self, ranges_path: str, header: str, done: Set[int]):
+
+        with self.get_sftp().open(ranges_path + self.done_suffix, "wb") as journal:
+            journal.write("\n".join(
+                [header] + [str(offset) for offset in sorted(done)]).encode("utf-8"))
+
+    def upload_ranges(self, file_path: str, remote_path: str):
+        """
+        upload file_path as contiguous ranges written concurrently.
+        ranges go to a file created at full size next to remote_path, renamed
+        to remote_path once all are written and its size checked, a failed
+        upload never leaves a full size remote_path. ranges written are
+        recorded in a journal next to it, a failed upload of the same file
+        is resumed with the ranges missing."""
+
+        file_stat = os.stat(file_path)
+        size = file_stat.st_size
+        n_streams = self.get_upload_streams(size)
+        range_size = min(-(-size // n_streams), self.resume_range_size)
+        ranges_path = remote_path + self.ranges_suffix
+        header = f"{size} {file_stat.st_mtime_ns} {range_size}"
+
+        done = self.read_done_ranges(ranges_path, header)
+
+        if not done:
+            with self.get_sftp().open(ranges_path, "wb") as remote_file:
+                remote_file.truncate(size)
+
+            self.write_done_ranges(ranges_path, header, done)
+
+        ranges = [(offset, min(range_size, size - offset))
+                  for offset in range(0, size, range_size) if offset not in done]
+
+        errors = []
+
+        with ThreadPoolExecutor(max_workers=n_streams) as executor:
+            uploads = {executor.submit(self.upload_range, file_path, ranges_path, offset, length): offset
+                       for offset, length in ranges}
+
+            for upload in as_completed(uploads):
+                try:
+                    upload.result()
+                except Exception as error:
+                    errors.append(error)
+                    continue
+
+                done.add(uploads[upload])
+                self.write_done_ranges(ranges_path, header, done)
+
+        if errors:
+            raise errors[0]
+
+        remote_size = self.get_sftp().stat(ranges_path).st_size
+        if remote_size != size:
+            raise IOError(
+                f"uploaded {ranges_path} has {remote_size} bytes, expected {size}")
+
+        self.get_sftp().posix_rename(ranges_path, remote_path)
+        self.get_sftp().remove(ranges_path + self.done_suffix)
 
     def download_file(self, remote_path: str, file_path: str):
         """
         download file using paramiko"""
-        with self as conn:
-            ftp_client = self.conn.open_sftp()
-            ftp_client.get(remote_path, file_path)
-            ftp_client.close()
+        self.call(lambda: self.get_sftp().get(remote_path, file_path))
+
+    def open_upload_stream(self, remote_path: str, offset: int = 0) -> UploadStream:
+        """
+        remote file written as data comes, connection held until closed"""
+
+        return SftpUploadStream(self, remote_path, offset)
 
 
 class ConnectorDocker(Connector):
@@ -187,6 +580,7 @@ class ConnectorDocker(Connector):
     """
     config_image_name = "image"
     televir_username = "flu_user"
+    max_processes = 8
 
     def __init__(self, config_file: str) -> None:
         super().__init__()
@@ -267,6 +661,17 @@ class ConnectorDocker(Connector):
 
         return output.decode("utf-8")
 
+    def execute_commands(self, commands: List[str]) -> List[str]:
+        """
+        run commands in the container, at most max_processes docker exec
+        at a time. outputs in order."""
+
+        if not commands:
+            return []
+
+        with ThreadPoolExecutor(max_workers=min(self.max_processes, len(commands))) as executor:
+            return list(executor.map(self.execute_command, commands))
+
     def check_file_exists(self, file_path: str) -> bool:
         """
         check file exists in docker container"""
@@ -295,6 +700,22 @@ class ConnectorDocker(Connector):
             bash_command.split(), stdout=subprocess.PIPE)
         output, error = process.communicate()
 
+    def upload_file_range(self, file_path: str, remote_path: str, offset: int):
+        """
+        write the tail of file_path from offset into remote_path, piped to dd in the container"""
+
+        with open(file_path, "rb", buffering=0) as local_file:
+            local_file.seek(offset)
+
+            process = subprocess.Popen(
+                ["docker", "exec", "-i", self.server_name, "dd", f"of={remote_path}",
+                 f"seek={offset}", "oflag=seek_bytes", "conv=notrunc", "status=none"],
+                stdin=local_file, stdout=subprocess.DEVNULL)
+
+            if process.wait() != 0:
+                raise OSError(
+                    f"docker exec dd exited with code {process.returncode}")
+
     def download_file(self, file_path: str, remote_path: str):
         """
         download file using docker cp"""
@@ -304,3 +725,9 @@ class ConnectorDocker(Connector):
         process = subprocess.Popen(
             bash_command.split(), stdout=subprocess.PIPE)
         output, error = process.communicate()
+
+    def open_upload_stream(self, remote_path: str, offset: int = 0) -> UploadStream:
+        """
+        remote file written through docker exec dd"""
+
+        return DockerUploadStream(self.server_name, remote_path, offset)
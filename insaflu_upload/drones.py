@@ -5,6 +5,7 @@ import threading
 import time
 from _thread import interrupt_main
 from threading import Event, Thread
+from typing import Callable, Optional
 
 from insaflu_upload.insaflu_uploads import (InsafluFileProcess,
                                             TelevirFileProcess)
@@ -77,10 +78,12 @@ class InsafluFileProcessThread(Thread):
 
 
 class TelevirFileProcessThread(Thread):
-    def __init__(self, processor: TelevirFileProcess, thread_lock: LockWithOwner):
+    def __init__(self, processor: TelevirFileProcess, thread_lock: LockWithOwner,
+                 wait_for_files: Optional[Callable[[float], bool]] = None):
         super(TelevirFileProcessThread, self).__init__()
         self.lock = thread_lock
         self.processor = processor
+        self.wait_for_files = wait_for_files
         self._stopevent = Event()  # initialize the event
         self.work_period = processor.real_sleep
         self.counter = 0
@@ -106,7 +109,11 @@ class TelevirFileProcessThread(Thread):
                             self._stopevent.set()
                             break
 
-                    time.sleep(1)
+                    if self.wait_for_files is None:
+                        time.sleep(1)
+
+                    elif self.wait_for_files(1):
+                        break
 
                 self.lock.release_to('A')
 
@@ -1,18 +1,24 @@
 
+import contextlib
 import datetime
 import logging
 import os
 import sys
-from typing import List
+from typing import List, Optional
 
 import pandas as pd
 
-from fastq_handler.fastq_handler import DirectoryProcessingSimple, PreMain
-from fastq_handler.records import Processed
+from fastq_handler.fastq_handler import (CompletenessDetector,
+                                         DirectoryProcessingSimple, PreMain)
+from fastq_handler.compression import get_default_codec
+from fastq_handler.records import (ProcessActionMergeWithLast,
+                                   ProcessActionSubsample, Processed)
+from fastq_handler.utilities import FastqDirectoryIndex
 from insaflu_upload.configs import InfluConfig, default_log_handler
 from insaflu_upload.plot_utils import plot_project_results
 from insaflu_upload.records import InsafluFile, MetadataEntry
-from insaflu_upload.upload_utils import InsafluSampleCodes, InsafluUpload
+from insaflu_upload.upload_utils import (InsafluSampleCodes, InsafluUpload,
+                                         UploadManifest)
 
 
 class InfluProcessed(Processed):
@@ -94,8 +100,10 @@ class InfluDirectoryProcessing(DirectoryProcessingSimple):
     uploader: InsafluUpload
 
     def __init__(self, fastq_dir: str, run_metadata: InfluConfig, processed: InfluProcessed,
-                 start_time: float):
-        super().__init__(fastq_dir, run_metadata, processed, start_time)
+                 start_time: float, detector: Optional[CompletenessDetector] = None,
+                 directory_index: Optional[FastqDirectoryIndex] = None):
+        super().__init__(fastq_dir, run_metadata, processed, start_time,
+                         detector=detector, directory_index=directory_index)
 
         self.run_metadata = run_metadata
         self.processed = processed
@@ -159,6 +167,48 @@ class InfluDirectoryProcessing(DirectoryProcessingSimple):
             barcode=barcode,
         )
 
+    def is_stream_upload(self, n_files: int) -> bool:
+        """
+        stream the merged output of n_files new files: enabled, the last of them
+        selected for upload, no subsampled copy uploaded in its place and a
+        codec writing through python.
+        """
+        if not self.run_metadata.stream_upload:
+            return False
+
+        if ProcessActionSubsample in (self.run_metadata.actions or []):
+            return False
+
+        if get_default_codec().writes_fd:
+            return False
+
+        files_to_upload = self.processed.processed.fastq.tolist() + \
+            [""] * n_files
+
+        return self.run_metadata.upload_strategy.is_to_upload(
+            files_to_upload, len(files_to_upload) - 1)
+
+    @contextlib.contextmanager
+    def upload_stream(self, destination_file: str, n_files: int = 1):
+        """
+        upload destination_file while it is merged. with merge, the remote
+        file starts with the upload of the last merged file, copied on the
+        server, only the new data is streamed.
+        """
+        if not self.is_stream_upload(n_files):
+            yield None
+            return
+
+        remote_path = self.uploader.get_remote_path(destination_file)
+        base_file = None
+
+        if ProcessActionMergeWithLast in (self.run_metadata.actions or []):
+            base_file = self.processed.get_id_merged_last(
+                self.processed.get_sample_id_from_merged(destination_file)) or None
+
+        with self.uploader.stream_upload(remote_path, destination_file, base_file) as stream:
+            yield stream
+
     def insaflu_process(self):
         """
         prepare processed files for upload
@@ -166,13 +216,16 @@ class InfluDirectoryProcessing(DirectoryProcessingSimple):
 
         files_to_upload = self.processed.processed.fastq.tolist()
 
-        for ix, row in self.processed.processed.iterrows():
+        rows = [(ix, row) for ix, row in self.processed.processed.iterrows()
+                if not self.processed.is_folded(row.folded)]
+
+        statuses = self.uploader.get_samples_status(
+            [self.get_filename_from_path(row.merged) for _, row in rows])
+
+        for (ix, row), status in zip(rows, statuses):
 
             fastq_file = row.fastq
             merged_file = row.merged
-            merged_name = self.get_filename_from_path(merged_file)
-
-            status = self.uploader.get_sample_status(merged_name)
 
             if self.run_metadata.upload_strategy.is_to_upload(files_to_upload, ix):
 
@@ -191,12 +244,10 @@ class InfluDirectoryProcessing(DirectoryProcessingSimple):
                         metadata_entry
                     )
 
-    def process_folder(self):
+    def post_process(self):
         """
-        process folder, merge and update metadata
         submit to televir only the last file.
         """
-        super().process_folder()
         self.insaflu_process()
 
 
@@ -216,19 +267,39 @@ class InsafluFileProcess(PreMain, InsafluSetup):
     """
 
     processed: InfluProcessed
+    processed_class = InfluProcessed
     run_metadata: InfluConfig
     projects_results: list = []
     metadata_dirname = "metadata_dir"
 
     def __init__(self, run_metadata: InfluConfig):
         PreMain.__init__(self, run_metadata)
-        InsafluSetup.__init__(self, run_metadata)
+        self.uploader = run_metadata.uploader
 
         self.logger = logging.getLogger(__name__)
         self.logger.addHandler(default_log_handler)
 
+        if self.level_advisor is not None and hasattr(self.uploader, "throughput_listeners"):
+            self.uploader.throughput_listeners.append(
+                self.level_advisor.record_upload)
+
+        if hasattr(self.uploader, "manifest"):
+            self.prep_manifest()
+
         self.prep_metadata_dir()
 
+    def prep_manifest(self):
+        """
+        load the upload manifest, drop entries no longer on the server
+        """
+        self.uploader.manifest = UploadManifest(self.run_metadata.logs_dir)
+
+        dropped = self.uploader.verify_uploads()
+
+        if dropped:
+            self.logger.info(
+                f"{len(dropped)} uploads no longer on the server, removed from manifest")
+
     def prep_metadata_dir(self):
         """
         create output directories
@@ -247,7 +318,8 @@ class InsafluFileProcess(PreMain, InsafluSetup):
     def get_directory_processing(self, fastq_dir: str):
 
         return InfluDirectoryProcessing(fastq_dir, self.run_metadata, self.processed,
-                                        self.start_time)
+                                        self.start_time, detector=self.completeness_detector,
+                                        directory_index=self.directory_index)
 
     def write_metadata(self, metadata: List[MetadataEntry], metadata_filename: str):
         """
@@ -320,8 +392,8 @@ class InsafluFileProcess(PreMain, InsafluSetup):
         samples_to_clean = self.uploader.logger.generate_file_list_status(
             InsafluSampleCodes.STATUS_SUBMITTED)
 
-        for file in samples_to_clean:
-            self.uploader.clean_upload(file.remote_path)
+        self.uploader.clean_uploads(
+            [file.remote_path for file in samples_to_clean])
 
     def submit_samples(self, sample_metadata: List[MetadataEntry]):
         """
@@ -375,12 +447,14 @@ class InsafluFileProcess(PreMain, InsafluSetup):
 
         fastq_list = self.uploader.logger.generate_fastq_list()
 
-        for fastq in fastq_list:
+        file_names = [self.processed.get_run_info(fastq.file_path)[0]
+                      for fastq in fastq_list]
+
+        statuses = self.uploader.get_samples_status(file_names)
 
-            file_name, _ = self.processed.get_run_info(fastq.file_path)
+        for fastq, status in zip(fastq_list, statuses):
 
-            _ = self.uploader.update_sample_status_remote(
-                file_name, fastq.file_path)
+            self.uploader.update_file_status(fastq.file_path, status)
 
     def run(self):
         super().run()
@@ -468,16 +542,19 @@ class TelevirFileProcess(InsafluSetup):
         fastq_list = self.uploader.logger.generate_fastq_list_status(
             InsafluSampleCodes.STATUS_SUBMITTED)
 
-        for fastq in fastq_list:
-            project_name = self.assign_project_name(fastq)
+        file_names = [self.processed.get_run_info(fastq.file_path)[0]
+                      for fastq in fastq_list]
 
-            file_name, _ = self.processed.get_run_info(fastq.file_path)
-            self.deploy_televir_sample(
-                fastq.sample_id,
-                file_name,
-                fastq.file_path,
-                project_name,
-            )
+        statuses = self.uploader.get_samples_status(file_names)
+
+        samples_to_deploy = [
+            (fastq.sample_id, file_name, fastq.file_path,
+             self.assign_project_name(fastq))
+            for fastq, file_name, status in zip(fastq_list, file_names, statuses)
+            if status == InsafluSampleCodes.STATUS_SUBMITTED
+        ]
+
+        self.uploader.deploy_televir_samples(samples_to_deploy)
 
     def download_project_results(self):
         """
@@ -6,7 +6,9 @@ import time
 from dataclasses import dataclass
 from typing import Tuple
 
-from fastq_handler.records import ProcessActionMergeWithLast
+from fastq_handler.compression import CODECS
+from fastq_handler.records import (ProcessActionMergeWithLast,
+                                   ProcessActionSubsample)
 from insaflu_upload.configs import InfluConfig
 from insaflu_upload.connectors import ConnectorDocker, ConnectorParamiko
 from insaflu_upload.drones import (InsafluFileProcessThread, LockWithOwner,
@@ -31,6 +33,21 @@ class ArgsClass:
     keep_names: bool
     monitor: bool
     televir: bool
+    watch: bool
+    completeness: str
+    workers: int
+    batch: bool
+    coalesce: int
+    codec: str
+    compress_threads: int
+    compresslevel: int
+    adaptive_level: bool
+    subsample: bool
+    max_upload_bytes: int
+    stats: bool
+    bgzf: bool
+    stream_upload: bool
+    delta_upload: bool
 
 
 class MainInsaflu:
@@ -72,6 +89,67 @@ class MainInsaflu:
         parser.add_argument(
             "--monitor", help="monitor directory until killed", action="store_true")
 
+        parser.add_argument(
+            "--watch", help="in monitor mode, wake on new files (linux inotify) instead of sleeping the full interval",
+            action="store_true")
+
+        parser.add_argument('--completeness',
+                            default='open_files',
+                            choices=['open_files', 'quiescence',
+                                     'gzip_trailer'],
+                            help='how to decide a chunk is finished (default: open_files)',)
+
+        parser.add_argument('--workers',
+                            type=int,
+                            default=1,
+                            help='number of barcode directories merged in parallel (default: 1)',)
+
+        parser.add_argument(
+            "--batch", help="with --merge, merge all new chunks of a barcode in one pass per cycle", action="store_true")
+
+        parser.add_argument('--coalesce',
+                            type=int,
+                            default=0,
+                            help='write only the last cumulative file when a barcode has more than this many new chunks (default: 0, off)',)
+
+        parser.add_argument('--codec',
+                            default='auto',
+                            choices=['auto'] + list(CODECS),
+                            help='gzip backend (default: auto, fastest available at startup)',)
+
+        parser.add_argument('--compress-threads',
+                            type=int,
+                            default=1,
+                            help='threads per compression, isal, zlib-ng and pigz (default: 1)',)
+
+        parser.add_argument('--compresslevel',
+                            type=int,
+                            default=3,
+                            help='gzip level for new chunks, starting level with --adaptive-level (default: 3)',)
+
+        parser.add_argument(
+            "--adaptive-level", help="pick the gzip level from measured compression and upload throughput", action="store_true")
+
+        parser.add_argument(
+            "--subsample", help="upload a random subsample of merged files larger than --max-upload-bytes", action="store_true")
+
+        parser.add_argument('--max-upload-bytes',
+                            type=int,
+                            default=ProcessActionSubsample.max_bytes,
+                            help=f'size cap for --subsample (default: {ProcessActionSubsample.max_bytes}, the insaflu limit)',)
+
+        parser.add_argument(
+            "--stats", help="record reads, bases, N50 and mean quality of each chunk while merging", action="store_true")
+
+        parser.add_argument(
+            "--bgzf", help="write merged files as bgzf with a block index (.blocks) next to them", action="store_true")
+
+        parser.add_argument(
+            "--stream-upload", help="upload merged files while they are written instead of reading them back (not with --subsample or --workers > 1)", action="store_true")
+
+        parser.add_argument(
+            "--delta-upload", help="with --merge, build each upload from the previous one on the server and send only the new data", action="store_true")
+
         parser.add_argument(
             "--televir", help="deploy televir pathogen identification on each sample", action="store_true"
         )
@@ -87,7 +165,8 @@ class MainInsaflu:
         else:
             connector = ConnectorParamiko(args.config)
 
-        insaflu_upload = InsafluUploadRemote(connector, args.config)
+        insaflu_upload = InsafluUploadRemote(
+            connector, args.config, delta_upload=args.delta_upload)
 
         # determine upload strategy
         if args.upload == 'last':
@@ -99,6 +178,8 @@ class MainInsaflu:
         actions = []
         if args.merge:
             actions.append(ProcessActionMergeWithLast)
+        if args.subsample:
+            actions.append(ProcessActionSubsample)
 
         # create run metadata
 
@@ -113,6 +194,19 @@ class MainInsaflu:
             sleep_time=args.sleep,
             deploy_televir=args.televir,
             monitor=args.monitor,
+            watch=args.watch,
+            completeness=args.completeness,
+            workers=args.workers,
+            batch=args.batch,
+            coalesce_threshold=args.coalesce,
+            codec=args.codec,
+            compress_threads=args.compress_threads,
+            compresslevel=args.compresslevel,
+            adaptive_level=args.adaptive_level,
+            max_upload_bytes=args.max_upload_bytes,
+            stats=args.stats,
+            bgzf=args.bgzf,
+            stream_upload=args.stream_upload,
         )
 
         return run_metadata
@@ -137,8 +231,12 @@ class MainInsaflu:
         file_processor_task = InsafluFileProcessThread(
             file_processor, lock
         )
+        wait_for_files = None
+        if file_processor.run_metadata.watch:
+            wait_for_files = file_processor.wait_for_files
+
         televir_processor_task = TelevirFileProcessThread(
-            televir_processor, lock
+            televir_processor, lock, wait_for_files=wait_for_files
         )
 
         file_processor_task.daemon = True
@@ -1,8 +1,16 @@
 import gzip
+import hashlib
+import io
+import logging
 import os
 import shutil
+import subprocess
+import tempfile
+import threading
+import time
 import unittest
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import List
 
 import mockssh
 import pandas as pd
@@ -11,12 +19,13 @@ import pytest
 from paramiko import SSHClient
 
 from insaflu_upload.configs import InfluConfig
-from insaflu_upload.connectors import ConnectorParamiko
+from insaflu_upload.connectors import ConnectorParamiko, UploadStream
 from insaflu_upload.insaflu_uploads import (InfluDirectoryProcessing,
                                             InfluProcessed, InsafluFileProcess)
 from insaflu_upload.records import MetadataEntry
 from insaflu_upload.upload_utils import (InsafluFile, InsafluSampleCodes,
-                                         InsafluUploadRemote, UploadLog)
+                                         InsafluUploadRemote, UploadLog,
+                                         UploadManifest)
 
 
 @pytest.fixture(scope="session")
@@ -244,6 +253,502 @@ class TestUploadLog(unittest.TestCase):
         assert sample.sample_id == "test"
 
 
+class UploadStreamProxy(UploadStream):
+
+    def __init__(self, fail_after: int = -1):
+        super().__init__()
+        self.data = bytearray()
+        self.fail_after = fail_after
+
+    def write_remote(self, data: bytes):
+        if self.fail_after >= 0 and len(self.data) >= self.fail_after:
+            raise OSError("connection lost")
+
+        self.data.extend(data)
+
+    def close_remote(self):
+        pass
+
+
+class LocalUploadStream(UploadStream):
+
+    def __init__(self, remote_path: str, offset: int = 0):
+        super().__init__()
+        self.remote_file = open(remote_path, "r+b" if offset else "wb")
+        self.remote_file.seek(offset)
+
+    def write_remote(self, data: bytes):
+        self.remote_file.write(data)
+
+    def close_remote(self):
+        self.remote_file.close()
+
+
+class LocalConnector:
+    """
+    connector stand-in running commands on the local filesystem"""
+
+    def execute_command(self, command: str) -> str:
+        return subprocess.run(command, shell=True, capture_output=True).stdout.decode("utf-8")
+
+    def check_file_exists(self, file_path: str) -> bool:
+        return os.path.exists(file_path)
+
+    def upload_file(self, file_path: str, remote_path: str):
+        shutil.copyfile(file_path, remote_path)
+
+    def upload_file_range(self, file_path: str, remote_path: str, offset: int):
+        with open(file_path, "rb") as local_file, open(remote_path, "r+b") as remote_file:
+            local_file.seek(offset)
+            remote_file.seek(offset)
+            remote_file.write(local_file.read())
+
+    def execute_commands(self, commands: List[str]) -> List[str]:
+        return [self.execute_command(command) for command in commands]
+
+    def open_upload_stream(self, remote_path: str, offset: int = 0) -> UploadStream:
+        return LocalUploadStream(remote_path, offset)
+
+
+class LocalUploaderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.remote_dir = os.path.join(self.test_dir, "remote")
+        os.makedirs(self.remote_dir)
+
+        self.uploads = []
+        self.uploader = InsafluUploadRemote.__new__(InsafluUploadRemote)
+        self.uploader.logger = UploadLog()
+        self.uploader.conn = LocalConnector()
+        self.uploader.delta_upload = True
+        self.uploader.remote_dir = self.remote_dir
+        self.uploader.throughput_listeners = [
+            lambda n_bytes, seconds: self.uploads.append(n_bytes)]
+        self.uploader.logging_logger = logging.getLogger("test")
+        self.uploader.held_paths = []
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def write_file(self, name: str, data: bytes) -> str:
+        file_path = os.path.join(self.test_dir, name)
+
+        with open(file_path, "wb") as f:
+            f.write(data)
+
+        return file_path
+
+
+class TestDeltaUpload(LocalUploaderTestCase):
+
+    def test_delta_upload(self):
+        first = os.urandom(5000)
+        second = first + os.urandom(1000)
+
+        first_path = self.write_file("sample_01-01.fastq.gz", first)
+        second_path = self.write_file("sample_01-02.fastq.gz", second)
+
+        self.uploader.upload_sample(first_path, sample_id="sample")
+        self.uploader.upload_sample(second_path, sample_id="sample")
+
+        with open(self.uploader.get_remote_path(second_path), "rb") as f:
+            assert f.read() == second
+
+        assert self.uploads == [5000, 1000]
+        assert self.uploader.logger.get_file_status(
+            second_path) == InsafluSampleCodes.STATUS_UPLOADED
+
+    def test_delta_upload_not_prefix(self):
+        first_path = self.write_file(
+            "sample_01-01.fastq.gz", os.urandom(5000))
+        second = os.urandom(6000)
+        second_path = self.write_file("sample_01-02.fastq.gz", second)
+
+        self.uploader.upload_sample(first_path, sample_id="sample")
+        self.uploader.upload_sample(second_path, sample_id="sample")
+
+        with open(self.uploader.get_remote_path(second_path), "rb") as f:
+            assert f.read() == second
+
+        assert self.uploads == [5000, 6000]
+        assert not os.path.exists(
+            self.uploader.get_remote_path(second_path) + self.uploader.part_suffix)
+
+
+    def test_delta_upload_submitted(self):
+        first = os.urandom(5000)
+        second = first + os.urandom(1000)
+
+        first_path = self.write_file("sample_01-01.fastq.gz", first)
+        second_path = self.write_file("sample_01-02.fastq.gz", second)
+
+        self.uploader.upload_sample(first_path, sample_id="sample")
+        self.uploader.update_file_status(
+            first_path, InsafluSampleCodes.STATUS_SUBMITTED)
+        self.uploader.upload_sample(second_path, sample_id="sample")
+
+        assert self.uploads == [5000, 1000]
+
+    def test_delta_base_held(self):
+        first = os.urandom(5000)
+        second = first + os.urandom(1000)
+
+        first_path = self.write_file("sample_01-01.fastq.gz", first)
+        second_path = self.write_file("sample_01-02.fastq.gz", second)
+        first_remote_path = self.uploader.get_remote_path(first_path)
+
+        self.uploader.upload_sample(first_path, sample_id="sample")
+
+        upload_file_range = self.uploader.conn.upload_file_range
+
+        def clean_during_upload(file_path, remote_path, offset):
+            self.uploader.clean_uploads([first_remote_path])
+            upload_file_range(file_path, remote_path, offset)
+
+        self.uploader.conn.upload_file_range = clean_during_upload
+        self.uploader.upload_sample(second_path, sample_id="sample")
+
+        assert os.path.exists(first_remote_path)
+        assert self.uploads == [5000, 1000]
+
+        self.uploader.clean_uploads([first_remote_path])
+        assert not os.path.exists(first_remote_path)
+
+
+class TestResumableUpload(LocalUploaderTestCase):
+
+    def test_resume(self):
+        data = os.urandom(6000)
+        file_path = self.write_file("sample_01-01.fastq.gz", data)
+        remote_path = self.uploader.get_remote_path(file_path)
+
+        with open(remote_path + self.uploader.part_suffix, "wb") as f:
+            f.write(data[:4000])
+
+        self.uploader.upload_file(file_path, remote_path, "sample")
+
+        with open(remote_path, "rb") as f:
+            assert f.read() == data
+
+        assert self.uploads == [2000]
+        assert not os.path.exists(remote_path + self.uploader.part_suffix)
+        assert self.uploader.logger.get_file_status(
+            file_path) == InsafluSampleCodes.STATUS_UPLOADED
+
+    def test_resume_different_part(self):
+        data = os.urandom(6000)
+        file_path = self.write_file("sample_01-01.fastq.gz", data)
+        remote_path = self.uploader.get_remote_path(file_path)
+
+        with open(remote_path + self.uploader.part_suffix, "wb") as f:
+            f.write(os.urandom(4000))
+
+        self.uploader.upload_file(file_path, remote_path, "sample")
+
+        with open(remote_path, "rb") as f:
+            assert f.read() == data
+
+        assert self.uploads == [6000]
+
+    def test_failed_upload(self):
+        data = os.urandom(6000)
+        file_path = self.write_file("sample_01-01.fastq.gz", data)
+        remote_path = self.uploader.get_remote_path(file_path)
+
+        def upload_half(file_path, remote_path):
+            with open(remote_path, "wb") as f:
+                f.write(data[:3000])
+            raise EOFError()
+
+        self.uploader.conn.upload_file = upload_half
+        self.uploader.upload_file(file_path, remote_path, "sample")
+
+        assert not os.path.exists(remote_path)
+        assert self.uploader.logger.get_file_status(
+            file_path) == InsafluSampleCodes.STATUS_ERROR
+
+        del self.uploader.conn.upload_file
+        self.uploader.upload_file(file_path, remote_path, "sample")
+
+        with open(remote_path, "rb") as f:
+            assert f.read() == data
+
+        assert self.uploads == [3000]
+
+
+class TestUploadManifest(LocalUploaderTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.uploader.delta_upload = False
+        self.uploader.manifest = UploadManifest(self.test_dir)
+
+        self.checks = []
+        check_file_exists = self.uploader.conn.check_file_exists
+
+        def counted_check_file_exists(file_path):
+            self.checks.append(file_path)
+            return check_file_exists(file_path)
+
+        self.uploader.conn.check_file_exists = counted_check_file_exists
+
+    def test_unchanged_skipped(self):
+        file_path = self.write_file("sample_01-01.fastq.gz", os.urandom(3000))
+        remote_path = self.uploader.get_remote_path(file_path)
+
+        self.uploader.upload_file(file_path, remote_path, "sample")
+        self.uploader.upload_file(file_path, remote_path, "sample")
+
+        assert self.uploads == [3000]
+        assert self.checks == [remote_path]
+
+        manifest = UploadManifest(self.test_dir)
+        assert manifest.get(remote_path).matches(file_path)
+
+    def test_changed_uploaded(self):
+        file_path = self.write_file("sample_01-01.fastq.gz", os.urandom(3000))
+        remote_path = self.uploader.get_remote_path(file_path)
+
+        self.uploader.upload_file(file_path, remote_path, "sample")
+
+        data = os.urandom(4000)
+        self.write_file("sample_01-01.fastq.gz", data)
+        self.uploader.upload_file(file_path, remote_path, "sample")
+
+        with open(remote_path, "rb") as f:
+            assert f.read() == data
+
+        assert self.uploads == [3000, 4000]
+
+    def test_verify_uploads(self):
+        file_paths = [self.write_file(f"sample_01-0{ix}.fastq.gz", os.urandom(1000))
+                      for ix in range(3)]
+        remote_paths = [self.uploader.get_remote_path(
+            file_path) for file_path in file_paths]
+
+        for file_path, remote_path in zip(file_paths, remote_paths):
+            self.uploader.upload_file(file_path, remote_path, "sample")
+
+        os.remove(remote_paths[1])
+        self.uploader.manifest = UploadManifest(self.test_dir)
+
+        assert self.uploader.verify_uploads() == [remote_paths[1]]
+        assert self.uploader.verify_uploads(checksum=True) == []
+        assert len(self.uploader.manifest) == 2
+
+    def test_verify_uploads_chunked(self):
+        file_paths = [self.write_file(f"sample_01-0{ix}.fastq.gz", os.urandom(1000))
+                      for ix in range(5)]
+        remote_paths = [self.uploader.get_remote_path(
+            file_path) for file_path in file_paths]
+
+        for file_path, remote_path in zip(file_paths, remote_paths):
+            self.uploader.upload_file(file_path, remote_path, "sample")
+
+        os.remove(remote_paths[0])
+        os.remove(remote_paths[3])
+        self.uploader.manifest = UploadManifest(self.test_dir)
+
+        batches = []
+        execute_commands = self.uploader.conn.execute_commands
+
+        def counted_execute_commands(commands):
+            batches.append(commands)
+            return execute_commands(commands)
+
+        self.uploader.conn.execute_commands = counted_execute_commands
+        self.uploader.verify_chunk_size = 2
+
+        assert self.uploader.verify_uploads(checksum=True) == [
+            remote_paths[0], remote_paths[3]]
+        assert len(batches) == 1 and len(batches[0]) == 3
+        assert len(self.uploader.manifest) == 3
+
+    def test_verify_uploads_confirmed(self):
+        file_paths = [self.write_file(f"sample_01-0{ix}.fastq.gz", os.urandom(size))
+                      for ix, size in enumerate([1000, 1000, 4000])]
+        remote_paths = [self.uploader.get_remote_path(
+            file_path) for file_path in file_paths]
+
+        for file_path, remote_path in zip(file_paths, remote_paths):
+            self.uploader.upload_file(file_path, remote_path, "sample")
+
+        batches = []
+        execute_commands = self.uploader.conn.execute_commands
+
+        def counted_execute_commands(commands):
+            batches.append(commands)
+            return execute_commands(commands)
+
+        self.uploader.conn.execute_commands = counted_execute_commands
+
+        assert self.uploader.verify_uploads(checksum=True) == []
+        assert batches == []
+
+        with open(remote_paths[0], "r+b") as f:
+            f.write(os.urandom(10))
+
+        self.uploader.manifest = UploadManifest(self.test_dir)
+        self.uploader.verify_checksum_min_size = 2000
+
+        assert self.uploader.verify_uploads(checksum=True) == []
+        assert len(batches) == 1 and len(batches[0]) == 2
+        assert batches[0][0].startswith(f"sha256sum {remote_paths[2]} ")
+        assert batches[0][1].startswith(
+            f"stat -c '%s %n' {remote_paths[0]} {remote_paths[1]} ")
+
+        assert self.uploader.verify_uploads(checksum=True) == []
+        assert len(batches) == 1
+
+
+class TestStreamUpload(LocalUploaderTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.uploader.manifest = UploadManifest(self.test_dir)
+
+    def test_stream_from_base(self):
+        first = os.urandom(5000)
+        tail = os.urandom(1000)
+
+        first_path = self.write_file("sample_01-01.fastq.gz", first)
+        second_path = os.path.join(self.test_dir, "sample_01-02.fastq.gz")
+        remote_path = self.uploader.get_remote_path(second_path)
+
+        self.uploader.upload_file(
+            first_path, self.uploader.get_remote_path(first_path), "sample")
+
+        with self.uploader.stream_upload(remote_path, second_path, first_path) as stream:
+            stream.write(tail)
+            self.write_file("sample_01-02.fastq.gz", first + tail)
+
+        with open(remote_path, "rb") as f:
+            assert f.read() == first + tail
+
+        assert self.uploads == [5000, 1000]
+        assert self.uploader.manifest.get(remote_path).matches(second_path)
+        assert not os.path.exists(remote_path + self.uploader.part_suffix)
+
+    def test_stream_mismatch(self):
+        first = os.urandom(5000)
+        tail = os.urandom(1000)
+
+        first_path = self.write_file("sample_01-01.fastq.gz", first)
+        second_path = os.path.join(self.test_dir, "sample_01-02.fastq.gz")
+        remote_path = self.uploader.get_remote_path(second_path)
+
+        self.uploader.upload_file(
+            first_path, self.uploader.get_remote_path(first_path), "sample")
+
+        with self.uploader.stream_upload(remote_path, second_path, first_path) as stream:
+            stream.write(tail)
+            stream.remote_file.seek(5500)
+            stream.remote_file.write(b"corrupt")
+            self.write_file("sample_01-02.fastq.gz", first + tail)
+
+        with open(remote_path, "rb") as f:
+            assert f.read() == first + tail
+
+        assert self.uploads == [5000, 6000]
+        assert self.uploader.manifest.get(remote_path).matches(second_path)
+
+    def test_stream_base_removed(self):
+        first_path = self.write_file(
+            "sample_01-01.fastq.gz", os.urandom(5000))
+        first_remote_path = self.uploader.get_remote_path(first_path)
+        second_path = os.path.join(self.test_dir, "sample_01-02.fastq.gz")
+        remote_path = self.uploader.get_remote_path(second_path)
+
+        self.uploader.upload_file(first_path, first_remote_path, "sample")
+        os.remove(first_remote_path)
+
+        with self.uploader.stream_upload(remote_path, second_path, first_path) as stream:
+            assert stream is None
+
+        assert os.listdir(self.remote_dir) == []
+
+
+class TestDeployTelevir(LocalUploaderTestCase):
+
+    def test_project_created_once(self):
+        self.uploader.django_manager = "manage.py"
+        self.uploader.televir_user = "user"
+
+        batches = []
+
+        def execute_commands(commands):
+            batches.append(commands)
+            return ["submitted"] * len(commands)
+
+        self.uploader.conn.execute_commands = execute_commands
+
+        samples = [("s1", "sample_01", "f1", "project"),
+                   ("s2", "sample_02", "f2", "project"),
+                   ("s3", "sample_03", "f3", "other")]
+
+        statuses = self.uploader.deploy_televir_samples(samples)
+
+        commands = [self.uploader.televir_project_command(sample_name, project_name)
+                    for _, sample_name, _, project_name in samples]
+
+        assert batches[:2] == [[commands[0], commands[2]], [commands[1]]]
+        assert statuses == [InsafluSampleCodes.STATUS_TELEVIR_SUBMITTED] * 3
+
+
+class TestInsafluFileProcess(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_recover_interrupted(self):
+        merged_file = os.path.join(self.test_dir, "sample_01-01.fastq.gz")
+        with open(merged_file, "wb") as f:
+            f.write(gzip.compress(b"@r1\nACGT\n+\nIIII\n")[:-4])
+
+        run_metadata = InfluConfig(output_dir=self.test_dir)
+
+        processed = InfluProcessed(run_metadata.logs_dir)
+        processed.update("chunk_01.fastq.gz", "barcode01", 0, merged_file)
+        processed.export(run_metadata.logs_dir)
+
+        file_process = InsafluFileProcess(run_metadata)
+
+        assert isinstance(file_process.processed, InfluProcessed)
+        assert len(file_process.processed) == 0
+        assert len(InfluProcessed(run_metadata.logs_dir)) == 0
+
+
+class TestUploadStream(unittest.TestCase):
+
+    def test_write(self):
+        stream = UploadStreamProxy()
+
+        with stream:
+            stream.write(b"test")
+            stream.write(b"data")
+
+        assert bytes(stream.data) == b"testdata"
+        assert stream.bytes_written == 8
+        assert stream.sha256 == hashlib.sha256(b"testdata").hexdigest()
+        assert stream.error is None
+
+    def test_write_error(self):
+        stream = UploadStreamProxy(fail_after=4)
+
+        with stream:
+            assert stream.write(b"test") == 4
+            assert stream.write(b"data") == 4
+            assert stream.write(b"more") == 4
+
+        assert bytes(stream.data) == b"test"
+        assert stream.bytes_written == 4
+        assert isinstance(stream.error, OSError)
+
+
 class ConnectorParamikoProxy(ConnectorParamiko):
 
     def connect(self):
@@ -264,6 +769,256 @@ class ConnectorParamikoProxy(ConnectorParamiko):
         self.server.__exit__(exc_type, exc_value, traceback)
 
 
+class LocalSftpFile(io.FileIO):
+
+    def set_pipelined(self, pipelined=True):
+        pass
+
+
+class LocalSftp:
+    """
+    sftp client stand-in on the local filesystem"""
+
+    modes = {"wb": "w", "r+b": "r+", "rb": "r"}
+
+    def open(self, path, mode):
+        return LocalSftpFile(path, self.modes[mode])
+
+    def stat(self, path):
+        return os.stat(path)
+
+    def posix_rename(self, path, new_path):
+        os.replace(path, new_path)
+
+    def remove(self, path):
+        os.remove(path)
+
+    def close(self):
+        pass
+
+
+class LocalChannel:
+    """
+    ssh channel stand-in, output of any command"""
+
+    def __init__(self, output: bytes, error: Exception = None):
+        self.output = output
+        self.error = error
+        self.commands = []
+
+    def exec_command(self, command):
+        self.commands.append(command)
+
+        if self.error is not None:
+            raise self.error
+
+    def makefile(self, mode):
+        return io.BytesIO(self.output)
+
+    def close(self):
+        pass
+
+
+class LocalTransport:
+
+    def __init__(self, channel: LocalChannel):
+        self.channel = channel
+
+    def open_session(self):
+        return self.channel
+
+
+class TestConnectorParamikoSession(unittest.TestCase):
+
+    def get_connector(self, connected: bool):
+        connector = ConnectorParamiko.__new__(ConnectorParamiko)
+        connector.conn = SSHClient()
+        connector.sessions = 0
+
+        def open_session():
+            connector.sessions += 1
+
+        connector.open_session = open_session
+        connector.is_connected = lambda: connected
+
+        return connector
+
+    def test_call_reconnects(self):
+        connector = self.get_connector(connected=False)
+        calls = []
+
+        def call():
+            calls.append(1)
+            if len(calls) == 1:
+                raise EOFError()
+            return "ok"
+
+        assert connector.call(call) == "ok"
+        assert len(calls) == 2
+        assert connector.sessions == 2
+
+    def test_call_error_connected(self):
+        connector = self.get_connector(connected=True)
+
+        def call():
+            raise ValueError()
+
+        with self.assertRaises(ValueError):
+            connector.call(call)
+
+        assert connector.sessions == 0
+
+    def test_execute_commands(self):
+        connector = self.get_connector(connected=True)
+        connector.max_channels = 3
+        lock = threading.Lock()
+        running = []
+        max_running = []
+
+        def run_command(command):
+            with lock:
+                running.append(command)
+                max_running.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.remove(command)
+            return command.upper()
+
+        connector.run_command = run_command
+        commands = [f"echo {ix}" for ix in range(10)]
+
+        assert connector.execute_commands(commands) == [
+            command.upper() for command in commands]
+        assert max(max_running) <= 3
+        assert connector.execute_commands([]) == []
+
+    def test_run_command_reconnects(self):
+        connector = self.get_connector(connected=False)
+        channel = LocalChannel(b"ok")
+        transport = LocalTransport(channel)
+
+        connector.conn.get_transport = lambda: transport if connector.sessions else None
+
+        assert connector.run_command("echo ok") == "ok"
+        assert channel.commands == ["echo ok"]
+        assert connector.sessions == 1
+
+    def test_run_command_not_repeated(self):
+        connector = self.get_connector(connected=False)
+        channel = LocalChannel(b"", error=EOFError())
+        transport = LocalTransport(channel)
+
+        connector.conn.get_transport = lambda: transport
+
+        with self.assertRaises(EOFError):
+            connector.run_command("upload_samples")
+
+        assert channel.commands == ["upload_samples"]
+        assert connector.sessions == 0
+
+    def test_upload_ranges(self):
+        connector = self.get_connector(connected=True)
+        connector.conn.open_sftp = LocalSftp
+        connector.get_sftp = LocalSftp
+        connector.parallel_upload_threshold = 100
+        connector.upload_block_size = 64
+
+        test_dir = tempfile.mkdtemp()
+        local_file = os.path.join(test_dir, "local.fastq.gz")
+        remote_file = os.path.join(test_dir, "remote.fastq.gz")
+        data = os.urandom(1001)
+
+        with open(local_file, "wb") as f:
+            f.write(data)
+
+        assert connector.get_upload_streams(len(data)) == 4
+        assert connector.get_upload_streams(99) == 1
+
+        connector.upload_ranges(local_file, remote_file)
+
+        with open(remote_file, "rb") as f:
+            assert f.read() == data
+
+        assert not os.path.exists(remote_file + connector.ranges_suffix)
+
+        shutil.rmtree(test_dir)
+
+    def test_upload_ranges_failed(self):
+        connector = self.get_connector(connected=True)
+        connector.conn.open_sftp = LocalSftp
+        connector.get_sftp = LocalSftp
+        connector.parallel_upload_threshold = 100
+        connector.upload_block_size = 64
+
+        test_dir = tempfile.mkdtemp()
+        local_file = os.path.join(test_dir, "local.fastq.gz")
+        remote_file = os.path.join(test_dir, "remote.fastq.gz")
+
+        with open(local_file, "wb") as f:
+            f.write(os.urandom(1001))
+
+        upload_range = connector.upload_range
+
+        def fail_last_range(file_path, remote_path, offset, length):
+            if offset + length == 1001:
+                raise EOFError()
+            upload_range(file_path, remote_path, offset, length)
+
+        connector.upload_range = fail_last_range
+
+        with self.assertRaises(EOFError):
+            connector.upload_ranges(local_file, remote_file)
+
+        assert not os.path.exists(remote_file)
+
+        shutil.rmtree(test_dir)
+
+    def test_upload_ranges_resume(self):
+        connector = self.get_connector(connected=True)
+        connector.conn.open_sftp = LocalSftp
+        connector.get_sftp = LocalSftp
+        connector.parallel_upload_threshold = 100
+        connector.upload_block_size = 64
+        connector.resume_range_size = 128
+
+        test_dir = tempfile.mkdtemp()
+        local_file = os.path.join(test_dir, "local.fastq.gz")
+        remote_file = os.path.join(test_dir, "remote.fastq.gz")
+        data = os.urandom(1001)
+
+        with open(local_file, "wb") as f:
+            f.write(data)
+
+        upload_range = connector.upload_range
+        uploaded = []
+
+        def fail_range(file_path, remote_path, offset, length):
+            if offset == 512:
+                raise EOFError()
+            upload_range(file_path, remote_path, offset, length)
+
+        def counted_range(file_path, remote_path, offset, length):
+            uploaded.append(offset)
+            upload_range(file_path, remote_path, offset, length)
+
+        connector.upload_range = fail_range
+
+        with self.assertRaises(EOFError):
+            connector.upload_ranges(local_file, remote_file)
+
+        connector.upload_range = counted_range
+        connector.upload_ranges(local_file, remote_file)
+
+        assert uploaded == [512]
+
+        with open(remote_file, "rb") as f:
+            assert f.read() == data
+
+        assert sorted(os.listdir(test_dir)) == ["local.fastq.gz", "remote.fastq.gz"]
+
+        shutil.rmtree(test_dir)
+
+
 class TestConnectorParamiko:
 
     def test_init(self, tmpdir):
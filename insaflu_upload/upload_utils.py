@@ -1,14 +1,21 @@
 import configparser
+import contextlib
+import csv
 import logging
 import os
 import sys
+import threading
+import time
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
-from typing import List, Optional
+from typing import (Callable, ContextManager, Dict, List, Optional, Set,
+                    Tuple)
 
 import pandas as pd
 
-from insaflu_upload.connectors import Connector
+from fastq_handler.records import ProcessActionSubsample
+from fastq_handler.utilities import Utils
+from insaflu_upload.connectors import Connector, UploadStream
 from insaflu_upload.records import InsafluFile, InsafluSampleCodes
 from insaflu_upload.tables_post import InsafluFilesTable
 
@@ -60,6 +67,103 @@ class UploadStep(UploadStrategy):
         return sample_index % self.step == 0
 
 
+@dataclass
+class ManifestEntry:
+    remote_path: str
+    file_path: str
+    size: int
+    mtime_ns: int
+    sha256: str
+
+    def matches(self, file_path: str) -> bool:
+        """
+        file_path is the file uploaded, unchanged since"""
+
+        if file_path != self.file_path:
+            return False
+
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            return False
+
+        return stat.st_size == self.size and stat.st_mtime_ns == self.mtime_ns
+
+
+class UploadManifest:
+    """
+    local record of completed uploads by remote path: local file, size,
+    mtime and sha256 as verified on the server. a file unchanged since
+    its upload is known to be on the server without asking it.
+    """
+
+    output_file = "upload_manifest.tsv"
+    columns = ["remote_path", "file_path", "size", "mtime_ns", "sha256"]
+
+    def __init__(self, output_dir: str):
+        self.manifest_file = os.path.join(output_dir, self.output_file)
+        self.entries: Dict[str, ManifestEntry] = {}
+        self.confirmed: Set[str] = set()
+        self.read()
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def remote_paths(self) -> List[str]:
+        return list(self.entries)
+
+    @property
+    def unconfirmed_paths(self) -> List[str]:
+        """
+        entries neither added nor checked on the server since loaded"""
+        return [remote_path for remote_path in self.entries if remote_path not in self.confirmed]
+
+    def confirm(self, remote_paths: List[str]):
+        self.confirmed.update(remote_paths)
+
+    def read(self):
+        try:
+            with open(self.manifest_file, "r", newline="") as manifest:
+                for row in csv.DictReader(manifest, delimiter="\t"):
+                    self.entries[row["remote_path"]] = ManifestEntry(
+                        row["remote_path"], row["file_path"], int(row["size"]),
+                        int(row["mtime_ns"]), row["sha256"])
+        except FileNotFoundError:
+            pass
+
+    def save(self):
+        tmp_file = self.manifest_file + ".tmp"
+
+        with open(tmp_file, "w", newline="") as manifest:
+            writer = csv.writer(manifest, delimiter="\t", lineterminator="\n")
+            writer.writerow(self.columns)
+
+            for entry in self.entries.values():
+                writer.writerow([entry.remote_path, entry.file_path,
+                                entry.size, entry.mtime_ns, entry.sha256])
+
+        os.replace(tmp_file, self.manifest_file)
+
+    def get(self, remote_path: str) -> Optional[ManifestEntry]:
+        return self.entries.get(remote_path)
+
+    def add(self, remote_path: str, file_path: str, sha256: str):
+        stat = os.stat(file_path)
+
+        self.entries[remote_path] = ManifestEntry(
+            remote_path, file_path, stat.st_size, stat.st_mtime_ns, sha256)
+        self.confirmed.add(remote_path)
+        self.save()
+
+    def remove(self, remote_paths: List[str]):
+        removed = [remote_path for remote_path in remote_paths
+                   if self.entries.pop(remote_path, None) is not None]
+
+        if removed:
+            self.save()
+
+
 class UploadLog:
 
     STATUS_MISSING = InsafluSampleCodes.STATUS_MISSING
@@ -261,9 +365,17 @@ class InsafluUpload(ABC):
         pass
 
     @abstractmethod
-    def upload_file(self, file_path, remote_path, sample_id: str, barcode: str, tag: str):
+    def upload_file(self, file_path, remote_path, sample_id: str, barcode: str, tag: str, source_path: Optional[str] = None):
         """
-        upload file"""
+        upload file, source_path is read in place of file_path if given"""
+        pass
+
+    @abstractmethod
+    def stream_upload(self, remote_path: str, file_path: str,
+                      base_file: Optional[str] = None) -> ContextManager[Optional[UploadStream]]:
+        """
+        stream to remote_path written while file_path is written,
+        after the upload of base_file if given"""
         pass
 
     @abstractmethod
@@ -361,12 +473,24 @@ class InsafluUpload(ABC):
         get sample status"""
         pass
 
+    @abstractmethod
+    def get_samples_status(self, sample_names: List[str]) -> List[int]:
+        """
+        get status of several samples, in order"""
+        pass
+
     @abstractmethod
     def clean_upload(self, file_path: str):
         """
         clean upload"""
         pass
 
+    @abstractmethod
+    def clean_uploads(self, file_paths: List[str]):
+        """
+        clean several uploads"""
+        pass
+
     @abstractmethod
     def launch_televir_project(self, sample_name: str, project_name: Optional[str] = None):
         """
@@ -379,6 +503,12 @@ class InsafluUpload(ABC):
         deploy televir sample"""
         pass
 
+    @abstractmethod
+    def deploy_televir_samples(self, samples: List[Tuple[str, str, str, Optional[str]]]) -> List[int]:
+        """
+        deploy televir samples, (sample_id, sample_name, file_path, project_name) each"""
+        pass
+
     @abstractmethod
     def translate_project_results(self,  project_results: str):
         """
@@ -398,11 +528,19 @@ class InsafluUploadRemote(InsafluUpload):
     logger: UploadLog
     TAG_FASTQ = "fastq"
     TAG_METADATA = "metadata"
+    part_suffix = ".part"
+    manifest: Optional[UploadManifest] = None
+    held_lock = threading.Lock()
+    verify_chunk_size = 200
+    verify_checksum_min_size = 1024 * 1024
 
-    def __init__(self, connector: Connector, config_file: str) -> None:
+    def __init__(self, connector: Connector, config_file: str, delta_upload: bool = False) -> None:
         super().__init__()
         self.logger = UploadLog()
         self.conn = connector
+        self.delta_upload = delta_upload
+        self.throughput_listeners: List[Callable[[int, float], None]] = []
+        self.held_paths: List[str] = []
         self.prep_config(config_file=config_file)
         self.prep_upload()
         self.test_insaflu_user_exists()
@@ -521,20 +659,24 @@ class InsafluUploadRemote(InsafluUpload):
 
         return self.conn.check_file_exists(file_path)
 
-    def upload_file(self, file_path: str, remote_path: str, sample_id="NA", barcode="", tag: Optional[str] = None):
+    def upload_file(self, file_path: str, remote_path: str, sample_id="NA", barcode="", tag: Optional[str] = None,
+                    source_path: Optional[str] = None):
         """
-        upload file to remote server"""
+        upload file to remote server.
+        source_path, e.g. a subsampled copy, is uploaded in place of file_path"""
+
+        if source_path is None:
+            source_path = file_path
 
         status = self.logger.STATUS_MISSING
-        if self.conn.check_file_exists(remote_path):
+        if self.is_uploaded(source_path, remote_path):
             status = self.logger.STATUS_UPLOADED
             self.logging_logger.error(f"File already exists: {file_path}")
 
         else:
             try:
-                self.conn.upload_file(
-                    file_path,
-                    remote_path)
+                checksum = self.upload_resumable(source_path, remote_path)
+                self.record_upload(remote_path, source_path, checksum)
 
                 status = self.logger.STATUS_UPLOADED
 
@@ -553,6 +695,270 @@ class InsafluUploadRemote(InsafluUpload):
             tag=tag
         )
 
+    def is_uploaded(self, source_path: str, remote_path: str) -> bool:
+        """
+        remote_path holds source_path. if the manifest has remote_path, it
+        decides without asking the server, a changed source is not uploaded.
+        otherwise, whether remote_path exists."""
+
+        if self.manifest is not None:
+            entry = self.manifest.get(remote_path)
+
+            if entry is not None:
+                return entry.matches(source_path)
+
+        return self.conn.check_file_exists(remote_path)
+
+    def record_upload(self, remote_path: str, source_path: str, checksum: str):
+        if self.manifest is not None:
+            self.manifest.add(remote_path, source_path, checksum)
+
+    def verify_uploads(self, checksum: bool = False) -> List[str]:
+        """
+        check manifest entries on the server, by size or by sha256 if checksum,
+        verify_chunk_size paths per command, run concurrently. entries added or
+        checked since the manifest was loaded are skipped, files smaller than
+        verify_checksum_min_size, e.g. metadata, are checked by size only.
+        entries not matching, e.g. files removed remotely, are dropped and returned."""
+
+        if self.manifest is None:
+            return []
+
+        remote_paths = self.manifest.unconfirmed_paths
+
+        if not remote_paths:
+            return []
+
+        by_checksum = [remote_path for remote_path in remote_paths
+                       if checksum and self.manifest.get(remote_path).size >= self.verify_checksum_min_size]
+        checksum_paths = set(by_checksum)
+        by_size = [remote_path for remote_path in remote_paths
+                   if remote_path not in checksum_paths]
+
+        commands = []
+        for command, paths in [("sha256sum", by_checksum), ("stat -c '%s %n'", by_size)]:
+            commands.extend(
+                [f"{command} {' '.join(paths[ix:ix + self.verify_chunk_size])} 2>/dev/null"
+                 for ix in range(0, len(paths), self.verify_chunk_size)])
+
+        outputs = self.conn.execute_commands(commands)
+
+        remote_values = {}
+        for output in outputs:
+            for line in output.splitlines():
+                value, _, remote_path = line.partition(" ")
+                remote_values[remote_path.strip()] = value
+
+        dropped = []
+        for remote_path in remote_paths:
+            entry = self.manifest.get(remote_path)
+            expected = entry.sha256 if remote_path in checksum_paths else str(
+                entry.size)
+
+            if remote_values.get(remote_path) != expected:
+                dropped.append(remote_path)
+
+        self.manifest.remove(dropped)
+        self.manifest.confirm(
+            [remote_path for remote_path in remote_paths if remote_path not in dropped])
+
+        return dropped
+
+    def remote_size(self, remote_path: str) -> Optional[int]:
+        """
+        size of remote_path, None if missing"""
+
+        output = self.conn.execute_command(
+            f"stat -c %s {remote_path}").strip()
+
+        if not output.isdigit():
+            return None
+
+        return int(output)
+
+    def get_resume_offset(self, source_path: str, part_path: str) -> Tuple[int, str]:
+        """
+        bytes of source_path already in part_path from an interrupted upload,
+        0 if none or they differ, and the sha256 of source_path."""
+
+        size = os.path.getsize(source_path)
+        part_size = self.remote_size(part_path)
+
+        if part_size is None or part_size == 0 or part_size > size:
+            return 0, Utils.sha256_file(source_path)[0]
+
+        checksum, prefix_checksum = Utils.sha256_file(
+            source_path, prefix_size=part_size)
+
+        if self.remote_sha256(part_path) != prefix_checksum:
+            return 0, checksum
+
+        return part_size, checksum
+
+    def upload_resumable(self, source_path: str, remote_path: str):
+        """
+        upload source_path to a part file moved to remote_path once its size and
+        sha256 match. a part file left by a failed upload is continued from its
+        size if it holds the start of source_path, a connector uploading in
+        ranges resumes the ranges missing itself. returns the sha256, raises on
+        failure, the part file is kept for the next attempt."""
+
+        part_path = remote_path + self.part_suffix
+        size = os.path.getsize(source_path)
+
+        offset, checksum = self.get_resume_offset(source_path, part_path)
+
+        if offset:
+            self.logging_logger.info(
+                f"Resuming upload of {source_path} at {offset} of {size} bytes")
+
+        if offset < size:
+            start = time.perf_counter()
+
+            if offset == 0:
+                self.conn.upload_file(source_path, part_path)
+            else:
+                self.conn.upload_file_range(source_path, part_path, offset)
+
+            self.report_throughput(size - offset, time.perf_counter() - start)
+
+        if self.remote_size(part_path) != size:
+            raise IOError(f"uploaded size differs: {remote_path}")
+
+        if self.remote_sha256(part_path) != checksum:
+            self.conn.execute_command(f"rm -f {part_path}")
+            raise IOError(f"uploaded checksum differs: {remote_path}")
+
+        self.conn.execute_command(f"mv -f {part_path} {remote_path}")
+
+        return checksum
+
+    def get_stream_base(self, base_file: str) -> Optional[ManifestEntry]:
+        """
+        manifest entry of the upload of base_file, if base_file is unchanged
+        since and the upload still on the server with its sha256"""
+
+        if self.manifest is None:
+            return None
+
+        entry = self.manifest.get(self.get_remote_path(base_file))
+
+        if entry is None or not entry.matches(base_file):
+            return None
+
+        if self.remote_sha256(entry.remote_path) != entry.sha256:
+            return None
+
+        return entry
+
+    def copy_stream_base(self, base_file: str, part_path: str) -> Optional[int]:
+        """
+        copy the upload of base_file to part_path on the server, its size.
+        None if it is not on the server as uploaded."""
+
+        with self.hold_remote(self.get_remote_path(base_file)):
+            base = self.get_stream_base(base_file)
+
+            if base is None:
+                return None
+
+            self.conn.execute_command(
+                f"cp --reflink=auto {base.remote_path} {part_path}")
+
+        return base.size
+
+    @contextlib.contextmanager
+    def stream_upload(self, remote_path: str, file_path: str, base_file: Optional[str] = None):
+        """
+        stream to remote_path, e.g. teed from file_path being written.
+        data goes to a part file moved into place if the block exits cleanly,
+        every write went through and its size and sha256 match what was
+        written, removed otherwise. on a mismatch file_path is uploaded again.
+        file_path is recorded as uploaded, it must be complete when the block exits.
+        with base_file, an uploaded file file_path starts with, the part file
+        is first copied from its upload on the server and only the rest is
+        streamed. yields None if the stream can not be opened or base_file
+        is not on the server, the file is then uploaded as usual."""
+
+        part_path = remote_path + self.part_suffix
+        stream = None
+
+        try:
+            offset = 0 if base_file is None else self.copy_stream_base(
+                base_file, part_path)
+
+            if offset is None:
+                self.logging_logger.info(
+                    f"Previous upload not on the server, not streaming: {remote_path}")
+            else:
+                stream = self.conn.open_upload_stream(part_path, offset)
+
+        except Exception as error:
+            self.logging_logger.error(
+                f"Error opening upload stream: {remote_path}")
+            self.logging_logger.error(error)
+            self.conn.execute_command(f"rm -f {part_path}")
+
+        if stream is None:
+            yield None
+            return
+
+        try:
+            yield stream
+        except BaseException:
+            stream.close()
+            self.conn.execute_command(f"rm -f {part_path}")
+            raise
+
+        stream.close()
+
+        if stream.error is not None:
+            self.logging_logger.error(f"Error streaming file: {remote_path}")
+            self.logging_logger.error(stream.error)
+            self.conn.execute_command(f"rm -f {part_path}")
+            return
+
+        if not self.is_stream_complete(part_path, offset, stream):
+            self.logging_logger.error(
+                f"Streamed file differs, uploading it again: {remote_path}")
+            self.conn.execute_command(f"rm -f {part_path}")
+
+            try:
+                checksum = self.upload_resumable(file_path, remote_path)
+                self.record_upload(remote_path, file_path, checksum)
+            except Exception as error:
+                self.logging_logger.error(f"Error uploading file: {file_path}")
+                self.logging_logger.error(error)
+
+            return
+
+        checksum = self.remote_sha256(part_path)
+
+        self.conn.execute_command(f"mv -f {part_path} {remote_path}")
+        self.record_upload(remote_path, file_path, checksum)
+        self.report_throughput(stream.bytes_written, stream.seconds)
+
+    def is_stream_complete(self, part_path: str, offset: int, stream: UploadStream) -> bool:
+        """
+        part_path holds what was streamed after its first offset bytes,
+        checked by size and sha256"""
+
+        if self.remote_size(part_path) != offset + stream.bytes_written:
+            return False
+
+        return self.remote_sha256(part_path, offset) == stream.sha256
+
+    def report_throughput(self, n_bytes: int, seconds: float):
+        """
+        log upload rate, pass upload size and duration to listeners"""
+
+        if seconds > 0:
+            self.logging_logger.info(
+                f"Uploaded {n_bytes / 1e6:.1f} MB in {seconds:.1f} s ({n_bytes / 1e6 / seconds:.1f} MB/s)")
+
+        for listener in self.throughput_listeners:
+            listener(n_bytes, seconds)
+
     def download_file(self, remote_path: str, local_path: str):
         """
         download file from remote server"""
@@ -580,16 +986,131 @@ class InsafluUploadRemote(InsafluUpload):
 
     def upload_sample(self, fastq_path: str, sample_id: str = "NA", barcode: str = ""):
         """
-        upload sample using metadir and fastq path"""
+        upload sample using metadir and fastq path.
+        in delta mode, only what was appended since the last upload is sent if possible"""
+
+        remote_path = self.get_remote_path(fastq_path)
+        source_path = ProcessActionSubsample.get_upload_source(fastq_path)
+
+        if self.delta_upload and source_path == fastq_path and \
+                not self.is_uploaded(source_path, remote_path):
+
+            if self.upload_delta(fastq_path, remote_path, sample_id):
+                self.logger.update_log(
+                    sample_id=sample_id,
+                    barcode=barcode,
+                    file_path=fastq_path,
+                    remote_path=remote_path,
+                    status=self.logger.STATUS_UPLOADED,
+                    tag=self.TAG_FASTQ
+                )
+                return
 
         self.upload_file(
             fastq_path,
-            self.get_remote_path(fastq_path),
+            remote_path,
             sample_id,
             barcode,
-            self.TAG_FASTQ
+            self.TAG_FASTQ,
+            source_path=source_path,
         )
 
+    def get_previous_upload(self, fastq_path: str, sample_id: str) -> Optional[InsafluFile]:
+        """
+        latest upload of sample_id possibly still on the remote, uploaded as
+        is and smaller than fastq_path, e.g. the previous cumulative merged
+        file. submitted files are kept on the remote until cleaned."""
+
+        size = os.path.getsize(fastq_path)
+
+        for sample_file in reversed(self.logger.get_sample_files(sample_id)):
+
+            if sample_file.file_path == fastq_path:
+                continue
+
+            if sample_file.status not in [self.logger.STATUS_UPLOADED, self.logger.STATUS_UPLOADING,
+                                          self.logger.STATUS_SUBMITTED, self.logger.STATUS_PROCESSED]:
+                continue
+
+            if ProcessActionSubsample.get_upload_source(sample_file.file_path) != sample_file.file_path:
+                continue
+
+            if not os.path.isfile(sample_file.file_path) or os.path.getsize(sample_file.file_path) >= size:
+                continue
+
+            return sample_file
+
+        return None
+
+    def remote_sha256(self, remote_path: str, offset: int = 0) -> str:
+        """
+        sha256 of remote_path, from offset on if given, empty if missing"""
+
+        if offset:
+            command = f"tail -c +{offset + 1} {remote_path} | sha256sum"
+        else:
+            command = f"sha256sum {remote_path}"
+
+        output = self.conn.execute_command(command).split()
+
+        if not output or len(output[0]) != 64:
+            return ""
+
+        return output[0]
+
+    def upload_delta(self, fastq_path: str, remote_path: str, sample_id: str) -> bool:
+        """
+        build remote_path from the previous upload of the sample if fastq_path
+        starts with it: copy it remotely, send the rest, check size and sha256.
+        False if there is no such upload or a check fails, nothing is left behind."""
+
+        previous = self.get_previous_upload(fastq_path, sample_id)
+
+        if previous is None:
+            return False
+
+        with self.hold_remote(previous.remote_path):
+            return self.upload_delta_from(fastq_path, remote_path, previous)
+
+    def upload_delta_from(self, fastq_path: str, remote_path: str, previous: InsafluFile) -> bool:
+        """
+        upload_delta from the upload of previous"""
+
+        offset = os.path.getsize(previous.file_path)
+        checksum, prefix_checksum = Utils.sha256_file(
+            fastq_path, prefix_size=offset)
+
+        if self.remote_sha256(previous.remote_path) != prefix_checksum:
+            return False
+
+        part_path = remote_path + self.part_suffix
+
+        try:
+            self.conn.execute_command(
+                f"cp --reflink=auto {previous.remote_path} {part_path}")
+
+            start = time.perf_counter()
+            self.conn.upload_file_range(fastq_path, part_path, offset)
+            seconds = time.perf_counter() - start
+
+            if self.remote_sha256(part_path) != checksum:
+                raise IOError("checksum mismatch after delta upload")
+
+            self.conn.execute_command(f"mv -f {part_path} {remote_path}")
+
+        except Exception as error:
+            self.logging_logger.error(f"Delta upload failed: {fastq_path}")
+            self.logging_logger.error(error)
+            self.conn.execute_command(f"rm -f {part_path}")
+            return False
+
+        self.record_upload(remote_path, fastq_path, checksum)
+        self.logging_logger.info(
+            f"Delta upload: {fastq_path} from {previous.remote_path}, {offset} bytes reused")
+        self.report_throughput(os.path.getsize(fastq_path) - offset, seconds)
+
+        return True
+
     def update_sample_status_remote(self, sample_name: str, file_path: str):
         """
         update sample status"""
@@ -631,30 +1152,81 @@ class InsafluUploadRemote(InsafluUpload):
             status=success_tag
         )
 
+    def sample_status_command(self, sample_name: str) -> str:
+
+        return f"python3 {self.django_manager} check_sample_status --name {sample_name} --user_login {self.televir_user}"
+
     def get_sample_status(self, sample_name: str):
         """
         get sample status"""
 
-        command = f"python3 {self.django_manager} check_sample_status --name {sample_name} --user_login {self.televir_user}"
         sample_status = self.conn.execute_command(
-            command
+            self.sample_status_command(sample_name)
         )
 
         return self.translate_sample_status(sample_status)
 
+    def get_samples_status(self, sample_names: List[str]) -> List[int]:
+        """
+        get status of several samples, queried concurrently"""
+
+        samples_status = self.conn.execute_commands(
+            [self.sample_status_command(sample_name)
+             for sample_name in sample_names]
+        )
+
+        return [self.translate_sample_status(sample_status) for sample_status in samples_status]
+
+    @contextlib.contextmanager
+    def hold_remote(self, remote_path: str):
+        """
+        keep remote_path from being cleaned while the block runs,
+        e.g. the previous upload a delta upload is copied from"""
+
+        with self.held_lock:
+            self.held_paths.append(remote_path)
+
+        try:
+            yield
+        finally:
+            with self.held_lock:
+                self.held_paths.remove(remote_path)
+
     def clean_upload(self, file_path: str):
         """
-        clean upload"""
-        file_exists = self.check_file_exists(file_path)
+        clean upload, kept if held"""
 
-        if file_exists:
-            _ = self.conn.execute_command(
-                f"rm -f {file_path}"
-            )
+        with self.held_lock:
+            if file_path in self.held_paths:
+                return
 
-    def launch_televir_project(self, sample_name: str, project_name: Optional[str] = None):
+            file_exists = self.check_file_exists(file_path)
+
+            if file_exists:
+                _ = self.conn.execute_command(
+                    f"rm -f {file_path}"
+                )
+
+            if self.manifest is not None:
+                self.manifest.remove([file_path])
+
+    def clean_uploads(self, file_paths: List[str]):
         """
-        launch televir project"""
+        clean several uploads concurrently, missing files are ignored,
+        held files are kept"""
+
+        with self.held_lock:
+            file_paths = [file_path for file_path in file_paths
+                          if file_path not in self.held_paths]
+
+            _ = self.conn.execute_commands(
+                [f"rm -f {file_path}" for file_path in file_paths]
+            )
+
+            if self.manifest is not None:
+                self.manifest.remove(file_paths)
+
+    def televir_project_command(self, sample_name: str, project_name: Optional[str] = None) -> str:
 
         if project_name is None:
             project_name = sample_name
@@ -671,10 +1243,14 @@ class InsafluUploadRemote(InsafluUpload):
             project_name
         ]
 
-        command = " ".join(command)
+        return " ".join(command)
+
+    def launch_televir_project(self, sample_name: str, project_name: Optional[str] = None):
+        """
+        launch televir project"""
 
         submit_status = self.conn.execute_command(
-            command
+            self.televir_project_command(sample_name, project_name)
         )
 
         return self.translate_televir_submission_output(submit_status)
@@ -708,6 +1284,52 @@ class InsafluUploadRemote(InsafluUpload):
 
         return submit_status
 
+    def deploy_televir_samples(self, samples: List[Tuple[str, str, str, Optional[str]]]) -> List[int]:
+        """
+        deploy televir samples, projects launched concurrently.
+        the first sample of each project is launched before the others,
+        so the project is created once, not by concurrent launches.
+        samples are (sample_id, sample_name, file_path, project_name)"""
+
+        commands = [self.televir_project_command(sample_name, project_name)
+                    for _, sample_name, _, project_name in samples]
+
+        first_launches: Dict[str, int] = {}
+        for ix, (_, sample_name, _, project_name) in enumerate(samples):
+            first_launches.setdefault(project_name or sample_name, ix)
+
+        first_ixs = list(first_launches.values())
+        other_ixs = [ix for ix in range(len(samples)) if ix not in first_ixs]
+
+        submit_outputs = [""] * len(samples)
+        for ixs in [first_ixs, other_ixs]:
+            outputs = self.conn.execute_commands(
+                [commands[ix] for ix in ixs])
+
+            for ix, output in zip(ixs, outputs):
+                submit_outputs[ix] = output
+
+        submit_statuses = [self.translate_televir_submission_output(
+            submit_output) for submit_output in submit_outputs]
+
+        files_to_clean = []
+
+        for (sample_id, _, file_path, _), submit_status in zip(samples, submit_statuses):
+
+            if submit_status == InsafluSampleCodes.STATUS_TELEVIR_SUBMITTED:
+
+                files_to_clean.extend(
+                    self.logger.get_sample_remotepaths(sample_id))
+
+                self.update_file_status(
+                    file_path,
+                    submit_status,
+                )
+
+        self.clean_uploads(files_to_clean)
+
+        return submit_statuses
+
     def translate_project_results(self, project_results: str) -> str:
         project_file = project_results.splitlines()[-1]
 
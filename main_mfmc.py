@@ -1,5 +1,6 @@
 import argparse
 
+from fastq_handler.compression import CODECS
 from fastq_handler.fastq_handler import PreMain
 from fastq_handler.records import ProcessActionMergeWithLast, RunConfig
 
@@ -23,6 +24,46 @@ def get_arguments():
     parser.add_argument(
         "--monitor", help="run indefinitely", action="store_true")
 
+    parser.add_argument(
+        "--watch", help="in monitor mode, wake on new files (linux inotify) instead of sleeping the full interval",
+        action="store_true")
+
+    parser.add_argument(
+        "--completeness", help="how to decide a chunk is finished (default: open_files)",
+        choices=["open_files", "quiescence", "gzip_trailer"], default="open_files")
+
+    parser.add_argument(
+        "--workers", help="number of barcode directories merged in parallel (default: 1)",
+        type=int, default=1)
+
+    parser.add_argument(
+        "--coalesce", help="write only the last cumulative file when a barcode has more than this many new chunks (default: 0, off)",
+        type=int, default=0)
+
+    parser.add_argument(
+        "--codec", help="gzip backend (default: auto, fastest available at startup)",
+        choices=["auto"] + list(CODECS), default="auto")
+
+    parser.add_argument(
+        "--compress-threads", help="threads per compression, isal, zlib-ng and pigz (default: 1)",
+        type=int, default=1)
+
+    parser.add_argument(
+        "--compresslevel", help="gzip level for new chunks (default: 3)",
+        type=int, default=3)
+
+    parser.add_argument(
+        "--stats", help="record reads, bases, N50 and mean quality of each chunk while merging",
+        action="store_true")
+
+    parser.add_argument(
+        "--bgzf", help="write merged files as bgzf with a block index (.blocks) next to them",
+        action="store_true")
+
+    parser.add_argument(
+        "--batch", help="merge all new chunks of a barcode in one pass per cycle",
+        action="store_true")
+
     return parser.parse_args()
 
 
@@ -36,7 +77,17 @@ def main():
         name_tag=args.tag,
         actions=[ProcessActionMergeWithLast],
         keep_name=args.keep_names,
-        sleep_time=args.sleep
+        sleep_time=args.sleep,
+        watch=args.watch,
+        completeness=args.completeness,
+        workers=args.workers,
+        batch=args.batch,
+        coalesce_threshold=args.coalesce,
+        codec=args.codec,
+        compress_threads=args.compress_threads,
+        compresslevel=args.compresslevel,
+        stats=args.stats,
+        bgzf=args.bgzf,
     )
 
     compressor = PreMain(